@@ -7,25 +7,7 @@
 __version__ = "0.0.8"
 
 def get_connected_linkers():
-	# Get D2xx linkers
-	from typing import List
+	""" Open every connected linker, see pm2hw.discovery for finding them without opening """
+	from pm2hw.discovery import discover
 
-	import ftd2xx
-
-	from pm2hw.linkers import BaseLinker, linkers
-	from pm2hw.locales import delayed_gettext as _
-	from pm2hw.exceptions import clarify
-
-	num_devices = ftd2xx.createDeviceInfoList()
-	devices: List[BaseLinker] = []
-	for i in range(num_devices):
-		# getDeviceInfoDetail returns null data for PokeCard
-		with clarify(_("exception.device.open.failed")):
-			dev = ftd2xx.open(i)
-		linker_cls = linkers.get(dev.description)
-		if linker_cls:
-			devices.append(linker_cls(dev))
-		else:
-			dev.close()
-
-	return devices
+	return [device.open() for device in discover()]
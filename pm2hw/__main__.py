@@ -4,19 +4,25 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import os
 import sys
 import argparse
-from io import BytesIO
+from shutil import copyfileobj
+from functools import partial
+from multiprocessing import parent_process
+from tempfile import NamedTemporaryFile
 from enum import Enum
 from time import time
-from typing import List
+from typing import List, Optional
 
-from pm2hw import get_connected_linkers, logger, linkers
+from pm2hw import daemon, get_connected_linkers, logger, linkers
 from pm2hw.base import BaseFlashable
+from pm2hw.image import MappedImage
+from pm2hw.scheduler import raise_first, run_all, summarize
 from pm2hw.info import games
 from pm2hw.info.games.base import ROM
 from pm2hw.config import config, save as save_config
-from pm2hw.logger import log, error, exception, progress, verbose, LogRecord
+from pm2hw.logger import log, warn, debug, error, exception, progress, verbose, LogRecord
 from pm2hw.linkers import extra_options
 from pm2hw.locales import gettext as _, natural_size, parse_natural_size, bind_domain
 from pm2hw.exceptions import DeviceError
@@ -70,15 +76,21 @@ group.add_argument("-a", "--all", action="store_true", dest="all_global",
 	help=_("cli.help.param.all"))
 parser.add_argument("-v", "--verbose", action="count", dest="verbose_global", default=0,
 	help=_("cli.help.param.verbose"))
+parser.add_argument("-P", "--processes", action="store_true", dest="processes_global",
+	help=_("cli.help.param.processes"))
 parser.add_argument("--profile", action="store_true", dest="profile_global",
 	help=argparse.SUPPRESS)
+parser.add_argument("--simulate", metavar="linker", action="append", dest="simulate_global",
+	default=[], help=argparse.SUPPRESS)
 
 def add_common_flags(cmd: argparse.ArgumentParser):
 	group = cmd.add_mutually_exclusive_group()
 	group.add_argument("-l", "--linker", help=argparse.SUPPRESS)
 	group.add_argument("-a", "--all", action="store_true", help=argparse.SUPPRESS)
 	cmd.add_argument("-v", "--verbose", action="count", default=0, help=argparse.SUPPRESS)
+	cmd.add_argument("-P", "--processes", action="store_true", help=argparse.SUPPRESS)
 	cmd.add_argument("--profile", action="store_true", help=argparse.SUPPRESS)
+	cmd.add_argument("--simulate", metavar="linker", action="append", default=[], help=argparse.SUPPRESS)
 	return group
 
 subparsers = parser.add_subparsers(dest="cmd", title="actions")
@@ -92,6 +104,10 @@ flash_cmd.add_argument("-E", "--no-erase", action="store_false", dest="erase",
 	help=_("cli.help.param.flash.no-erase"))
 flash_cmd.add_argument("-V", "--no-verify", action="store_false", dest="verify",
 	help=_("cli.help.param.flash.no-verify"))
+flash_cmd.add_argument("-D", "--differential", action="store_true",
+	help=_("cli.help.param.flash.differential"))
+flash_cmd.add_argument("-r", "--resume", action="store_true",
+	help=_("cli.help.param.flash.resume"))
 flash_cmd.add_argument("roms", metavar="file", # nargs=argparse.ONE_OR_MORE,
 	help=_("cli.help.param.flash.roms"))
 
@@ -105,6 +121,8 @@ add_common_flags(dump_cmd)
 # 	help=_("cli.help.param.dump.split"))
 dump_cmd.add_argument("-p", "--partial", metavar="{size,offset:size}",
 	help=_("cli.help.param.dump.partial"))
+dump_cmd.add_argument("-r", "--resume", action="store_true",
+	help=_("cli.help.param.dump.resume"))
 dump_cmd.add_argument("dest", metavar="file", nargs="?", default="{i:02d}-{code}-{name}.min",
 	help=_("cli.help.param.dump.dest"))
 
@@ -137,6 +155,19 @@ config_cmd.add_argument("settings", nargs="*",
 test_cmd = subparsers.add_parser("test",
 	help=_("cli.help.command.test"), **common)
 
+calibrate_cmd = subparsers.add_parser("calibrate",
+	help=_("cli.help.command.calibrate"), **common)
+add_common_flags(calibrate_cmd)
+
+daemon_cmd = subparsers.add_parser("daemon",
+	help=_("cli.help.command.daemon"), **common)
+add_common_flags(daemon_cmd)
+daemon_cmd.add_argument("action", choices=["start", "stop"], nargs="?", default="start",
+	help=_("cli.help.param.daemon.action"))
+
+# Daemon keeping the linkers while serving requests, see pm2hw.daemon
+held: Optional[daemon.Daemon] = None
+
 
 def parse_partial(x):
 	if ":" in x:
@@ -146,9 +177,15 @@ def parse_partial(x):
 		return 0, parse_natural_size(x)
 
 
+def find_linkers(args):
+	if args.simulate:
+		from pm2hw.linkers.simulated import get_simulated_linkers
+		return get_simulated_linkers(args.simulate)
+	return get_connected_linkers()
+
 def connect(args):
 	log(_("cli.connect.search"))
-	linkers = get_connected_linkers()
+	linkers = held.linkers if held is not None else find_linkers(args)
 	if not linkers:
 		raise DeviceError(_("cli.connect.no-linkers"))
 	elif args.linker:
@@ -162,6 +199,9 @@ def connect(args):
 			raise DeviceError(_("cli.linker.device.not-found"))
 		linkers = [found]
 	elif len(linkers) > 1 and not args.all:
+		if held is not None:
+			# Nobody to ask
+			raise DeviceError(_("cli.daemon.select-linker"))
 		valid_choices = ["a", "A"]
 		print(_("cli.connect.select-linker.title"), file=sys.stderr)
 		for i, l in enumerate(linkers):
@@ -182,7 +222,7 @@ def connect(args):
 
 	flashables: List[BaseFlashable] = []
 	for linker in linkers:
-		flashable = linker.init()
+		flashable = held.connect([linker])[0] if held is not None else linker.init()
 		flashables.append(flashable)
 		log(_("cli.connect.connected"), name=flashable.name)
 		try:
@@ -193,6 +233,98 @@ def connect(args):
 
 	return flashables, time()
 
+def report_simulated(flashables: List[BaseFlashable]):
+	for flashable in flashables:
+		linker = getattr(flashable, "linker", flashable)
+		if linker.handle is None:
+			# Handed over to a worker process, which reported it
+			continue
+		report = linker.clock.report()
+		log(_("cli.simulate.report"),
+			name=linker.name,
+			secs=report.secs,
+			writes=report.usb_writes,
+			reads=report.usb_reads,
+			bytes_out=report.bytes_out,
+			bytes_in=report.bytes_in,
+			busy=report.chip_busy,
+			slept=report.slept,
+		)
+		if report.busy_violations:
+			warn(_("cli.simulate.busy-violations"), name=linker.name, count=report.busy_violations)
+
+def job_done(flashable: BaseFlashable, args):
+	# Worker processes don't hand their simulated linkers back
+	if args.simulate and parent_process() is not None:
+		report_simulated([flashable])
+
+def flash_job(flashable: BaseFlashable, args, rom: str) -> int:
+	if rom == "-":
+		reader = games.LookupReader(sys.stdin.buffer)
+		errors = flashable.flash(reader, erase=args.erase, differential=args.differential, verify=args.verify, resume=args.resume)
+	else:
+		with open(rom, "rb") as f:
+			reader = games.LookupReader(f)
+			errors = flashable.flash(reader, erase=args.erase, differential=args.differential, verify=args.verify, resume=args.resume)
+	if args.verify:
+		# Blocks are read back while flashing
+		if errors:
+			log(_("cli.flash.verify.failure"))
+		else:
+			log(_("cli.flash.verify.success"))
+	job_done(flashable, args)
+	return reader.tell()
+
+def dump_job(flashable: BaseFlashable, args, kwargs: dict, index: int) -> int:
+	linker = getattr(flashable, "linker", flashable)
+	if args.dest == "-":
+		flashable.dump(sys.stdout.buffer, resume=args.resume, **kwargs)
+	else:
+		kw = {"i": index, "linker": linker.name}
+		for search, key, addr, size, enc in [
+			("{code", "code", 0x021ac, 4, "ascii"),
+			("{name", "name", 0x021b0, 12, "shift-jis"),
+		]:
+			if search in args.dest:
+				flashable.seek(addr)
+				try:
+					kw[key] = flashable.read(size).rstrip(b"\0").decode(enc)
+				except UnicodeDecodeError:
+					kw[key] = "x" * size
+		dest = args.dest.format(**kw)
+		# Resuming writes over the rest of what's there
+		mode = "r+b" if args.resume and os.path.exists(dest) else "w+b"
+		with MappedImage.open(dest, mode) as f:
+			flashable.dump(f, resume=args.resume, **kwargs)
+			f.truncate()
+	job_done(flashable, args)
+	offset = kwargs.get("offset", 0)
+	return min(kwargs.get("size") or flashable.memory, flashable.memory - offset)
+
+def erase_job(flashable: BaseFlashable, args, kwargs: dict) -> int:
+	flashable.erase(**kwargs)
+	job_done(flashable, args)
+	return kwargs.get("size") or flashable.memory
+
+def test_job(flashable: BaseFlashable, args) -> int:
+	flashable.test()
+	job_done(flashable, args)
+	return flashable.memory
+
+def serve(args):
+	global held
+	if args.simulate:
+		held = daemon.Daemon(find_linkers(args))
+	else:
+		from pm2hw.discovery import Watcher
+		held = daemon.Daemon(find_linkers(args), Watcher())
+	try:
+		held.serve(run_for_daemon)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		held = None
+
 def _main(args):
 	if args.verbose:
 		logger.set_level([logger.VERBOSE, logger.DEBUG, logger.PROTOCOL][min(args.verbose - 1, 2)])
@@ -200,68 +332,74 @@ def _main(args):
 	if args.cmd in {"f", "flash"}:
 		flashables, start = connect(args)
 		log(_("cli.flash.intro"))
-		if args.roms == "-":
-			data = BytesIO(sys.stdin.buffer.read())
-		for flashable in flashables:
-			# TODO: multithreaded
-			if not args.erase:
-				# Delete the erase method
-				flashable.erase_data = lambda *a: None
-
-			if args.roms == "-":
-				flashable.flash(data)
-			else:
-				with open(args.roms, "rb") as f:
-					flashable.flash(f)
-					if args.verify:
-						log(_("cli.flash.verify.intro"))
-						if flashable.verify(f):
-							log(_("cli.flash.verify.success"))
-						else:
-							log(_("cli.flash.verify.failure"))
+		rom = spooled = args.roms
+		if rom == "-" and len(flashables) > 1:
+			# Every card needs its own pass over the ROM
+			with NamedTemporaryFile(suffix=".min", delete=False) as f:
+				copyfileobj(sys.stdin.buffer, f)
+			rom = spooled = f.name
+
+		try:
+			results = run_all(flashables, partial(flash_job, args=args, rom=rom), processes=args.processes)
+		finally:
+			if spooled != args.roms:
+				os.remove(spooled)
 		if len(flashables) > 1:
 			log(_("cli.flash.complete"), secs=time() - start)
+			summarize(results, time() - start)
+		raise_first(results)
 		return flashables
 	elif args.cmd in {"d", "dump"}:
 		flashables, start = connect(args)
 		log(_("cli.dump.intro"))
-		for i, flashable in enumerate(flashables):
-			# TODO: multithreaded
-			kwargs = {}
-			if args.partial:
-				kwargs["offset"], kwargs["size"] = parse_partial(args.partial)
-
-			if args.dest == "-":
-				flashable.dump(sys.stdout.buffer, **kwargs)
-			else:
-				kw = {"i": i, "linker": getattr(flashable, "linker", flashable).name}
-				for search, key, addr, size, enc in [
-					("{code", "code", 0x021ac, 4, "ascii"),
-					("{name", "name", 0x021b0, 12, "shift-jis"),
-				]:
-					if search in args.dest:
-						flashable.seek(addr)
-						try:
-							kw[key] = flashable.read(size).rstrip(b"\0").decode(enc)
-						except UnicodeDecodeError:
-							kw[key] = "x" * size
-				with open(args.dest.format(**kw), "wb") as f:
-					flashable.dump(f, **kwargs)
+		kwargs = {}
+		if args.partial:
+			kwargs["offset"], kwargs["size"] = parse_partial(args.partial)
+
+		# Each dump's {i} is its place in the list, serials may be blank or shared
+		jobs = [partial(dump_job, args=args, kwargs=kwargs, index=i) for i in range(len(flashables))]
+		# Dumps to stdout would be interleaved
+		results = run_all(flashables, jobs, parallel=args.dest != "-", processes=args.processes)
 		if len(flashables) > 1:
 			log(_("cli.dump.complete"), secs=time() - start)
+			summarize(results, time() - start)
+		raise_first(results)
 		return flashables
 	elif args.cmd in {"e", "erase"}:
 		flashables, start = connect(args)
 		log(_("cli.erase.intro"))
-		for flashable in flashables:
-			# TODO: multithreaded
-			kwargs = {}
-			if args.partial:
-				kwargs["offset"], kwargs["size"] = parse_partial(args.partial)
-			flashable.erase(**kwargs)
+		kwargs = {}
+		if args.partial:
+			kwargs["offset"], kwargs["size"] = parse_partial(args.partial)
+
+		results = run_all(flashables, partial(erase_job, args=args, kwargs=kwargs), processes=args.processes)
 		if len(flashables) > 1:
 			log(_("cli.erase.complete"), secs=time() - start)
+			summarize(results, time() - start)
+		raise_first(results)
 		return flashables
+	elif args.cmd == "calibrate":
+		flashables, start = connect(args)
+		log(_("cli.calibrate.intro"))
+
+		def calibrate(flashable: BaseFlashable):
+			if not hasattr(flashable, "calibrate"):
+				raise DeviceError(_("cli.calibrate.unsupported").format(name=getattr(flashable, "linker", flashable).name))
+			flashable.calibrate()
+			return 0
+
+		# Measurements would disturb each other
+		raise_first(run_all(flashables, calibrate, parallel=False))
+		return flashables
+	elif args.cmd == "daemon":
+		if args.action == "stop":
+			if daemon.stop():
+				log(_("cli.daemon.stopped"))
+			else:
+				warn(_("cli.daemon.not-running"))
+		else:
+			serve(args)
+			log(_("cli.daemon.stopped"))
 	elif args.cmd in {"i", "info"}:
 		def print_info_line(name, rhs):
 			print(
@@ -398,10 +536,12 @@ def _main(args):
 	elif args.cmd == "test":
 		flashables, start = connect(args)
 		log(_("cli.test.intro"))
-		for flashable in flashables:
-			flashable.test()
+
+		results = run_all(flashables, partial(test_job, args=args), processes=args.processes)
 		if len(flashables) > 1:
 			log(_("cli.test.complete"), secs=time() - start)
+			summarize(results, time() - start)
+		raise_first(results)
 		return flashables
 	elif args.linker is not None:
 		print(_("cli.linker.intro"))
@@ -411,16 +551,52 @@ def _main(args):
 		parser.print_help()
 
 
+def parse_args(argv: Optional[List[str]] = None):
+	args = parser.parse_args(argv)
+	# Normalize globals
+	args.all = args.all_global or getattr(args, "all", False)
+	args.linker = args.linker_global or getattr(args, "linker", False)
+	args.profile = args.profile_global or getattr(args, "profile", False)
+	args.processes = args.processes_global or getattr(args, "processes", False)
+	args.simulate = args.simulate_global + getattr(args, "simulate", [])
+	args.verbose = args.verbose_global + getattr(args, "verbose", 0)
+	return args
+
+def uses_daemon(args) -> bool:
+	""" Whether the command should be sent to a running daemon """
+	if args.simulate or args.profile or held is not None:
+		return False
+	if args.cmd in {"i", "info"}:
+		return not args.rom
+	return args.cmd in {"f", "flash", "d", "dump", "e", "erase", "test", "calibrate"}
+
+def run_for_daemon(argv: List[str]) -> int:
+	try:
+		args = parse_args(argv)
+	except SystemExit as err:
+		return err.code
+	# The daemon owns the handles
+	args.processes = False
+	return run(args)
+
 def main():
 	try:
-		args = parser.parse_args()
-		# Normalize globals
-		args.all = args.all_global or getattr(args, "all", False)
-		args.linker = args.linker_global or getattr(args, "linker", False)
-		args.profile = args.profile_global or getattr(args, "profile", False)
-		args.verbose = args.verbose_global + getattr(args, "verbose", 0)
-
-		if args.profile:	
+		args = parse_args()
+		if uses_daemon(args):
+			stdin = None
+			if args.cmd in {"f", "flash"} and args.roms == "-":
+				stdin = sys.stdin.buffer
+			code = daemon.request(sys.argv[1:], stdin)
+			if code is not None:
+				return code
+	except DeviceError as err:
+		error(_("cli.error.device"), errmsg=str(err))
+		return 1
+	return run(args)
+
+def run(args):
+	try:
+		if args.profile:
 			import cProfile
 			from pstats import Stats
 
@@ -439,7 +615,14 @@ def main():
 			stats.sort_stats("time")
 			stats.dump_stats(name + ".prof")
 		else:
-			_main(args)
+			flashables = _main(args)
+		if flashables:
+			for flashable in flashables:
+				linker = getattr(flashable, "linker", flashable)
+				if hasattr(linker, "wait_stats"):
+					debug("Waited on {name}: {stats}", name=linker.name, stats=linker.wait_stats)
+			if args.simulate:
+				report_simulated(flashables)
 		return 0
 	except DeviceError as err:
 		error(_("cli.error.device"), errmsg=str(err))
@@ -0,0 +1,238 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import asyncio
+import logging
+from threading import Event, get_ident, local
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, BinaryIO, Callable, Dict, List, NamedTuple, Optional
+
+from pm2hw import logger
+from pm2hw.base import BaseFlashable
+from pm2hw.linkers import BaseLinker
+from pm2hw.logger import LogRecord, progress
+from pm2hw.exceptions import OperationCancelled
+
+class Progress(NamedTuple):
+	""" How far along one stage of an operation is """
+	# Which progress message it is, like erase, flash, dump, or verify
+	stage: str
+	current: int
+	end: int
+
+	@property
+	def percent(self) -> float:
+		return self.current * 100 / self.end if self.end else 0
+
+
+class _ProgressHook(logging.Handler):
+	""" Passes progress from an operation's thread to the event loop """
+
+	def __init__(self, operation: "Operation"):
+		super().__init__()
+		self.operation = operation
+		self.thread = get_ident()
+
+	def emit(self, record: LogRecord):
+		msg = record.msg
+		if isinstance(msg, progress):
+			section = getattr(msg.msg, "section", None)
+			self.operation._update(Progress(section.name if section else "", msg.current, msg.end))
+
+	def filter(self, record: LogRecord) -> bool:
+		return record.thread == self.thread and super().filter(record)
+
+
+# The operation running on this thread
+_current = local()
+
+class _Tracker:
+	""" Progress for the lower level card methods, which take one """
+
+	def __init__(self, stage: str, end: int):
+		self.operation: "Operation" = _current.operation
+		self.stage = stage
+		self.current = 0
+		self.end = end
+
+	def add(self, value: int):
+		self.update(self.current + value)
+
+	def update(self, value: int):
+		self.current = value
+		self.operation._update(Progress(self.stage, value, self.end))
+
+	def done(self):
+		if self.end > self.current:
+			self.end = self.current
+
+
+class Operation:
+	"""
+	A card operation running on its linker's thread. Await it for the
+	result, and iterate over it with async for to follow its progress.
+
+	Cancelling the task awaiting it, or running out of time, stops the
+	operation at the card's next block, leaving the linker ready for the
+	next command. What was done so far stays done, so flashing and
+	dumping can be resumed.
+	"""
+
+	def __init__(self, alinker: "AsyncLinker", fn: Callable, *args, timeout: Optional[float] = None, **kwargs):
+		self.timeout = timeout
+		self._loop = asyncio.get_running_loop()
+		self._updates: "asyncio.Queue[Optional[Progress]]" = asyncio.Queue()
+		self._cancelled = Event()
+		self._future = self._loop.run_in_executor(alinker.executor, self._run, alinker, fn, args, kwargs)
+		# Nothing retrieves the outcome once it's been cancelled
+		self._future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+	def _run(self, alinker: "AsyncLinker", fn: Callable, args: tuple, kwargs: Dict[str, Any]):
+		# Operations on a linker run one at a time, so the card is this one's
+		card = alinker.card.card if alinker.card is not None else None
+		hook = _ProgressHook(self)
+		logger.add_handler(hook)
+		_current.operation = self
+		if card is not None:
+			card.cancel = self._cancelled
+		try:
+			self._check()
+			return fn(*args, **kwargs)
+		except OperationCancelled:
+			raise asyncio.CancelledError() from None
+		finally:
+			if card is not None:
+				card.cancel = None
+			logger.remove_handler(hook)
+			_current.operation = None
+			self._loop.call_soon_threadsafe(self._updates.put_nowait, None)
+
+	def _check(self):
+		if self._cancelled.is_set():
+			raise asyncio.CancelledError()
+
+	def _update(self, update: Progress):
+		self._loop.call_soon_threadsafe(self._updates.put_nowait, update)
+
+	def cancel(self):
+		""" Stop at the card's next block """
+		self._cancelled.set()
+
+	def done(self) -> bool:
+		return self._future.done()
+
+	async def result(self):
+		try:
+			return await asyncio.wait_for(asyncio.shield(self._future), self.timeout)
+		except (asyncio.CancelledError, asyncio.TimeoutError):
+			self.cancel()
+			raise
+
+	def __await__(self):
+		return self.result().__await__()
+
+	async def __aiter__(self) -> AsyncIterator[Progress]:
+		while True:
+			update = await self._updates.get()
+			if update is None:
+				return
+			yield update
+
+
+class AsyncCard:
+	"""
+	Asynchronous front for a card. Each method starts the operation on the
+	linker's thread and returns an Operation, operations on the same
+	linker run one after another.
+	"""
+
+	def __init__(self, alinker: "AsyncLinker", card: BaseFlashable):
+		self.linker = alinker
+		self.card = card
+
+	@property
+	def name(self) -> str:
+		return self.card.name
+
+	@property
+	def memory(self) -> int:
+		return self.card.memory
+
+	def _run(self, fn: Callable, *args, timeout: Optional[float] = None, **kwargs) -> Operation:
+		return Operation(self.linker, fn, *args, timeout=timeout, **kwargs)
+
+	def flash(self, stream: BinaryIO, *, timeout: Optional[float] = None, **kwargs) -> Operation:
+		""" See BaseFlashable.flash """
+		return self._run(self.card.flash, stream, timeout=timeout, **kwargs)
+
+	def dump(self, stream: BinaryIO, *, timeout: Optional[float] = None, **kwargs) -> Operation:
+		""" See BaseFlashable.dump """
+		return self._run(self.card.dump, stream, timeout=timeout, **kwargs)
+
+	def erase(self, *, timeout: Optional[float] = None, **kwargs) -> Operation:
+		""" See BaseFlashable.erase """
+		return self._run(self.card.erase, timeout=timeout, **kwargs)
+
+	def verify(self, stream: BinaryIO, *, timeout: Optional[float] = None) -> Operation:
+		""" See BaseFlashable.verify """
+		return self._run(self.card.verify, stream, timeout=timeout)
+
+	def test(self, *, timeout: Optional[float] = None) -> Operation:
+		""" See BaseFlashable.test """
+		return self._run(self.card.test, timeout=timeout)
+
+	def read_data(self, addr: int, size: int, *, timeout: Optional[float] = None) -> Operation:
+		""" Read size bytes from addr, the result is the bytes """
+		return self._run(self._read_data, addr, size, timeout=timeout)
+
+	def _read_data(self, addr: int, size: int) -> bytes:
+		reads = self.card.read_data(addr, size, prog=_Tracker("read", size))
+		ret = []
+		try:
+			for data in reads:
+				ret.append(data)
+				self.card.check_cancelled()
+		finally:
+			# Reads still in flight are drained
+			reads.close()
+		return b"".join(ret)
+
+
+class AsyncLinker:
+	"""
+	Asynchronous front for a linker. Its blocking calls run on a thread of
+	its own, so one event loop can drive several linkers at once.
+	"""
+
+	def __init__(self, linker: BaseLinker, *, executor: Optional[ThreadPoolExecutor] = None):
+		self.linker = linker
+		self.executor = executor or ThreadPoolExecutor(1, thread_name_prefix="pm2hw")
+		self.card: Optional[AsyncCard] = None
+
+	@property
+	def name(self) -> str:
+		return self.linker.name
+
+	def run(self, fn: Callable, *args, timeout: Optional[float] = None, **kwargs) -> Operation:
+		""" Run any blocking call on this linker's thread """
+		return Operation(self, fn, *args, timeout=timeout, **kwargs)
+
+	async def init(self, *, timeout: Optional[float] = None) -> AsyncCard:
+		""" Initialize the connection to the linker, see BaseLinker.init """
+		self.card = AsyncCard(self, await self.run(self.linker.init, timeout=timeout))
+		return self.card
+
+	async def close(self):
+		await self.run(self.linker.close)
+		self.executor.shutdown(wait=False)
+
+
+async def connected_linkers() -> List[AsyncLinker]:
+	""" Open every connected linker, see pm2hw.get_connected_linkers """
+	from pm2hw import get_connected_linkers
+
+	loop = asyncio.get_running_loop()
+	return [AsyncLinker(linker) for linker in await loop.run_in_executor(None, get_connected_linkers)]
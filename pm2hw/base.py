@@ -4,14 +4,34 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
-from io import BufferedIOBase, BytesIO
+from io import BytesIO, RawIOBase
 from os import SEEK_SET
-from typing import TYPE_CHECKING, Any, BinaryIO, Callable, ClassVar, Iterable, Optional, Protocol, Union
+from typing import TYPE_CHECKING, Any, BinaryIO, Callable, ClassVar, Dict, Iterable, Optional, Protocol, Union
 
 if TYPE_CHECKING:
 	from pm2hw.linkers.base import BaseLinker
 
-Transform = Callable[[int], int]
+class Transform(bytes):
+	""" Byte-wise transformation as a 256-entry translation table """
+
+	@classmethod
+	def from_function(cls, fn: Callable[[int], int]) -> "Transform":
+		return cls(fn(x) & 0xff for x in range(256))
+
+	@classmethod
+	def coerce(cls, transform: Optional[Callable[[int], int]]) -> Optional["Transform"]:
+		""" Accept plain functions where a Transform is expected """
+		if transform is None or isinstance(transform, cls):
+			return transform
+		return cls.from_function(transform)
+
+	def __call__(self, x: int) -> int:
+		return self[x]
+
+	def apply(self, data: Union[bytes, bytearray, memoryview]) -> bytes:
+		if isinstance(data, memoryview):
+			data = data.tobytes()
+		return data.translate(self)
 
 BytesOrSequence = Union[
 	bytes,
@@ -32,6 +52,19 @@ def chunked(size, source):
     for i in range(0, len(source), size):
         yield source[i:i+size]
 
+def read_fully(stream: BinaryIO, size: int) -> bytes:
+	""" Read size bytes, or up to the end, from a stream which may return less at once, like a pipe """
+	data = stream.read(size)
+	if len(data) == size:
+		return data
+	buf = bytearray(data)
+	while len(buf) < size:
+		data = stream.read(size - len(buf))
+		if not data:
+			break
+		buf += data
+	return bytes(buf)
+
 class Handle(Protocol):
 	def read(self, size: int) -> bytes:
 		...
@@ -42,37 +75,54 @@ class Handle(Protocol):
 	def close(self):
 		...
 
-class BaseReader(BufferedIOBase):
+class BaseReader(RawIOBase):
+	""" Response to a read_data request, decoded as it's read """
+
 	def __init__(self, linker: "BaseLinker", size: int, transform: Optional[Transform] = None) -> None:
 		self.linker = linker
 		self._size = size
-		self.transform = transform
+		self.transform = Transform.coerce(transform)
 		self._position = 0
 
 	def __len__(self):
 		return self._size
 
-	def read(self, size: Optional[int] = None) -> bytes:
-		tr = self.transform
-		if size is None:
-			size = self._size
+	def readable(self):
+		return True
 
-		read_size = self._position
-		ret = b""
-		while read_size < size:
-			res = self.linker.read_in(size)
-			read_size += len(res)
-			if tr:
-				ret += bytes(tr(r) for r in res)
-			else:
-				ret += res
+	def readinto(self, buffer) -> int:
+		""" Decode up to len(buffer) bytes of the response directly into buffer """
+		view = memoryview(buffer).cast("B")[:self._size - self._position]
+		if not view:
+			return 0
 
-		self._position = read_size
-		return ret
+		size = self.linker.read_into(view)
+		tr = self.transform
+		if tr:
+			view[:size] = tr.apply(view[:size])
+		self._position += size
+		return size
+
+	def read(self, size: Optional[int] = -1) -> bytes:
+		remaining = self._size - self._position
+		if size is None or size < 0 or size > remaining:
+			size = remaining
+
+		ret = bytearray(size)
+		view = memoryview(ret)
+		read_size = 0
+		while read_size < size:
+			res = self.readinto(view[read_size:])
+			if not res:
+				break
+			read_size += res
+		return bytes(view[:read_size])
 
 	def clear(self):
-		if self._position < self.size:
-			self.linker.read_in(self.size - self._position)
+		""" Discard the rest of the response """
+		if self._position < self._size:
+			self.linker.read_in(self._size - self._position)
+			self._position = self._size
 
 
 class BaseFlashable:
@@ -80,7 +130,7 @@ class BaseFlashable:
 	can_erase = True
 	name: ClassVar[str]
 
-	def flash(self, stream: BinaryIO, *, erase: bool = True):
+	def flash(self, stream: BinaryIO, *, erase: bool = True, differential: bool = False, verify: bool = False, resume: bool = False) -> Optional[Dict[int, int]]:
 		""" Flash a ROM to the card """
 		raise NotImplementedError
 
@@ -93,7 +143,7 @@ class BaseFlashable:
 		buff2.seek(0)
 		return buff1 == buff2.read()
 
-	def dump(self, stream: BinaryIO, *, offset: int = 0, size: int = 0):
+	def dump(self, stream: BinaryIO, *, offset: int = 0, size: int = 0, resume: bool = False):
 		""" Dump a ROM from the card """
 		raise NotImplementedError
 
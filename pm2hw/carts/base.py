@@ -4,14 +4,19 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
-from io import BytesIO
-from os import SEEK_SET, SEEK_CUR, SEEK_END
-from typing import TYPE_CHECKING, BinaryIO, ClassVar, Iterator, Optional, Tuple
-
-from pm2hw.base import BaseFlashable
+import re
+from os import SEEK_SET, SEEK_END
+from threading import Event
+from typing import TYPE_CHECKING, BinaryIO, ClassVar, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from pm2hw.base import chunked, read_fully, BaseFlashable
+from pm2hw.image import MappedImage
+from pm2hw.carts.cache import SectorCache
+from pm2hw.carts.journal import Journal
+from pm2hw.carts.view import CardView
 from pm2hw.logger import error, log, progress, verbose, warn
 from pm2hw.locales import delayed_gettext as _, natural_size
-from pm2hw.exceptions import DeviceError, DeviceTestReadingError, DeviceTestWritingError
+from pm2hw.exceptions import DeviceError, DeviceTestReadingError, DeviceTestWritingError, OperationCancelled
 
 if TYPE_CHECKING:
 	from pm2hw.linkers.base import BaseLinker
@@ -22,17 +27,63 @@ class DummyProgress(progress):
 
 dummy_progress = DummyProgress("", 0)
 
+def count_differences(a: bytes, b: bytes) -> int:
+	""" Number of bytes which differ between a and b """
+	return sum(x != y for x, y in zip(a, b)) + abs(len(a) - len(b))
+
 class BaseCard(BaseFlashable):
 	chip: str
 	memory: int  # Size available in bytes
 	block_size: int
 	packet_size: ClassVar[int]
 	erased_byte: ClassVar[int]  # fill byte when erased
-	_cursor = 0
+	# Manufacturer, device code, and extended code, once detected
+	device_id: Optional[Tuple[int, int, Optional[int]]] = None
+	# Most bytes a job does between checkpoints of its journal
+	checkpoint_size = 64 * 1024
+	# Set to stop the running operation at the next block boundary
+	cancel: Optional[Event] = None
+	_cache: Optional[SectorCache] = None
+	_view: Optional[CardView] = None
 
 	def __init__(self, linker: "BaseLinker"):
 		self.linker = linker
 
+	@property
+	def cache(self) -> SectorCache:
+		""" Last known contents of the card's sectors """
+		if self._cache is None:
+			self._cache = SectorCache.for_card(self)
+			self._cache.validate(self)
+		return self._cache
+
+	@property
+	def view(self) -> CardView:
+		""" Random-access file over the card which keeps recently read blocks """
+		if self._view is None:
+			self._view = CardView(self)
+		return self._view
+
+	def check_cancelled(self, journal: Optional[Journal] = None, stream: Optional[BinaryIO] = None):
+		"""
+		Raise OperationCancelled if cancel is set. Call it between blocks,
+		where no command is half sent, and drain any reads still in flight
+		when it raises. The journal, if any, is saved so the job can be resumed.
+		"""
+		if self.cancel is not None and self.cancel.is_set():
+			self.linker.flush()
+			if journal is not None:
+				journal.checkpoint(stream, force=True)
+			# Keep the sectors which were changed from being trusted later
+			if self._cache is not None:
+				self._cache.save()
+			raise OperationCancelled()
+
+	def forget_contents(self):
+		""" Drop what's known about the card's contents, in case it was swapped """
+		self._cache = None
+		self._view = None
+
 	# Top level methods
 	def blocks(self, start: int = 0, size: int = 0):
 		memory = self.memory
@@ -49,30 +100,228 @@ class BaseCard(BaseFlashable):
 		for addr in range(start, end, block_size):
 			yield addr, min(end - addr, block_size)
 
-	def flash(self, stream: BinaryIO, *, erase: bool = True):
-		""" Flash a ROM to the card """
+	def flash(self, stream: BinaryIO, *, erase: bool = True, differential: bool = False, verify: bool = False, resume: bool = False) -> Optional[Dict[int, int]]:
+		"""
+		Flash a ROM to the card. If verify is set, each block is read back
+		as it's written and the ones which still failed after retrying
+		are returned as {address: bad byte count}.
+		If resume is set, blocks an interrupted flash of the same ROM
+		finished are skipped.
+		"""
 		self.linker.reload_config()
+		fn = getattr(stream, "name", _("RAM"))
 
-		# Get file size
-		stream.seek(0, SEEK_END)
-		size = stream.tell()
-		if (size > self.memory):
-			raise DeviceError(_("exception.flash.too-large").format(size=natural_size(self.memory)))
-		stream.seek(0, SEEK_SET)
+		# Pipes can't say how much is coming, so it's checked as it's read
+		size = None
+		if stream.seekable():
+			size = stream.seek(0, SEEK_END)
+			if size > self.memory:
+				raise DeviceError(_("exception.flash.too-large").format(size=natural_size(self.memory)))
+			stream.seek(0, SEEK_SET)
 
-		# Chip erase or sector erase
-		if erase:
-			self.erase_data(0, size)
+		if differential:
+			return self.flash_differential(stream, size=size, erase=erase, verify=verify, fn=fn)
+
+		journal = Journal.for_job(self, "flash", size=size, erase=erase)
+		if resume and journal.resume():
+			log(_("log.journal.resume"), size=natural_size(len(journal.done) * self.block_size))
+
+		# Chip erase or sector erase, what's after the ROM doesn't matter
+		if erase and not journal.erased:
+			self.erase_data(0, size or self.memory, keep_outside=False)
+			journal.erased = True
+			journal.checkpoint(force=True)
 
 		prog = progress(
 			progress.config.get_message("flash"),
-			size,
+			size or self.memory,
 			card=self,
-			fn=getattr(stream, "name", _("RAM"))
+			fn=fn
 		)
 
-		# Programming
-		self.write_data(0, stream.read(size), prog=prog)
+		# Programming, a run of blocks at a time
+		errors = {} if verify else None
+		run_size = max(self.checkpoint_size // self.block_size, 1) * self.block_size
+		addr = 0
+		while addr < self.memory:
+			run = read_fully(stream, min(run_size, self.memory - addr))
+			if not run:
+				break
+
+			# Group the blocks which still need writing
+			todo = []
+			digests = {}
+			for (start, bsize), block in zip(self.blocks(addr, len(run)), chunked(self.block_size, run)):
+				digests[start] = SectorCache.hash(block)
+				if journal.is_done(start, digests[start]):
+					prog.add(bsize)
+				elif todo and sum(todo[-1]) == start:
+					todo[-1][1] += bsize
+				else:
+					todo.append([start, bsize])
+
+			for start, tsize in todo:
+				self.check_cancelled(journal)
+				data = run[start - addr:start - addr + tsize]
+				blocks = list(self.blocks(start, tsize))
+				if erase and any(bstart in journal.done for bstart, bsize in blocks):
+					# An interrupted flash wrote something else here
+					self.erase_data(start, tsize)
+				for bstart, bsize in blocks:
+					journal.begin(bstart)
+				journal.checkpoint(force=True)
+				if verify:
+					errors.update(self.write_verify_data(start, data, prog=prog))
+				else:
+					self.write_data(start, data, prog=prog)
+				for bstart, bsize in blocks:
+					journal.complete(bstart, digests[bstart])
+			journal.checkpoint()
+			addr += len(run)
+		else:
+			if stream.read(1):
+				raise DeviceError(_("exception.flash.too-large").format(size=natural_size(self.memory)))
+		journal.remove()
+		if not prog.is_complete():
+			# A pipe ended before the card's size, which was the estimate
+			prog.done()
+			prog.update(prog.current)
+
+		if verify:
+			self.report_verify(errors)
+		self.cache.save()
+		return errors
+
+	def _journal_runs(self, journal: Journal, addr: int, size: int) -> List[Tuple[int, int]]:
+		""" Group the blocks a job hasn't done yet into runs to checkpoint after """
+		runs = []
+		for start, bsize in self.blocks(addr, size):
+			if journal.is_done(start):
+				continue
+			if runs and sum(runs[-1]) == start and runs[-1][1] + bsize <= self.checkpoint_size:
+				runs[-1][1] += bsize
+			else:
+				runs.append([start, bsize])
+		return runs
+
+	def flash_differential(self, stream: BinaryIO, *, size: Optional[int] = None, erase: bool = True, verify: bool = False, fn: str = "") -> Optional[Dict[int, int]]:
+		"""
+		Only erase and program the sectors which differ from the stream,
+		comparing a run of sectors at a time as it's read
+		"""
+		cache = self.cache
+		prog = progress(
+			progress.config.get_message("flash"),
+			size or self.memory,
+			card=self,
+			fn=fn
+		)
+
+		errors = {} if verify else None
+		run_size = max(self.checkpoint_size // self.sector_size, 1) * self.sector_size
+		addr = 0
+		while addr < self.memory:
+			data = read_fully(stream, min(run_size, self.memory - addr))
+			if not data:
+				break
+
+			# Only read back sectors which aren't known to match already
+			unknown = []
+			for start, ssize in self.sectors(addr, len(data)):
+				if cache.matches(start, data[start - addr:start - addr + ssize]):
+					prog.add(ssize)
+				else:
+					unknown.append((start, ssize))
+
+			# Group neighboring sectors which need the same treatment
+			runs = []
+			for (start, ssize), current in zip(unknown, self.read_ranges(unknown)):
+				end = start + ssize
+				old = int.from_bytes(current, "big")
+				new = int.from_bytes(data[start - addr:end - addr], "big")
+				if old == new:
+					cache.record(start, current)
+					prog.add(ssize)
+					continue
+				# Programming can only clear bits
+				needs_erase = erase and old & new != new
+				if runs and runs[-1][1] == start and runs[-1][2] == needs_erase:
+					runs[-1][1] = end
+					runs[-1][3] += current
+				else:
+					runs.append([start, end, needs_erase, bytearray(current)])
+
+			run_errors = {} if verify else None
+			for start, end, needs_erase, current in runs:
+				self.check_cancelled()
+				new = data[start - addr:end - addr]
+				if needs_erase:
+					self.erase_data(start, end - start)
+					if verify:
+						run_errors.update(self.write_verify_data(start, new))
+					else:
+						self.write_data(start, new)
+				elif verify:
+					run_errors.update(self.write_verify_data(start, new))
+				else:
+					# Only program the bytes that changed
+					diff = (
+						int.from_bytes(current, "big")
+						^ int.from_bytes(new, "big")
+					).to_bytes(end - start, "big")
+					for m in re.finditer(rb"[^\x00]+", diff):
+						self.write_data(start + m.start(), new[m.start():m.end()])
+				prog.add(end - start)
+
+			if run_errors == {}:
+				cache.record(addr, data)
+			elif run_errors is None:
+				# Nothing programmed was read back, so it isn't known
+				for start, end, needs_erase, current in runs:
+					cache.invalidate(start, end - start)
+			else:
+				errors.update(run_errors)
+			addr += len(data)
+		else:
+			if stream.read(1):
+				# Keep the sectors which were changed from being trusted later
+				cache.save()
+				raise DeviceError(_("exception.flash.too-large").format(size=natural_size(self.memory)))
+		if not prog.is_complete():
+			# A pipe ended before the card's size, which was the estimate
+			prog.done()
+			prog.update(prog.current)
+
+		if verify:
+			self.report_verify(errors)
+		cache.save()
+		return errors
+
+	def read_ranges(self, ranges: Iterable[Tuple[int, int]], into: Optional[memoryview] = None) -> Iterator[Union[bytes, memoryview]]:
+		"""
+		Read each (addr, size) range, yielding them in order.
+		If into is given, the ranges are read into consecutive parts of it.
+		"""
+		pos = 0
+		for addr, size in ranges:
+			data = self.read_all_data(addr, size)
+			if into is None:
+				yield data
+			else:
+				into[pos:pos + size] = data
+				yield into[pos:pos + size]
+				pos += size
+
+	def sectors(self, start: int = 0, size: int = 0):
+		""" Like blocks, but in the smallest units which can be erased """
+		sector_size = self.sector_size
+		end = min(start + size if size else self.memory, self.memory)
+		for addr in range(start, end, sector_size):
+			yield addr, min(end - addr, sector_size)
+
+	@property
+	def sector_size(self) -> int:
+		return self.block_size
 
 	def verify(self, stream: BinaryIO) -> bool:
 		""" Verify the ROM on the card is correct """
@@ -87,54 +336,135 @@ class BaseCard(BaseFlashable):
 		)
 		stream.seek(0, SEEK_SET)
 
-		block_size = self.block_size
-		read = block_size
-		bads = []
-		for dump in self.read_data(0, size):
-			dumped = len(dump)
-			orig = stream.read(read)
-			read = len(orig)
-			if orig != (dump if dumped == read else dump[:read]):
-				count = len([i for i, (o, d) in enumerate(zip(orig, dump)) if o != d])
-				bads.append(count)
-			prog.add(read)
-			if read < dumped:
-				# I don't think this should happen tho
-				break 
+		# Blocks known to match don't need to be read back
+		cache = self.cache
+		blocks = list(self.blocks(0, size))
+		if isinstance(stream, MappedImage):
+			# Compare against the mapping rather than copies of it
+			buffer = stream.getbuffer()
+			origs = [buffer[start:start + bsize] for start, bsize in blocks]
+		else:
+			origs = [stream.read(bsize) for start, bsize in blocks]
+		unknown = [
+			(start, bsize)
+			for (start, bsize), orig in zip(blocks, origs)
+			if not cache.matches(start, orig)
+		]
+		dumps = self.read_ranges(unknown)
+		to_check = {start for start, bsize in unknown}
+
+		bads = {}
+		try:
+			for (start, bsize), orig in zip(blocks, origs):
+				if start in to_check:
+					dump = next(dumps)
+					if orig != dump:
+						bads[start] = count_differences(orig, dump)
+					else:
+						cache.record(start, dump)
+				prog.add(bsize)
+				self.check_cancelled()
+		finally:
+			# Reads still in flight are drained
+			dumps.close()
+		cache.save()
 		prog.done()
+		return self.report_verify(bads)
 
-		if any(bads):
+	def report_verify(self, errors: Dict[int, int]) -> bool:
+		""" Log the result of verifying, errors is {address: bad byte count} """
+		if errors:
 			error(_("log.verify.failed"))
 			verbose(_("log.verify-failed.report.title"))
-			for i, c in enumerate(bads):
-				verbose(_("log.verify-failed.report.entry"), block=i, count=c)
+			for start, count in sorted(errors.items()):
+				verbose(_("log.verify-failed.report.entry"), block=start // self.block_size, count=count)
 			return False
 		else:
 			log(_("log.verify.success"))
 		return True
 
-	def dump(self, stream: BinaryIO, *, offset: int = 0, size: int = 0):
-		""" Dump a ROM from the card """
+	def dump(self, stream: BinaryIO, *, offset: int = 0, size: int = 0, resume: bool = False):
+		"""
+		Dump a ROM from the card. If resume is set, blocks an interrupted
+		dump to the stream finished are kept rather than reread. Only
+		streams which can be read back from can be resumed.
+		"""
+		direct = isinstance(stream, MappedImage)
+		resumable = direct or (stream.seekable() and stream.readable())
+		if resume and not resumable:
+			raise DeviceError(_("exception.dump.resume.unsupported"))
+
 		self.linker.reload_config()
 
+		fn = getattr(stream, "name", _("RAM"))
 		prog = progress(
 			progress.config.get_message("dump"),
 			size or self.memory,
 			card=self,
-			fn=getattr(stream, "name", _("RAM"))
+			fn=fn
 		)
-		for data in self.read_data(offset, size, prog=prog):
-			stream.write(data)
+		if resumable:
+			journal = Journal.for_job(self, "dump", file=str(fn), offset=offset, size=size)
+		else:
+			# Nothing could be picked up from it, so don't keep a journal
+			journal = Journal(None, {})
+		resumed = resume and journal.resume()
+
+		# Read everything into one buffer rather than a bytes per block,
+		# or decode straight into a mapped image
+		total = min(size or self.memory, self.memory - offset)
+		if direct:
+			existing = len(stream) - stream.tell()
+			image = stream.reserve(total)
+		else:
+			image = memoryview(bytearray(total))
+		runs = [[offset, total]]
+		if resumed:
+			# Take what was already dumped from the stream
+			for start, bsize in self.blocks(offset, size):
+				if direct:
+					present = start - offset + bsize <= existing
+				else:
+					stream.seek(start - offset)
+					present = stream.readinto(image[start - offset:start - offset + bsize]) == bsize
+				if not (journal.is_done(start) and present):
+					journal.done.pop(start, None)
+			runs = self._journal_runs(journal, offset, size)
+			log(_("log.journal.resume"), size=natural_size(len(image) - sum(rsize for start, rsize in runs)))
+			prog.add(len(image) - sum(rsize for start, rsize in runs))
+
+		for start, rsize in runs:
+			if resumed and not direct:
+				stream.seek(start - offset)
+			reads = self.read_data(start, rsize, prog=prog, into=image[start - offset:start - offset + rsize])
+			try:
+				for (bstart, bsize), data in zip(self.blocks(start, rsize), reads):
+					if not direct:
+						stream.write(data)
+					journal.complete(bstart)
+					journal.checkpoint(stream)
+					self.check_cancelled(journal, stream)
+			finally:
+				# Reads still in flight are drained
+				reads.close()
+		if resumed and not direct:
+			stream.seek(total)
+		journal.remove()
+
+		self.cache.record(offset, image)
+		self.cache.save()
 
 	def erase(self, *, offset: int = 0, size: int = 0):
 		self.linker.reload_config()
 
 		prog = progress(
 			progress.config.get_message("erase"),
-			size,
-			card=self
+			size or self.memory,
+			card=self,
+			eta=self.erase_time(offset, size or self.memory),
 		)
 		self.erase_data(offset, size or self.memory, prog=prog)
+		self.cache.save()
 
 	def test(self):
 		""" Run some tests on the card """
@@ -146,8 +476,8 @@ class BaseCard(BaseFlashable):
 		self.erase()
 
 		# Read in twice
-		buff1 = BytesIO()
-		buff2 = BytesIO()
+		buff1 = MappedImage.temporary()
+		buff2 = MappedImage.temporary()
 		self.dump(buff1)
 		self.dump(buff2)
 
@@ -179,10 +509,11 @@ class BaseCard(BaseFlashable):
 
 		## Write test
 		log(_("log.test.write.start"))
-		buff1 = BytesIO(random.randbytes(self.memory))
+		buff1 = MappedImage.temporary()
+		buff1.write(random.randbytes(self.memory))
 		self.flash(buff1)
 
-		buff2 = BytesIO()
+		buff2 = MappedImage.temporary()
 		self.dump(buff2)
 
 		# Verify
@@ -210,44 +541,71 @@ class BaseCard(BaseFlashable):
 		""" Return the addr, data from a raw packet """
 		raise NotImplementedError
 
+	def decode_packets(self, raw: bytes) -> bytes:
+		""" Return the data from a buffer of raw packets """
+		packet_size = self.packet_size
+		return bytes(
+			self.deconstruct_packet(raw[i:i + packet_size])[1]
+			for i in range(0, len(raw), packet_size)
+		)
+
+	def decode_packets_into(self, raw: bytes, view: memoryview) -> int:
+		""" Decode the data from a buffer of raw packets into view, return its size """
+		data = self.decode_packets(raw)
+		size = len(data)
+		view[:size] = data
+		return size
+
 	def write_data(self, addr: int, data: bytes, *, prog: progress = dummy_progress):
 		""" Prepare the write command(s) for some data """
 		raise NotImplementedError
 
-	def read_data(self, addr: int, size: int, *, prog: progress = dummy_progress) -> Iterator[bytes]:
-		""" Prepare the read command(s) for some data """
+	def write_verify_data(self, addr: int, data: bytes, *, prog: progress = dummy_progress, retries: int = 2) -> Dict[int, int]:
+		"""
+		Write some data and read it back, rewriting blocks which don't match.
+		Return the blocks which still don't as {address: bad byte count}.
+		"""
+		errors = {}
+		for (start, bsize), block in zip(self.blocks(addr, len(data)), chunked(self.block_size, data)):
+			for attempt in range(retries + 1):
+				self.write_data(start, block)
+				dump = self.read_all_data(start, bsize)
+				if dump == block:
+					self.cache.record(start, block)
+					errors.pop(start, None)
+					break
+				errors[start] = count_differences(block, dump)
+				if attempt < retries:
+					self.erase_data(start, bsize)
+			prog.add(bsize)
+		return errors
+
+	def read_data(self, addr: int, size: int, *, prog: progress = dummy_progress, into: Optional[memoryview] = None) -> Iterator[Union[bytes, memoryview]]:
+		"""
+		Prepare the read command(s) for some data, yielding it block by block.
+		If into is given, the data is read into it and slices of it are yielded.
+		"""
 		raise NotImplementedError
 
 	def read_all_data(self, addr: int, size: int) -> bytes:
 		return b"".join(self.read_data(addr, size))
 
-	def erase_data(self, addr: int, size: int, *, prog: progress = dummy_progress):
-		""" Prepare erase command(s) for some section """
+	def erase_data(self, addr: int, size: int, *, prog: progress = dummy_progress, keep_outside: bool = True):
+		"""
+		Prepare erase command(s) for some section. If keep_outside is set,
+		data around the section which shares its sectors is preserved.
+		"""
 		raise NotImplementedError
 
-	def read(self, size: int):
-		addr = self._cursor
-		data = self.read_all_data(addr, size)
-		self._cursor += len(data)
-		return data
+	def erase_time(self, addr: int, size: int) -> float:
+		""" Projected seconds to erase some section """
+		return 0.0
+
+	def read(self, size: int = -1):
+		return self.view.read(size)
 
 	def write(self, data: bytes):
-		addr = self._cursor
-		self.write_data(addr, data)
-		size = len(data)
-		self._cursor += size
-		return size
+		return self.view.write(data)
 
 	def seek(self, offset: int, whence: int = SEEK_SET):
-		if whence == SEEK_SET:
-			self._cursor = offset
-		elif whence == SEEK_CUR:
-			self._cursor += offset
-		elif whence == SEEK_END:
-			self._cursor = self.memory + offset
-		else:
-			raise ValueError("whence must be one of: SEEK_SET, SEEK_CUR, or SEEK_END")
-		if self._cursor < 0:
-			self._cursor = 0
-		elif self._cursor > self.memory:
-			self._cursor = self.memory
+		return self.view.seek(offset, whence)
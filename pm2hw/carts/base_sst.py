@@ -4,13 +4,16 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
-from time import sleep, time
-from typing import Callable, ClassVar, Sequence, Tuple
+import re
+from collections import deque
+from typing import Callable, ClassVar, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
 
-from pm2hw.base import chunked
-from pm2hw.carts.base import dummy_progress, BaseCard
-from pm2hw.logger import progress
-from pm2hw.locales import delayed_gettext as _
+from pm2hw.base import chunked, Transform, BaseReader
+from pm2hw.carts.base import count_differences, dummy_progress, BaseCard
+from pm2hw.config import config, save as save_config
+from pm2hw.logger import log, progress, verbose, warn
+from pm2hw.locales import delayed_gettext as _, natural_size
+from pm2hw.exceptions import DeviceError
 
 class BaseSstCard(BaseCard):
 	packet_size = 4
@@ -24,66 +27,455 @@ class BaseSstCard(BaseCard):
 	# Software Data Protection
 	buffer_sdp: bytes = b""
 
-	def erase_data(self, addr: int = 0, size: int = 0, *, prog: progress = dummy_progress):
+	# Whether the chip toggles DQ6 while erasing, set per chip
+	status_polling = False
+	# Longest an erase may take before giving up, as a multiple of its
+	# time in erase_modes
+	erase_timeout_scale = 20
+
+	# Most bytes to read per request, 0 for whole blocks
+	read_chunk_size = 0
+	# Most bytes to program per USB write, 0 for whole blocks
+	write_chunk_size = 0
+	read_transform: Optional[Transform] = None
+
+	@property
+	def sector_size(self) -> int:
+		return self.erase_modes[0][1]
+
+	def forget_contents(self):
+		super().forget_contents()
+		self.erased = (0, 0)
+
+	def erase_data(self, addr: int = 0, size: int = 0, *, prog: progress = dummy_progress, keep_outside: bool = True):
 		if not size:
 			size = self.memory
+		size = min(size, self.memory - addr)
+		if size <= 0:
+			# It starts past the end of the card
+			return
+		end = addr + size
+
+		plan = self.plan_erase(addr, size, spare=not keep_outside)
+		lo = plan[0][1]
+		hi = plan[-1][1] + plan[-1][2]
+
+		# Sectors can only be erased whole, so save what's around the range
+		keep_onset = keep_coda = b""
+		if keep_outside:
+			if lo < addr:
+				keep_onset = self.read_all_data(lo, addr - lo)
+			if end < hi:
+				keep_coda = self.read_all_data(end, hi - end)
+
+		# Nothing will be read back, so what's there isn't known
+		self.cache.invalidate(lo, hi - lo)
+		self.view.invalidate(lo, hi - lo)
+
+		for method, a, esize, secs in plan:
+			# What's around the range has to be restored once it starts
+			if not (keep_onset or keep_coda):
+				self.check_cancelled()
+			if esize == self.memory:
+				method()
+			else:
+				method(a)
+			self._wait_for_erased(a, secs * self.erase_timeout_scale)
+			prog.update(min(max(a + esize - addr, 0), size))
+		self.erased = (lo, hi)
+
+		if keep_onset:
+			self.write_data(lo, keep_onset)
+		if keep_coda:
+			self.write_data(end, keep_coda)
+		if keep_outside:
+			self.erased = (addr, end)
+
+	def plan_erase(self, addr: int, size: int, *, spare: bool = False) -> List[Tuple[Callable, int, int, float]]:
+		"""
+		Find the quickest sequence of erase commands covering the range,
+		as (method, addr, size, secs). It's widened to whole sectors, or
+		past the end of the range if spare says nothing there matters.
+		"""
+		unit = self.erase_modes[0][1]
+		size = min(size, self.memory - addr)
+		lo = addr - addr % unit
+		hi = -(-(addr + size) // unit) * unit
+		count = (hi - lo) // unit
+		limit = self.memory if spare else hi
+
+		# Quickest time to erase from each sector to the end and how
+		best = [0.0] * (count + 1)
+		choice = [None] * count
+		for i in range(count - 1, -1, -1):
+			a = lo + i * unit
+			best[i] = float("inf")
+			for mode in self.erase_modes:
+				method, esize, secs = mode
+				if a % esize == 0 and a + esize <= limit:
+					t = secs + best[min(i + esize // unit, count)]
+					if t < best[i]:
+						best[i] = t
+						choice[i] = mode
+
+		plan = []
+		i = 0
+		while i < count:
+			method, esize, secs = choice[i]
+			plan.append((method, lo + i * unit, esize, secs))
+			i += esize // unit
+		return plan
+
+	def erase_time(self, addr: int, size: int) -> float:
+		return sum(step[3] for step in self.plan_erase(addr, size or self.memory))
 
-		if addr == 0 and size == self.memory:
-			# Do a full chip erase.
-			self.sst_chip_erase()
-			self._wait_for_erased(0, 20)
-			prog.update(size)
-		elif addr % 0x04000 == 0 and size % 0x04000 == 0:
-			# Sector erase
-			for a in range(addr, addr + size, 0x04000):
-				prog.update(a - addr)
-				self.sst_sector_erase(a)
-				self._wait_for_erased(a, 5)
-			prog.update(a - addr)
+	def use_status_polling(self) -> bool:
+		return self.status_polling and self.linker.status_polling
+
+	def erase_wait(self, secs: float) -> float:
+		""" How long to wait after an erase command before checking on it """
+		return 0 if self.use_status_polling() else secs
+
+	def _wait_for_erased(self, addr: int, secs: float):
+		if self.use_status_polling():
+			ready = self._wait_for_ready(addr, secs)
 		else:
-			# Overwrite memory manually
-			# onset .. sectors .. coda
-			shortest = self.erase_modes[0][1]
-			onset = addr % shortest
-			if onset:
-				onset = shortest - onset
-			coda = (addr + size) % shortest
-
-			# Erase parts which are valid sectors
-			sectors_start = addr + onset
-			sectors_end = addr + size - coda
-			for a in range(sectors_start, sectors_end, 0x04000):
-				prog.update(a - addr - onset)
-				self.sst_sector_erase(a)
-				self._wait_for_erased(a, 5)
-			prog.update(a - addr - onset)
-
-			# Overwrite onset and coda (the bookends)
-			self.write_data(addr, b"\xff" * onset)
-			prog.add(onset)
-			self.write_data(sectors_end, b"\xff" * coda)
-			prog.add(coda)
-		self.erased = (addr, addr + size)
-
-	def _wait_for_erased(self, addr: int, secs: int):
-		start = time()
-		while self.read_all_data(addr, 1)[0] != 0xff and time() - start < 5:
-			sleep(0.050)
+			clock = self.linker.clock
+			start = clock.time()
+			ready = self.read_all_data(addr, 1)[0] == 0xff
+			while not ready and clock.time() - start < secs:
+				self.linker.sleep(0.050)
+				ready = self.read_all_data(addr, 1)[0] == 0xff
+		if not ready:
+			raise DeviceError(_("exception.erase.timeout").format(addr=addr))
+
+	def _wait_for_ready(self, addr: int, secs: float) -> bool:
+		""" Poll the toggle bit until the chip finishes its current operation """
+		# DQ6 toggles on every read while busy, so it's done when two reads
+		# match. This doesn't depend on how the data lines are wired.
+		clock = self.linker.clock
+		packets = self.prepare_read_packet(addr) * 2
+		start = clock.time()
+		while clock.time() - start < secs:
+			first, second = self.linker.read_data(packets, 2).read()
+			if first == second:
+				return True
+		return False
+
+	def read_data(self, addr: int, size: int, *, prog: progress = dummy_progress, into: Optional[memoryview] = None):
+		blocks = list(self.blocks(addr, size))
+		ranges = self.read_ranges(blocks, into)
+		try:
+			for (start, bsize), ret in zip(blocks, ranges):
+				prog.add(bsize)
+				yield ret
+		finally:
+			ranges.close()
+
+	def read_ranges(self, ranges: Iterable[Tuple[int, int]], into: Optional[memoryview] = None) -> Iterator[Union[bytes, memoryview]]:
+		"""
+		Read each (addr, size) range, yielding them in order, as one pipeline.
+		If into is given, the ranges are read into consecutive parts of it.
+		"""
+		ranges = list(ranges)
+		parts = []
+		for addr, size in ranges:
+			step = self.read_step(size) or 1
+			parts.append([
+				(a, min(step, addr + size - a))
+				for a in range(addr, addr + size, step)
+			])
+
+		transform = self.read_transform
+		responses = self.linker.read_pipelined(
+			(
+				(self.prepare_read_packets(a, s), s, transform)
+				for chunks in parts
+				for a, s in chunks
+			),
+			into,
+		)
+		pos = 0
+		try:
+			for (addr, size), chunks in zip(ranges, parts):
+				data = [next(responses) for chunk in chunks]
+				if into is None:
+					yield b"".join(data)
+				else:
+					yield into[pos:pos + size]
+					pos += size
+		finally:
+			# Drains the responses still in flight if the caller stopped early
+			responses.close()
 
 	def write_data(self, addr: int, data: bytes, *, prog: progress = dummy_progress):
+		self.cache.invalidate(addr, len(data))
+		self.view.invalidate(addr, len(data))
 		for (start, bsize), block in zip(
 			self.blocks(addr, len(data)),
 			chunked(self.block_size, data)
 		):
-			self.linker.start_buffering()
-			for a, d in zip(range(start, start + bsize), block):
-				self.sst_byte_program(a, d)
-			self.linker.end_buffering()
+			self._program_block(start, block)
 			prog.add(bsize)
 
+	def write_verify_data(self, addr: int, data: bytes, *, prog: progress = dummy_progress, retries: int = 2) -> Dict[int, int]:
+		self.cache.invalidate(addr, len(data))
+		self.view.invalidate(addr, len(data))
+		todo = deque(
+			(start, block, 0)
+			for (start, bsize), block in zip(
+				self.blocks(addr, len(data)),
+				chunked(self.block_size, data)
+			)
+		)
+		errors = {}
+
+		def check(start: int, block: bytes, attempt: int, dump: bytes) -> bool:
+			if dump == block:
+				self.cache.record(start, block)
+				prog.add(len(block))
+				return True
+			if attempt < retries:
+				# Bits which should be 1 were cleared, only an erase can fix that
+				if not self._can_program(dump, block):
+					self.erase_data(start, len(block))
+				todo.appendleft((start, block, attempt + 1))
+			else:
+				errors[start] = count_differences(block, dump)
+				prog.add(len(block))
+			return False
+
+		# Read back each block while the next one is being programmed
+		checking = None
+		while todo or checking:
+			if self.cancel is not None and self.cancel.is_set():
+				# Don't leave the block being checked in the queue
+				if checking:
+					for reader in checking[3]:
+						reader.clear()
+				self.check_cancelled()
+			current = None
+			if todo:
+				start, block, attempt = todo.popleft()
+				self._program_block(start, block)
+				current = (start, block, attempt, self._request_block(start, len(block)))
+				self.linker.flush()
+
+			if checking:
+				start, block, attempt, readers = checking
+				dump = b"".join(r.read() for r in readers)
+				if not (dump == block or current is None):
+					# Finish reading the next block before fixing this one
+					c_start, c_block, c_attempt, c_readers = current
+					c_dump = b"".join(r.read() for r in c_readers)
+					check(start, block, attempt, dump)
+					check(c_start, c_block, c_attempt, c_dump)
+					current = None
+				else:
+					check(start, block, attempt, dump)
+			checking = current
+		return errors
+
+	@staticmethod
+	def _can_program(current: bytes, data: bytes) -> bool:
+		""" Whether programming can turn current into data, since it only clears bits """
+		new = int.from_bytes(data, "big")
+		return int.from_bytes(current, "big") & new == new
+
+	def read_step(self, size: int) -> int:
+		""" Bytes to read per request, as calibrated for the linker if it has been """
+		return self.linker.read_chunk_size or self.read_chunk_size or size
+
+	def write_step(self, size: int) -> int:
+		""" Bytes to program per USB write, as calibrated for the linker if it has been """
+		return self.linker.write_chunk_size or self.write_chunk_size or size
+
+	def _program_block(self, addr: int, data: bytes):
+		# Each byte waits T_BP rather than polling, since a poll costs a USB
+		# round trip while a program takes microseconds
+		per_byte = len(self.prepare_sdp_prefixed(0xa0)) + self.packet_size
+		packets = b"".join(
+			self.prepare_program_packets(a, d)
+			for a, d in self._runs_to_program(addr, data)
+		)
+		self.linker.start_buffering()
+		for group in chunked(per_byte * self.write_step(len(data) or 1), packets):
+			self.linker.send(chunked(per_byte, group), wait=self.T_BP)
+			self.linker.flush()
+		self.linker.end_buffering()
+
+	def _request_block(self, addr: int, size: int) -> List[BaseReader]:
+		""" Queue reads for a block without waiting for the response """
+		step = self.read_step(size)
+		return [
+			self.linker.read_data(
+				self.prepare_read_packets(a, min(step, addr + size - a)),
+				min(step, addr + size - a),
+				transform=self.read_transform,
+			)
+			for a in range(addr, addr + size, step)
+		]
+
+	def calibrate(self, *, size: int = 64 * 1024) -> Tuple[int, int, int]:
+		"""
+		Time reading and programming with each clock divisor and chunk size
+		the linker allows, and save the fastest settings which read and
+		program correctly for this linker. One sector is programmed with a
+		test pattern and restored afterwards. Return the clock divisor and
+		the read and write chunk sizes.
+		"""
+		linker = self.linker
+		clock = linker.clock
+		size = min(size, self.memory)
+		sector = min(self.sector_size, size)
+		# Test programming in the last sector read
+		test_addr = (size - sector) // sector * sector
+
+		# One 0x35 command clocks at most 65536 bytes, and a response
+		# shouldn't outgrow the USB transfer or what's kept in flight
+		most = min(
+			0x10000,
+			linker.transfer_size,
+			getattr(linker, "read_ahead", 0x10000)
+		) // self.packet_size
+		read_sizes = [c for c in (128, 256, 512, 1024, 2048, 4096, 8192, 16384) if c <= min(most, size)]
+		write_sizes = [c for c in (16, 64, 256, 1024, 4096) if c < sector] + [sector]
+		pattern = (bytes(range(256)) * -(-sector // 256))[:sector]
+		slowest = max(linker.clock_divisors)
+		# Chunk sizes the card uses when not calibrated
+		default_read = self.read_chunk_size or max(read_sizes)
+		default_write = self.write_chunk_size or sector
+
+		def timed(fn: Callable[[], bytes]) -> Tuple[float, bytes]:
+			start = clock.perf_counter()
+			data = fn()
+			return clock.perf_counter() - start, data
+
+		def read_all() -> bytes:
+			return b"".join(self.read_ranges([(0, size)]))
+
+		def program() -> bytes:
+			self.write_data(test_addr, pattern)
+			# Wait for it to finish
+			return b"".join(self.read_ranges([(test_addr, 1)]))
+
+		def fastest(timings: List[Tuple[float, int]], default: int) -> Tuple[float, int]:
+			# Timings often tie, so keep the default then the larger chunk
+			return min(timings, key=lambda t: (t[0], t[1] != default, -t[1]))
+
+		def restore(data: bytes):
+			linker.set_clock_divisor(slowest)
+			linker.write_chunk_size = 0
+			self.erase_data(test_addr, sector, keep_outside=False)
+			self.write_data(test_addr, data)
+
+		reference = None
+		programmed = False
+		# divisor: (seconds per byte, read chunk size, write chunk size)
+		results: Dict[int, Tuple[float, int, int]] = {}
+		try:
+			# Take the slowest clock's reading as the reference
+			for divisor in sorted(linker.clock_divisors, reverse=True):
+				linker.set_clock_divisor(divisor)
+				reads = []
+				for chunk in read_sizes:
+					linker.read_chunk_size = chunk
+					secs, data = timed(read_all)
+					if reference is None:
+						reference = data
+					elif data != reference:
+						break
+					verbose(_("log.calibrate.read"), divisor=divisor, chunk=chunk, rate=natural_size(int(size / secs)))
+					reads.append((secs, chunk))
+				else:
+					# Only program at clocks which read back correctly
+					writes = []
+					for chunk in write_sizes:
+						programmed = True
+						self.erase_data(test_addr, sector, keep_outside=False)
+						linker.set_clock_divisor(divisor)
+						linker.write_chunk_size = chunk
+						secs = timed(program)[0]
+						if self.read_all_data(test_addr, sector) != pattern:
+							break
+						verbose(_("log.calibrate.write"), divisor=divisor, chunk=chunk, rate=natural_size(int(sector / secs)))
+						writes.append((secs, chunk))
+					restore(reference[test_addr:test_addr + sector])
+					programmed = False
+					if writes:
+						read_secs, read_chunk = fastest(reads, default_read)
+						write_secs, write_chunk = fastest(writes, default_write)
+						results[divisor] = (read_secs / size + write_secs / sector, read_chunk, write_chunk)
+						continue
+				warn(_("log.calibrate.unreliable"), divisor=divisor)
+		except BaseException:
+			if programmed:
+				restore(reference[test_addr:test_addr + sector])
+			raise
+
+		if not results:
+			linker.reload_config()
+			linker.set_clock_divisor(linker.clock_divisor)
+			raise DeviceError(_("exception.calibrate.failed"))
+
+		divisor = min(results, key=lambda d: results[d][0])
+		secs, read_chunk, write_chunk = results[divisor]
+		section = linker.tuning_section
+		if not config.has_section(section):
+			config.add_section(section)
+		config.set(section, "clock-divisor", str(divisor))
+		config.set(section, "read-chunk-size", str(read_chunk))
+		config.set(section, "write-chunk-size", str(write_chunk))
+		save_config()
+
+		linker.reload_config()
+		linker.set_clock_divisor(linker.clock_divisor)
+		log(_("log.calibrate.done"), divisor=divisor, read=read_chunk, write=write_chunk)
+		return divisor, read_chunk, write_chunk
+
+	def _runs_to_program(self, addr: int, data: bytes) -> Iterator[Tuple[int, bytes]]:
+		""" Split data into runs which need programming, skipping 0xff in erased areas """
+		end = addr + len(data)
+		lo = min(max(self.erased[0], addr), end)
+		hi = min(max(self.erased[1], lo), end)
+		if addr < lo:
+			yield addr, data[:lo - addr]
+		for m in re.finditer(rb"[^\xff]+", data[lo - addr:hi - addr]):
+			yield lo + m.start(), m.group()
+		if hi < end:
+			yield hi, data[hi - addr:]
+
 	def prepare_sdp_prefixed(self, data: int, addr: int):
 		return self.buffer_sdp + self.prepare_write_packet(addr, data)
 
+	def prepare_read_packets(self, addr: int, size: int) -> bytes:
+		""" Read packets for every address in the range """
+		return b"".join(
+			self.prepare_read_packet(a)
+			for a in range(addr, addr + size)
+		)
+
+	def prepare_write_packets(self, addr: int, data: bytes) -> bytes:
+		""" Write packets for each byte of data, starting at addr """
+		return b"".join(
+			self.prepare_write_packet(a, d)
+			for a, d in zip(range(addr, addr + len(data)), data)
+		)
+
+	def prepare_program_packets(self, addr: int, data: bytes) -> bytes:
+		""" Byte-Program command packets for each byte of data, starting at addr """
+		prefix = self.prepare_sdp_prefixed(0xa0)
+		writes = self.prepare_write_packets(addr, data)
+		packet_size = self.packet_size
+		prefix_size = len(prefix)
+		stride = prefix_size + packet_size
+		ret = bytearray(stride * len(data))
+		for i, b in enumerate(prefix):
+			ret[i::stride] = bytes([b]) * len(data)
+		for i in range(packet_size):
+			ret[prefix_size + i::stride] = writes[i::packet_size]
+		return bytes(ret)
+
 	@staticmethod
 	def prepare_write_packet(addr: int, data: int):
 		raise NotImplementedError
@@ -113,7 +505,7 @@ class BaseSstCard(BaseCard):
 		self.linker.send(
 			self.prepare_sdp_prefixed(0x80)
 			+ self.prepare_sdp_prefixed(0x10),
-			wait=self.T_SCE
+			wait=self.erase_wait(self.T_SCE)
 		)
 
 	def sst_software_id_entry(self):
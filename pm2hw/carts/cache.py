@@ -0,0 +1,137 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import json
+import hashlib
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from pm2hw.config import config, config_dir
+from pm2hw.logger import debug
+
+if TYPE_CHECKING:
+	from pm2hw.carts.base import BaseCard
+
+cache_dir = config_dir / "cache"
+
+def card_key(card: "BaseCard") -> Optional[str]:
+	""" Name which tells a card apart from others, as well as it can be """
+	if card.device_id is None:
+		return None
+
+	serial = card.linker.serial
+	if isinstance(serial, bytes):
+		serial = serial.decode(errors="replace")
+	ids = "".join(f"{x:02x}" for x in card.device_id if x is not None)
+	return f"{serial}-{ids}"
+
+class SectorCache:
+	"""
+	Last known hash of each sector of a card, kept between runs so
+	unchanged sectors don't need to be read back over USB.
+
+	Cards can't be told apart beyond their chip IDs, so the first few
+	bytes of each sector are kept too, and checked against the card
+	before the cache is trusted.
+	"""
+	sample_size = 8
+
+	def __init__(self, path: Optional[os.PathLike], sector_size: int):
+		self.path = path
+		self.sector_size = sector_size
+		# sector index: (hash, sample)
+		self.sectors: Dict[int, Tuple[str, bytes]] = {}
+		self.dirty = False
+
+		if path is not None:
+			try:
+				with open(path, "rt", encoding="UTF-8") as f:
+					raw = json.load(f)
+				if raw.get("sector-size") == sector_size:
+					self.sectors = {
+						int(i): (h, bytes.fromhex(s))
+						for i, (h, s) in raw["sectors"].items()
+					}
+			except (OSError, ValueError, KeyError, TypeError):
+				pass
+
+	@classmethod
+	def for_card(cls, card: "BaseCard") -> "SectorCache":
+		enabled = config.getboolean("general", "sector-cache", fallback=True)
+		key = card_key(card)
+		if not enabled or key is None:
+			return cls(None, card.sector_size)
+		return cls(cache_dir / f"{key}.json", card.sector_size)
+
+	@staticmethod
+	def hash(data: bytes) -> str:
+		return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+	def get(self, index: int) -> Optional[str]:
+		entry = self.sectors.get(index)
+		return entry[0] if entry else None
+
+	def matches(self, addr: int, data: bytes) -> bool:
+		""" Whether the card is known to hold data at addr, which must be whole sectors """
+		sector_size = self.sector_size
+		for start in range(0, len(data), sector_size):
+			chunk = data[start:start + sector_size]
+			if len(chunk) < sector_size or self.get((addr + start) // sector_size) != self.hash(chunk):
+				return False
+		return True
+
+	def record(self, addr: int, data: bytes):
+		""" Remember the card holds data at addr, forgetting partially covered sectors """
+		sector_size = self.sector_size
+		end = addr + len(data)
+		onset = -addr % sector_size
+		if onset:
+			self.invalidate(addr, onset)
+		for start in range(addr + onset, end, sector_size):
+			if end - start < sector_size:
+				self.invalidate(start, end - start)
+				break
+			chunk = bytes(data[start - addr:start - addr + sector_size])
+			self.sectors[start // sector_size] = (self.hash(chunk), chunk[:self.sample_size])
+		self.dirty = True
+
+	def invalidate(self, addr: int = 0, size: int = 0):
+		""" Forget sectors touched by an operation, or everything """
+		if not size:
+			self.sectors.clear()
+		else:
+			sector_size = self.sector_size
+			for i in range(addr // sector_size, -(-(addr + size) // sector_size)):
+				self.sectors.pop(i, None)
+		self.dirty = True
+
+	def samples(self) -> List[Tuple[int, bytes]]:
+		sector_size = self.sector_size
+		return [(i * sector_size, s) for i, (h, s) in sorted(self.sectors.items())]
+
+	def validate(self, card: "BaseCard"):
+		""" Drop everything if the card doesn't look like it did when cached """
+		samples = self.samples()
+		ranges = [(addr, len(sample)) for addr, sample in samples]
+		for (addr, sample), data in zip(samples, card.read_ranges(ranges)):
+			if data != sample:
+				debug("Sector cache doesn't match the card, discarding it")
+				self.invalidate()
+				return
+
+	def save(self):
+		if self.path is None or not self.dirty:
+			return
+		os.makedirs(cache_dir, exist_ok=True)
+		with open(self.path, "wt", encoding="UTF-8") as f:
+			json.dump({
+				"sector-size": self.sector_size,
+				"sectors": {
+					i: [h, s.hex()]
+					for i, (h, s) in self.sectors.items()
+				},
+			}, f)
+		self.dirty = False
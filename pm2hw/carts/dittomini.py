@@ -12,9 +12,8 @@ import struct
 from typing import TYPE_CHECKING, NamedTuple
 
 from pm2hw.base import BaseReader
-from pm2hw.carts.base import dummy_progress
 from pm2hw.carts.base_sst import BaseSstCard
-from pm2hw.logger import debug, progress, verbose
+from pm2hw.logger import debug, verbose
 from pm2hw.locales import natural_size
 from pm2hw.exceptions import DeviceNotSupportedError
 
@@ -70,9 +69,11 @@ class CFIQueryStruct(NamedTuple):
 # There is no Rev 1 or 2, though
 class DittoMiniRev3(BaseSstCard):
 	name = "DITTO mini"
+	read_chunk_size = 512
 
 	def __init__(self, linker: "BaseLinker"):
 		super().__init__(linker)
+		self.read_transform = linker.lsb_first
 		self.buffer_sdp = (
 			self.prepare_write_packet(0xAAA, 0xaa)
 			+ self.prepare_write_packet(0x555, 0x55)
@@ -90,7 +91,7 @@ class DittoMiniRev3(BaseSstCard):
 		dev_info = test
 		test = self.read_info(0, 4)
 		while test == dev_info:
-			time.sleep(0.001)
+			self.linker.sleep(0.001)
 			self.sst_exit()
 			test = self.read_info(0, 4)
 		debug(f"Reading software ID took {time.perf_counter() - start:.3f}s")
@@ -99,17 +100,24 @@ class DittoMiniRev3(BaseSstCard):
 			# http://ww1.microchip.com/downloads/en/devicedoc/25040a.pdf
 			# TODO: does devcex indicate SST39VF1681 vs SST39VF1682?
 			self.chip = "SST39VF1681"
+			self.status_polling = True
 			# wait time for byte_program: <=10 μs
 			self.read_cfi_query_struct()
 
+			# The block regions are the sector and block erase sizes,
+			# a chip with only one erases both the same
+			sizes = sorted(r.get_size() for r in self.block_regions)
+			sector = sizes[0]
+			block = sizes[1] if len(sizes) > 1 else sector
 			self.erase_modes = (
-				(self.sst_sector_erase, 4 * 1024, self.T_ERASE),
-				(self.sst_block_erase, 64 * 1024, self.T_ERASE),
-				(self.sst_chip_erase, self.memory, 0.050)
+				(self.sst_sector_erase, sector, self.T_ERASE),
+				(self.sst_block_erase, block, self.T_ERASE),
+				(self.sst_chip_erase, self.memory, self.T_SCE)
 			)
 		else:
 			raise DeviceNotSupportedError(manuf, devc, devcex)
 
+		self.device_id = (manuf, devc, devcex)
 		return manuf, devc, devcex
 
 	def read_cfi_query_struct(self):
@@ -162,6 +170,14 @@ class DittoMiniRev3(BaseSstCard):
 		x = int.from_bytes(packet[:4], "big", signed=False)
 		return (x & 0x1fffff00) >> 8, (x & 0xff)
 
+	def decode_packets(self, raw: bytes):
+		return raw[3::4]
+
+	def decode_packets_into(self, raw: bytes, view: memoryview):
+		size = len(raw) // 4
+		view[:size] = memoryview(raw)[3::4]
+		return size
+
 	@staticmethod
 	def prepare_write_packet(addr: int, data: int):
 		return (
@@ -177,37 +193,28 @@ class DittoMiniRev3(BaseSstCard):
 			((addr & 0x1fffff) << 8)
 		).to_bytes(4, "big")
 
+	def prepare_read_packets(self, addr: int, size: int):
+		return struct.pack(f">{size}I", *range(addr << 8, (addr + size) << 8, 0x100))
+
+	def prepare_write_packets(self, addr: int, data: bytes):
+		size = len(data)
+		ret = bytearray(struct.pack(
+			f">{size}I",
+			*range(0x80000000 | addr << 8, 0x80000000 | (addr + size) << 8, 0x100)
+		))
+		ret[3::4] = data
+		return bytes(ret)
+
+	def prepare_program_packets(self, addr: int, data: bytes):
+		return super().prepare_program_packets(addr, self.linker.lsb_first.apply(data))
+
 	def read_info(self, addr: int, size: int):
 		reader: BaseReader = self.linker.read_data(
-			b"".join(
-				self.prepare_read_packet(a)
-				for a in range(addr, addr + size)
-			),
+			self.prepare_read_packets(addr, size),
 			size,
 		)
 		return reader.read()
 
-	def read_data(self, addr: int, size: int, *, prog: progress = dummy_progress):
-		for start, bsize in self.blocks(addr, size):
-			read_size = 512
-			end = start + bsize
-			ret = b"".join(
-				self.linker.read_data(
-					b"".join(
-						self.prepare_read_packet(a)
-						for a in range(a, a + s)
-					),
-					s,
-					transform=self.linker.lsb_first
-				).read()
-				for a, s in zip(
-					range(start, end, read_size),
-					[read_size] * (bsize // read_size) + [bsize % read_size or read_size]
-				)
-			)
-			prog.add(bsize)
-			yield ret
-
 	# def write_data(self, addr: int, data: bytes, *, prog: progress = dummy_progress):
 	# 	for (start, bsize), block in zip(
 	# 		self.blocks(addr, len(data)),
@@ -236,14 +243,14 @@ class DittoMiniRev3(BaseSstCard):
 		self.linker.send(
 			self.prepare_sdp_prefixed(0x80)
 			+ self.prepare_sdp_prefixed(0x50, addr),
-			wait=self.T_ERASE
+			wait=self.erase_wait(self.T_ERASE)
 		)
 
 	def sst_block_erase(self, addr: int):
 		self.linker.send(
 			self.prepare_sdp_prefixed(0x80)
 			+ self.prepare_sdp_prefixed(0x30, addr),
-			wait=self.T_ERASE
+			wait=self.erase_wait(self.T_ERASE)
 		)
 
 	def sst_erase_suspend(self):
@@ -0,0 +1,103 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import json
+from time import monotonic
+from typing import TYPE_CHECKING, Any, BinaryIO, Dict, Optional
+
+from pm2hw.config import config_dir
+from pm2hw.carts.cache import card_key
+from pm2hw.logger import debug
+
+if TYPE_CHECKING:
+	from pm2hw.carts.base import BaseCard
+
+journal_dir = config_dir / "journal"
+
+class Journal:
+	"""
+	Blocks of a flash or dump job which have been completed, kept on disk
+	so the job can pick up where it left off if it's interrupted.
+
+	Only a journal for the same card, job, and block size is resumed.
+	Blocks may be recorded with a hash of what was written, so a flash
+	can tell whether it's resuming the same ROM.
+	"""
+	# Seconds between writing the journal to disk
+	interval = 0.5
+
+	def __init__(self, path: Optional[os.PathLike], job: Dict[str, Any]):
+		self.path = path
+		self.job = job
+		self.erased = False
+		# block address: hash of its contents, if known
+		self.done: Dict[int, Optional[str]] = {}
+		self._saved_at = monotonic()
+
+	@classmethod
+	def for_job(cls, card: "BaseCard", kind: str, **job) -> "Journal":
+		key = card_key(card)
+		job = dict(job, kind=kind)
+		job["block-size"] = card.block_size
+		return cls(None if key is None else journal_dir / f"{key}-{kind}.json", job)
+
+	def resume(self) -> bool:
+		""" Load the progress of an interrupted job, return whether there was any """
+		if self.path is None:
+			return False
+		try:
+			with open(self.path, "rt", encoding="UTF-8") as f:
+				raw = json.load(f)
+			if raw["job"] != self.job:
+				debug("Journal is for a different job, starting over")
+				return False
+			self.erased = raw["erased"]
+			self.done = {int(addr): digest for addr, digest in raw["done"].items()}
+		except (OSError, ValueError, KeyError, TypeError):
+			return False
+		return bool(self.erased or self.done)
+
+	def is_done(self, addr: int, digest: Optional[str] = None) -> bool:
+		return addr in self.done and self.done[addr] == digest
+
+	def begin(self, addr: int):
+		""" Note a block is being written, so its contents are unknown until it's complete """
+		self.done[addr] = ""
+
+	def complete(self, addr: int, digest: Optional[str] = None):
+		self.done[addr] = digest
+
+	def checkpoint(self, stream: Optional[BinaryIO] = None, *, force: bool = False):
+		"""
+		Save the journal if it's been a while. The output stream, if any,
+		is flushed first so the journal never gets ahead of it.
+		"""
+		if self.path is None or not (force or monotonic() - self._saved_at >= self.interval):
+			return
+		if stream is not None:
+			stream.flush()
+		self.save()
+
+	def save(self):
+		if self.path is None:
+			return
+		os.makedirs(journal_dir, exist_ok=True)
+		with open(self.path, "wt", encoding="UTF-8") as f:
+			json.dump({
+				"job": self.job,
+				"erased": self.erased,
+				"done": self.done,
+			}, f)
+		self._saved_at = monotonic()
+
+	def remove(self):
+		""" Forget the job once it's finished """
+		if self.path is not None:
+			try:
+				os.remove(self.path)
+			except FileNotFoundError:
+				pass
@@ -7,12 +7,11 @@
 # This code has been adapted from PokeFlash which is
 # Copyright (C) 2008-2013 Lupin
 
+import struct
 from typing import TYPE_CHECKING, Tuple
-from functools import lru_cache
 
-from pm2hw.carts.base import dummy_progress
+from pm2hw.base import Transform
 from pm2hw.carts.base_sst import BaseSstCard
-from pm2hw.logger import progress
 from pm2hw.exceptions import DeviceNotSupportedError
 
 if TYPE_CHECKING:
@@ -48,21 +47,29 @@ class PokeCard512(BaseSstCard):
 		# TODO: super doubt these are all wired the same way
 		if (manuf, devc, devcex) == (0x1f, 0x13, 0x0f):
 			self.chip = "Atmel AT49BV040A"
+			self.status_polling = True
+			# The erase times are the SST39VF040's, this can take seconds
+			self.erase_timeout_scale = 800
 			self.memory = 512 * 1024
 			# wait time for byte_program: 30~50 μs
 		elif (manuf, devc) == (0x01, 0x4f):
 			# http://instrumentation.obs.carnegiescience.edu/ccd/parts/AM29LV040B.pdf
 			self.chip = "AMD AM29LV040B"
+			self.status_polling = True
+			# The erase times are the SST39VF040's, this can take seconds
+			self.erase_timeout_scale = 800
 			self.memory = 512 * 1024
 			# wait time for byte_program: ~9 μs
 		elif (manuf, devc) == (0xbf, 0xd7):
 			# https://ww1.microchip.com/downloads/en/DeviceDoc/20005023B.pdf
 			self.chip = "SST39VF040"
+			self.status_polling = True
 			self.memory = 512 * 1024
 			self.name = "PokeCard512 (Rev 2.1)"
 			# wait time for byte_program: 14~20 μs
 		else:
 			raise DeviceNotSupportedError(manuf, devc, devcex)
+		self.device_id = (manuf, devc, devcex)
 		return manuf, devc, devcex
 
 	def prepare_sdp_prefixed(self, data: int, addr: int = 0x5555):
@@ -74,6 +81,13 @@ class PokeCard512(BaseSstCard):
 		x = int.from_bytes(packet[:4], "big", signed=False)
 		return (x & 0x7ffff000) >> 12, (x & 0x1fe) >> 1
 
+	def decode_packets(self, raw: bytes):
+		size = len(raw) // 4
+		return (
+			int.from_bytes(raw[2::4].translate(FROM_HIGH), "big")
+			| int.from_bytes(raw[3::4].translate(FROM_LOW), "big")
+		).to_bytes(size, "big")
+
 	@staticmethod
 	def prepare_write_packet(addr: int, data: int):
 		return (
@@ -90,17 +104,22 @@ class PokeCard512(BaseSstCard):
 			((addr & 0x07ffff) << 12)
 		).to_bytes(4, "big")
 
-	def read_data(self, addr: int, size: int, *, prog: progress = dummy_progress):
-		for start, bsize in self.blocks(addr, size):
-			ret = self.linker.read_data(
-				b"".join(
-					self.prepare_read_packet(a)
-					for a in range(start, start + bsize)
-				),
-				bsize
-			).read()
-			prog.add(bsize)
-			yield ret
+	def prepare_read_packets(self, addr: int, size: int):
+		return struct.pack(f">{size}I", *range(addr << 12, (addr + size) << 12, 0x1000))
+
+	def prepare_write_packets(self, addr: int, data: bytes):
+		size = len(data)
+		ret = bytearray(struct.pack(
+			f">{size}I",
+			*range(addr << 12 | 0x400, (addr + size) << 12 | 0x400, 0x1000)
+		))
+		# Data straddles the last two bytes: xxxD DDDD DDDx
+		ret[3::4] = data.translate(DATA_LOW)
+		ret[2::4] = (
+			int.from_bytes(ret[2::4], "big")
+			| int.from_bytes(data.translate(DATA_HIGH), "big")
+		).to_bytes(size, "big")
+		return bytes(ret)
 
 	# Chip commands
 	T_BP = 23.46e-6  # μs
@@ -111,9 +130,15 @@ class PokeCard512(BaseSstCard):
 		self.linker.send(
 			self.prepare_sdp_prefixed(0x80)
 			+ self.prepare_sdp_prefixed(0x30, addr),
-			wait=0.025
+			wait=self.erase_wait(0.025)
 		)
 
+# Where a data byte lands in the last two bytes of a packet
+DATA_HIGH = Transform.from_function(lambda x: x >> 7)
+DATA_LOW = Transform.from_function(lambda x: x << 1)
+FROM_HIGH = Transform.from_function(lambda x: (x & 1) << 7)
+FROM_LOW = Transform.from_function(lambda x: x >> 1)
+
 ON_0 = 1 << 0
 ON_1 = 1 << 1
 ON_2 = 1 << 2
@@ -123,8 +148,7 @@ ON_5 = 1 << 5
 ON_6 = 1 << 6
 ON_7 = 1 << 7
 
-@lru_cache(maxsize=10)
-def convert_byte(byte: int):
+def _convert_byte(byte: int):
 	bret = 0
 	if byte & ON_0: bret |= ON_7
 	if byte & ON_1: bret |= ON_5
@@ -136,7 +160,7 @@ def convert_byte(byte: int):
 	if byte & ON_7: bret |= ON_6
 	return bret
 
-def revert_byte(byte: int):
+def _revert_byte(byte: int):
 	bret = 0
 	if byte & ON_7: bret |= ON_0
 	if byte & ON_5: bret |= ON_1
@@ -148,3 +172,5 @@ def revert_byte(byte: int):
 	if byte & ON_6: bret |= ON_7
 	return bret
 
+convert_byte = Transform.from_function(_convert_byte)
+revert_byte = Transform.from_function(_revert_byte)
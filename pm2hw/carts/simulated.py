@@ -0,0 +1,223 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import struct
+from typing import TYPE_CHECKING, ClassVar, Dict, Optional, Tuple
+
+if TYPE_CHECKING:
+	from pm2hw.linkers.simulated import TimingModel
+
+class SimulatedSstChip:
+	""" Command state machine and memory array of an SST-style parallel flash chip """
+	chip: ClassVar[str]
+	memory: ClassVar[int]
+	software_id: ClassVar[bytes]
+	cfi_query: ClassVar[bytes] = b""
+
+	# Unlock addresses as seen by the chip
+	command_addresses: ClassVar[Tuple[int, int]]
+	command_mask: ClassVar[int]
+
+	# command byte: erase size (bytes), erase time (seconds)
+	erase_commands: ClassVar[Dict[int, Tuple[int, float]]]
+
+	# Datasheet typical times (seconds), cards wait for the maximums
+	T_BP: ClassVar[float]
+	T_SCE: ClassVar[float]
+
+	timing: Optional["TimingModel"] = None
+
+	def __init__(self, contents: Optional[bytes] = None):
+		self.array = bytearray(b"\xff" * self.memory)
+		if contents:
+			self.array[:len(contents)] = contents
+		self.mode = "read"
+		self._state = 0
+		self._programming = False
+
+		# Status of the running embedded algorithm
+		self.busy_until = 0.0
+		self.busy_time = 0.0
+		self.busy_violations = 0
+		self._busy_data = 0
+		self._toggle = 0
+
+	def reset(self):
+		self.mode = "read"
+		self._state = 0
+		self._programming = False
+
+	def now(self) -> float:
+		return self.timing.device if self.timing else 0.0
+
+	def is_busy(self) -> bool:
+		return self.now() < self.busy_until
+
+	def start_operation(self, secs: float, data: int = 0):
+		now = self.now()
+		self.busy_until = now + secs
+		self.busy_time += secs
+		self._busy_data = data
+
+	def read(self, addr: int) -> int:
+		if self.is_busy():
+			# Data# polling on DQ7 and toggle bit on DQ6
+			self._toggle ^= 0x40
+			return (~self._busy_data & 0x80) | self._toggle
+		elif self.mode == "id":
+			return self.software_id[addr % len(self.software_id)]
+		elif self.mode == "cfi":
+			return self.cfi_query[addr] if addr < len(self.cfi_query) else 0
+		return self.array[addr % self.memory]
+
+	def write(self, addr: int, data: int):
+		if self.is_busy():
+			# Commands are ignored while the chip is programming or erasing
+			self.busy_violations += 1
+			return
+
+		a1, a2 = self.command_addresses
+		caddr = addr & self.command_mask
+		state = self._state
+
+		if self._programming:
+			self._programming = False
+			self._state = 0
+			self.program(addr, data)
+		elif data == 0xf0 and state in (0, 2):
+			# Exit software ID/CFI query from either form of the command
+			self.reset()
+		elif state in (0, 3) and caddr == a1 and data == 0xaa:
+			self._state = state + 1
+		elif state in (1, 4) and caddr == a2 and data == 0x55:
+			self._state = state + 1
+		elif state == 2 and caddr == a1:
+			self._state = 0
+			if data == 0xa0:
+				self._programming = True
+			elif data == 0x80:
+				self._state = 3
+			elif data == 0x90:
+				self.mode = "id"
+			elif data == 0x98 and self.cfi_query:
+				self.mode = "cfi"
+		elif state == 5:
+			self._state = 0
+			if caddr == a1 and data == 0x10:
+				self.erase(0, self.memory)
+				self.start_operation(self.T_SCE)
+			elif data in self.erase_commands:
+				size, secs = self.erase_commands[data]
+				self.erase(addr - addr % size, size)
+				self.start_operation(secs)
+		else:
+			self._state = 0
+
+	def program(self, addr: int, data: int):
+		# Programming can only clear bits
+		self.array[addr % self.memory] &= data
+		self.start_operation(self.T_BP, data)
+
+	def erase(self, addr: int, size: int):
+		self.array[addr:addr + size] = b"\xff" * size
+
+
+class SST39VF040(SimulatedSstChip):
+	chip = "SST39VF040"
+	memory = 512 * 1024
+	software_id = bytes([0xbf, 0xd7, 0xbf, 0xd7])
+	command_addresses = (0x5555, 0x2aaa)
+	command_mask = 0x7fff
+	erase_commands = {0x30: (4 * 1024, 0.018)}
+	T_BP = 14e-6
+	T_SCE = 0.070
+
+
+class SST39VF1681(SimulatedSstChip):
+	chip = "SST39VF1681"
+	memory = 2 * 1024 * 1024
+	software_id = bytes([0xbf, 0xc8, 0x00, 0x00])
+	command_addresses = (0xaaa, 0x555)
+	command_mask = 0xfff
+	erase_commands = {0x50: (4 * 1024, 0.018), 0x30: (64 * 1024, 0.018)}
+	T_BP = 7e-6
+	T_SCE = 0.040
+
+	# Laid out the way DittoMiniRev3.read_cfi_query_struct reads it
+	cfi_query = bytes(0x10) + struct.pack(
+		"<3s4H4B8sBHHB",
+		b"QRY", 0x0701, 0, 0, 0,
+		0x27, 0x36, 0, 0, bytes([4, 0, 4, 6, 1, 0, 1, 1]),
+		21, 0, 0, 2
+	) + struct.pack(
+		"<HHHH",
+		511, 0x10,  # 512 sectors of 4 KiB
+		31, 0x100,  # 32 blocks of 64 KiB
+	)
+
+
+class SimulatedCart:
+	""" Cart side of the packet protocol, wrapping a simulated flash chip """
+	packet_size = 4
+
+	def __init__(self, chip: SimulatedSstChip):
+		self.chip = chip
+
+	def decode_packet(self, packet: bytes) -> Tuple[bool, int, int]:
+		""" Return whether it's a write, the addr, and the data from a raw packet """
+		raise NotImplementedError
+
+	def encode_response(self, addr: int, data: int) -> bytes:
+		raise NotImplementedError
+
+	# Wiring of the data lines between the linker and the chip
+	def to_chip(self, data: int) -> int:
+		return data
+
+	def from_chip(self, data: int) -> int:
+		return data
+
+	def transfer(self, packet: bytes) -> bytes:
+		""" Clock one packet through the cart and return what it clocked back """
+		is_write, addr, data = self.decode_packet(packet)
+		if is_write:
+			self.chip.write(addr, self.to_chip(data))
+			return packet
+		return self.encode_response(addr, self.from_chip(self.chip.read(addr)))
+
+
+class SimulatedPokeCard512(SimulatedCart):
+	def __init__(self, chip: Optional[SimulatedSstChip] = None):
+		super().__init__(chip or SST39VF040())
+
+	def decode_packet(self, packet: bytes):
+		# Layout: xAAA AAAA AAAA AAAA AAAA xCxD DDDD DDDx
+		x = int.from_bytes(packet, "big")
+		return bool(x & 0x400), (x & 0x7ffff000) >> 12, (x & 0x1fe) >> 1
+
+	def encode_response(self, addr: int, data: int):
+		return (((addr & 0x07ffff) << 12) | (data << 1)).to_bytes(4, "big")
+
+	def to_chip(self, data: int):
+		from pm2hw.carts.pokecard import revert_byte
+		return revert_byte(data)
+
+	def from_chip(self, data: int):
+		from pm2hw.carts.pokecard import convert_byte
+		return convert_byte(data)
+
+
+class SimulatedDittoMiniRev3(SimulatedCart):
+	def __init__(self, chip: Optional[SimulatedSstChip] = None):
+		super().__init__(chip or SST39VF1681())
+
+	def decode_packet(self, packet: bytes):
+		# Layout: CxxA AAAA AAAA AAAA AAAA AAAA DDDD DDDD
+		x = int.from_bytes(packet, "big")
+		return bool(x & 0x80000000), (x & 0x1fffff00) >> 8, x & 0xff
+
+	def encode_response(self, addr: int, data: int):
+		return (((addr & 0x1fffff) << 8) | data).to_bytes(4, "big")
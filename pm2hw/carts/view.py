@@ -0,0 +1,119 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from io import RawIOBase
+from os import SEEK_SET, SEEK_CUR, SEEK_END
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Iterable, List
+
+if TYPE_CHECKING:
+	from pm2hw.carts.base import BaseCard
+
+class CardView(RawIOBase):
+	"""
+	Random-access file over a card. The card is read a whole block at a
+	time, and the most recently used blocks are kept until the card is
+	written to or erased, so small reads near each other are cheap.
+	"""
+	# Most blocks kept at once
+	capacity = 16
+
+	def __init__(self, card: "BaseCard", *, block_size: int = 0, capacity: int = 0):
+		self.card = card
+		self.block_size = block_size or card.block_size
+		if capacity:
+			self.capacity = capacity
+		# block index: contents, least recently used first
+		self.blocks: "OrderedDict[int, bytes]" = OrderedDict()
+		self._position = 0
+
+	def readable(self):
+		return True
+
+	def writable(self):
+		return True
+
+	def seekable(self):
+		return True
+
+	def seek(self, offset: int, whence: int = SEEK_SET) -> int:
+		if whence == SEEK_SET:
+			position = offset
+		elif whence == SEEK_CUR:
+			position = self._position + offset
+		elif whence == SEEK_END:
+			position = self.card.memory + offset
+		else:
+			raise ValueError("whence must be one of: SEEK_SET, SEEK_CUR, or SEEK_END")
+		self._position = min(max(position, 0), self.card.memory)
+		return self._position
+
+	def tell(self) -> int:
+		return self._position
+
+	def readinto(self, buffer) -> int:
+		block_size = self.block_size
+		start = self._position
+		end = min(start + len(buffer), self.card.memory)
+		if end <= start:
+			return 0
+
+		indices = range(start // block_size, (end - 1) // block_size + 1)
+		with memoryview(buffer) as view:
+			view = view.cast("B")
+			pos = 0
+			for i, block in zip(indices, self._fetch(indices)):
+				lo = max(start - i * block_size, 0)
+				hi = min(end - i * block_size, len(block))
+				view[pos:pos + hi - lo] = block[lo:hi]
+				pos += hi - lo
+		self._position = end
+		return pos
+
+	def readall(self) -> bytes:
+		return self.read(self.card.memory - self._position)
+
+	def _fetch(self, indices: Iterable[int]) -> List[bytes]:
+		""" Return the blocks, reading the ones which aren't kept in one go """
+		block_size = self.block_size
+		blocks = self.blocks
+		indices = list(indices)
+		missing = [i for i in indices if i not in blocks]
+		ranges = [
+			(i * block_size, min(block_size, self.card.memory - i * block_size))
+			for i in missing
+		]
+		found = dict(zip(missing, (bytes(data) for data in self.card.read_ranges(ranges))))
+
+		ret = []
+		for i in indices:
+			if i in found:
+				block = found[i]
+				blocks[i] = block
+			else:
+				block = blocks[i]
+				blocks.move_to_end(i)
+			ret.append(block)
+		while len(blocks) > self.capacity:
+			blocks.popitem(last=False)
+		return ret
+
+	def write(self, data: bytes) -> int:
+		addr = self._position
+		size = len(data)
+		self.card.write_data(addr, bytes(data))
+		self.invalidate(addr, size)
+		self._position += size
+		return size
+
+	def invalidate(self, addr: int = 0, size: int = 0):
+		""" Forget blocks touched by an operation, or everything """
+		if not size:
+			self.blocks.clear()
+		else:
+			block_size = self.block_size
+			for i in range(addr // block_size, -(-(addr + size) // block_size)):
+				self.blocks.pop(i, None)
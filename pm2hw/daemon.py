@@ -0,0 +1,271 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import sys
+import socket
+import secrets
+from io import RawIOBase
+from queue import Empty, Queue
+from threading import Lock
+from typing import BinaryIO, Callable, Dict, List, Optional
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener
+
+from pm2hw import logger
+from pm2hw.base import BaseFlashable
+from pm2hw.carts.base import BaseCard
+from pm2hw.config import config_dir
+from pm2hw.discovery import DeviceEvent, Watcher
+from pm2hw.linkers import BaseLinker
+from pm2hw.logger import LogRecord, log, verbose, exception
+from pm2hw.locales import delayed_gettext as _
+from pm2hw.exceptions import DeviceError
+
+key_file = config_dir / "daemon.key"
+
+def address() -> str:
+	""" Where the daemon listens, a Unix socket or a named pipe on Windows """
+	if hasattr(socket, "AF_UNIX"):
+		return str(config_dir / "daemon.sock")
+	return r"\\.\pipe\pm2hw-" + os.getlogin()
+
+def connect() -> Optional[Connection]:
+	""" Connect to the running daemon, if there is one """
+	addr = address()
+	if hasattr(socket, "AF_UNIX") and not os.path.exists(addr):
+		return None
+	try:
+		with open(key_file, "rb") as f:
+			authkey = f.read()
+		return Client(addr, authkey=authkey)
+	except (OSError, AuthenticationError):
+		return None
+
+def request(argv: List[str], stdin: Optional[BinaryIO] = None) -> Optional[int]:
+	"""
+	Have the daemon run a command line, showing its logs and output here.
+	What it reads from stdin is read from the given stream as it asks.
+	Return its exit code, or None if the daemon isn't running.
+	"""
+	conn = connect()
+	if conn is None:
+		return None
+
+	with conn:
+		conn.send({"argv": argv, "cwd": os.getcwd()})
+		while True:
+			try:
+				msg = conn.recv()
+			except EOFError:
+				raise DeviceError(_("exception.daemon.disconnected"))
+			if isinstance(msg, LogRecord):
+				logger.logger.handle(msg)
+			elif msg[0] == "stdin":
+				conn.send((stdin.read(msg[1]) if stdin is not None else None) or b"")
+			elif msg[0] == "stdout":
+				sys.stdout.buffer.write(msg[1])
+				sys.stdout.flush()
+			elif msg[0] == "exit":
+				return msg[1]
+
+def stop() -> bool:
+	""" Ask the daemon to stop, return whether it was running """
+	conn = connect()
+	if conn is None:
+		return False
+	with conn:
+		conn.send({"stop": True})
+		try:
+			conn.recv()
+		except EOFError:
+			pass
+	return True
+
+
+class _ConnectionQueue:
+	""" Lets QueueHandler send records over a connection, from any thread """
+
+	def __init__(self, conn: Connection):
+		self.conn = conn
+		self.lock = Lock()
+
+	def put_nowait(self, obj):
+		with self.lock:
+			self.conn.send(obj)
+
+
+class _ConnectionReader(RawIOBase):
+	""" Reads the client's stdin over a connection, a chunk at a time """
+	chunk_size = 0x10000
+
+	def __init__(self, queue: _ConnectionQueue):
+		self.queue = queue
+		self.eof = False
+
+	def readable(self):
+		return True
+
+	def readinto(self, buffer) -> int:
+		if self.eof:
+			return 0
+		self.queue.put_nowait(("stdin", min(len(buffer), self.chunk_size)))
+		data = self.queue.conn.recv()
+		self.eof = not data
+		buffer[:len(data)] = data
+		return len(data)
+
+
+class Daemon:
+	"""
+	Keeps linkers open and initialized between commands. Clients send a
+	command line, which runs here one at a time, and get its log records,
+	output, and exit code back.
+	"""
+
+	def __init__(self, linkers: List[BaseLinker], watcher: Optional[Watcher] = None):
+		self.linkers = linkers
+		# Linkers which have been initialized, and what was found on them
+		self.flashables: Dict[BaseLinker, BaseFlashable] = {}
+		# Plugged in and unplugged linkers, applied between requests
+		self.events: "Queue[DeviceEvent]" = Queue()
+		self.watcher = watcher
+		if watcher is not None:
+			watcher.subscribe(self.events.put)
+
+	def apply_events(self):
+		""" Open linkers which were plugged in and drop ones which were unplugged """
+		while True:
+			try:
+				event = self.events.get_nowait()
+			except Empty:
+				break
+			held = {(linker.name, linker.serial): linker for linker in self.linkers}
+			linker = held.get(event.key)
+			if event.kind == "added" and linker is None:
+				try:
+					self.linkers.append(event.device.open())
+				except DeviceError as err:
+					verbose(str(err))
+			elif event.kind == "removed" and linker is not None:
+				self.linkers.remove(linker)
+				self.flashables.pop(linker, None)
+				try:
+					linker.close()
+				except Exception:
+					# It's gone already
+					pass
+
+	def connect(self, linkers: List[BaseLinker]) -> List[BaseFlashable]:
+		""" Return flashables for the linkers, only initializing those which need it """
+		flashables = []
+		for linker in linkers:
+			flashable = self.flashables.get(linker)
+			if flashable is None:
+				flashable = self.flashables[linker] = linker.init()
+			else:
+				linker.reload_config()
+				# The card may have been swapped since the last request, so
+				# detect it again and check what was cached against it
+				if isinstance(flashable, BaseCard):
+					flashable.get_device_info()
+					flashable.forget_contents()
+			flashables.append(flashable)
+		return flashables
+
+	def forget(self):
+		""" Initialize every linker again on next use, after something went wrong """
+		self.flashables.clear()
+
+	def serve(self, run: Callable[[List[str]], int]):
+		"""
+		Handle requests until asked to stop. run takes a command line and
+		returns an exit code, with stdin and stdout standing in for the client's.
+		"""
+		addr = address()
+		if hasattr(socket, "AF_UNIX") and os.path.exists(addr):
+			if connect() is not None:
+				raise DeviceError(_("exception.daemon.running"))
+			# Left behind by a daemon which didn't exit cleanly
+			os.remove(addr)
+
+		authkey = secrets.token_bytes(32)
+		os.makedirs(config_dir, exist_ok=True)
+		with open(os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as f:
+			f.write(authkey)
+
+		listener = Listener(addr, authkey=authkey)
+		log(_("log.daemon.listening"), address=addr)
+		if self.watcher is not None:
+			self.watcher.start()
+		try:
+			while True:
+				try:
+					conn = listener.accept()
+				except (OSError, EOFError, AuthenticationError) as err:
+					# Failed authentication or a client which went away
+					verbose(str(err))
+					continue
+				with conn:
+					try:
+						req = conn.recv()
+					except EOFError:
+						continue
+					if req.get("stop"):
+						conn.send(("exit", 0))
+						break
+					self.apply_events()
+					self._handle(conn, req, run)
+		finally:
+			if self.watcher is not None:
+				self.watcher.stop()
+			listener.close()
+			try:
+				os.remove(key_file)
+			except OSError:
+				pass
+			for linker in self.linkers:
+				linker.close()
+
+	def _handle(self, conn: Connection, req: dict, run: Callable[[List[str]], int]):
+		from io import BufferedReader, BytesIO, TextIOWrapper
+
+		queue = _ConnectionQueue(conn)
+		handler = logger.QueueHandler(queue)
+		handlers = list(logger.logger.handlers)
+		for h in handlers:
+			logger.remove_handler(h)
+		logger.add_handler(handler)
+		level = logger.logger.level
+
+		cwd = os.getcwd()
+		stdin, stdout = sys.stdin, sys.stdout
+		sys.stdin = TextIOWrapper(BufferedReader(_ConnectionReader(queue), _ConnectionReader.chunk_size))
+		sys.stdout = TextIOWrapper(BytesIO(), write_through=True)
+		try:
+			os.chdir(req["cwd"])
+			code = run(req["argv"])
+		except Exception as err:
+			exception(_("cli.error.exception"), err)
+			code = 2
+		finally:
+			os.chdir(cwd)
+			output = sys.stdout.buffer.getvalue()
+			sys.stdin, sys.stdout = stdin, stdout
+			logger.remove_handler(handler)
+			for h in handlers:
+				logger.add_handler(h)
+			logger.set_level(level)
+
+		if code:
+			self.forget()
+		try:
+			if output:
+				queue.put_nowait(("stdout", output))
+			queue.put_nowait(("exit", code))
+		except OSError:
+			# The client went away
+			pass
@@ -0,0 +1,177 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, Type
+
+from pm2hw.linkers import BaseLinker, linkers
+from pm2hw.logger import debug
+from pm2hw.locales import delayed_gettext as _
+from pm2hw.exceptions import DeviceError, clarify
+
+DeviceKey = Tuple[str, bytes]
+
+# FT_FLAGS_OPENED, the device is open in some process
+FLAG_OPENED = 1
+
+# location: (description, serial) last seen there, since the info list
+# leaves them out for devices which are open
+described: Dict[int, Tuple[bytes, bytes]] = {}
+# Held while listing devices, the watcher and the GUI may do so at once
+described_lock = Lock()
+
+class Device(NamedTuple):
+	""" A connected device which some linker class handles """
+	index: int
+	location: int
+	description: bytes
+	serial: bytes
+
+	@property
+	def linker_cls(self) -> Type[BaseLinker]:
+		return linkers[self.description]
+
+	@property
+	def key(self) -> DeviceKey:
+		""" What tells linkers apart, as (name, serial) """
+		return (self.linker_cls.name, self.serial)
+
+	def open(self) -> BaseLinker:
+		"""
+		Open the device, wherever it is in the info list now. Devices
+		plugged in or unplugged since it was found change the indexes.
+		"""
+		import ftd2xx
+
+		with described_lock:
+			for i in range(ftd2xx.createDeviceInfoList()):
+				detail = ftd2xx.getDeviceInfoDetail(i, update=False)
+				# The serial is left out for devices which are open or hidden
+				if detail["location"] == self.location and detail["serial"] in (b"", self.serial):
+					break
+			else:
+				raise DeviceError(_("exception.device.gone"))
+			with clarify(_("exception.device.open.failed")):
+				dev = ftd2xx.open(i, update=False)
+		return self.linker_cls(dev)
+
+
+def discover() -> List[Device]:
+	"""
+	List connected devices which a linker class handles, reading the
+	device info list rather than opening every device.
+	"""
+	import ftd2xx
+
+	with described_lock:
+		num_devices = ftd2xx.createDeviceInfoList()
+		found = []
+		seen = set()
+		for i in range(num_devices):
+			detail = ftd2xx.getDeviceInfoDetail(i, update=False)
+			location = detail["location"]
+			description = detail["description"]
+			serial = detail["serial"]
+			seen.add(location)
+			if description:
+				described[location] = (description, serial)
+			else:
+				# getDeviceInfoDetail returns null data for PokeCard,
+				# so open it the first time it's seen at this location
+				if location not in described:
+					if detail["flags"] & FLAG_OPENED:
+						# Can't ask, someone else is using it
+						continue
+					with clarify(_("exception.device.open.failed")):
+						dev = ftd2xx.open(i, update=False)
+					try:
+						info = dev.getDeviceInfo()
+					finally:
+						dev.close()
+					described[location] = (info["description"], info["serial"])
+				description, serial = described[location]
+			if description in linkers:
+				found.append(Device(i, location, description, serial))
+
+		# Forget unplugged devices, something else could be plugged in there
+		for location in list(described):
+			if location not in seen:
+				del described[location]
+
+		return found
+
+
+class DeviceEvent(NamedTuple):
+	""" A linker was plugged in (added) or unplugged (removed) """
+	kind: str
+	key: DeviceKey
+	# The device for added events, or how it was last seen for removed ones
+	device: Device
+
+
+class Watcher:
+	"""
+	Polls the device info list on a background thread and tells subscribers
+	which linkers were plugged in or unplugged since the last poll.
+	Subscribers are called from the watcher's thread.
+	"""
+	# Seconds between polls
+	interval = 0.25
+
+	def __init__(self, *, interval: float = 0):
+		if interval:
+			self.interval = interval
+		self.devices: Dict[DeviceKey, Device] = {}
+		self._subscribers: List[Callable[[DeviceEvent], None]] = []
+		self._lock = Lock()
+		self._stop = Event()
+		self._thread: Optional[Thread] = None
+
+	def subscribe(self, fn: Callable[[DeviceEvent], None]) -> Callable[[], None]:
+		""" Call fn with each event from now on, returns a function to unsubscribe """
+		self._subscribers.append(fn)
+		return lambda: self._subscribers.remove(fn)
+
+	def poll(self) -> List[DeviceEvent]:
+		""" Check for changes right away, sending and returning the events """
+		with self._lock:
+			found = {device.key: device for device in discover()}
+			events = [
+				DeviceEvent("removed", key, device)
+				for key, device in self.devices.items()
+				if key not in found
+			] + [
+				DeviceEvent("added", key, device)
+				for key, device in found.items()
+				if key not in self.devices
+			]
+			self.devices = found
+
+		for event in events:
+			for fn in list(self._subscribers):
+				fn(event)
+		return events
+
+	def start(self):
+		if self._thread is None:
+			self._stop.clear()
+			self._thread = Thread(target=self._run, name="pm2hw-watcher", daemon=True)
+			self._thread.start()
+
+	def stop(self):
+		if self._thread is not None:
+			self._stop.set()
+			self._thread.join()
+			self._thread = None
+
+	def _run(self):
+		while not self._stop.is_set():
+			try:
+				self.poll()
+			except Exception as err:
+				# Try again next time, the device list may have been changing
+				debug("Polling for devices failed: {err}", err=err)
+			self._stop.wait(self.interval)
@@ -6,12 +6,18 @@
 
 from contextlib import contextmanager
 
-import ftd2xx
-
 from pm2hw.locales import gettext as _
 
+try:
+	from ftd2xx import DeviceError as FtdiDeviceError
+except (ImportError, OSError):
+	# D2XX library isn't installed, only simulated devices will work
+	class FtdiDeviceError(Exception): pass
+
 class DeviceError(Exception): pass
 
+class OperationCancelled(Exception): pass
+
 class DeviceNotSupportedError(DeviceError):
 	def __init__(self, manufacturer: int, device: int, extended: int):
 		super().__init__(_("exception.device.unsupported"), manufacturer, device, extended)
@@ -101,7 +107,7 @@ class DeviceTestWritingError(DeviceTestError):
 def clarify(error_msg):
 	try:
 		yield
-	except ftd2xx.DeviceError as err:
+	except FtdiDeviceError as err:
 		raise DeviceError(f"{error_msg}: {err}") from None
 	except DeviceError:
 		raise DeviceError(error_msg) from None
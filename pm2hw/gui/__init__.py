@@ -21,6 +21,7 @@ from pm2hw.gui.components import (
 	GameList, HelpDialog, PreferencesDialog, ProtocolDialog
 )
 from pm2hw.config import config, log_dir as error_log_dir
+from pm2hw.discovery import Watcher
 
 
 logger.view = "gui"
@@ -238,10 +239,9 @@ with Menu(root) as m:
 		help.add_separator()
 		help.add_command(labelvar=TStringVar(_("window.menu.help.about")), command=partial(open_about, root))
 
-def auto_refresh():
-	refresh_linkers(game_list)
-	root.after(5000, auto_refresh)
-auto_refresh()
+refresh_linkers(game_list)
+linker_watcher = Watcher()
+game_list.watch(linker_watcher)
 
 # Check if update script exists and delete
 if getattr(sys, "frozen", False):
@@ -4,6 +4,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+from queue import Empty, Queue
 from typing import List, cast
 from functools import partial
 
@@ -12,11 +13,12 @@ from tkinter import ttk
 import weakref
 
 from pm2hw.gui.i18n import delayed_gettext as _, localized_game_name
-from pm2hw.gui.components.linker import Linker
+from pm2hw.gui.components.linker import Linker, apply_linker_event
 from pm2hw.gui.components.library import Entry, Library, BaseRomEntry
 from pm2hw.gui.resources import graphic
 from pm2hw.info import games
 from pm2hw.config import config
+from pm2hw.discovery import DeviceEvent, Watcher
 
 
 class ROM(BaseRomEntry):
@@ -127,6 +129,24 @@ class GameList(Library):
 				return
 		raise ValueError("entry")
 	
+	def watch(self, watcher: Watcher):
+		""" Keep the linkers listed up to date as they're plugged in and unplugged """
+		# Tk may only be touched from its own thread
+		events: "Queue[DeviceEvent]" = Queue()
+		watcher.subscribe(events.put)
+
+		def handle_events():
+			while True:
+				try:
+					event = events.get_nowait()
+				except Empty:
+					break
+				apply_linker_event(self, event)
+			self.after(100, handle_events)
+
+		handle_events()
+		watcher.start()
+
 	def add_no_linkers_message(self):
 		if not self._no_linkers_message:
 			self._no_linkers_message = self.make(_("library.list.no-linkers"), parent=self.iids[Linker])
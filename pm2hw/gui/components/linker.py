@@ -5,19 +5,19 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 import os
-from io import BytesIO
-from typing import TYPE_CHECKING, Optional
+from typing import TYPE_CHECKING, Dict, Optional
 
 from tkinter import ttk, filedialog
 
 from pm2hw.locales import natural_size
 
-from pm2hw import get_connected_linkers
+from pm2hw.discovery import Device, DeviceEvent, DeviceKey, discover
 from pm2hw.gui.components.status import prepare_progress, set_status
 from pm2hw.gui.components.library import BaseRomEntry
 from pm2hw.gui.i18n import delayed_gettext as _, localized_game_name
 from pm2hw.gui.util import filetypes_min, threaded
 from pm2hw.base import BaseFlashable
+from pm2hw.image import MappedImage
 from pm2hw.info import games
 from pm2hw.logger import error, exception, log, verbose
 from pm2hw.linkers import BaseLinker
@@ -33,7 +33,7 @@ class Linker(BaseRomEntry):
 		self.linker = linker
 		self.flashable: Optional[BaseFlashable] = None
 		self.connected = False
-		self.data = BytesIO()
+		self.data = MappedImage.temporary()
 		self.info: Optional[games.ROM] = None
 		
 		# Action statuses
@@ -44,6 +44,7 @@ class Linker(BaseRomEntry):
 
 	def cleanup(self):
 		self.linker.cleanup()
+		self.data.close()
 
 	@property
 	def name(self):
@@ -168,14 +169,11 @@ class Linker(BaseRomEntry):
 
 			# Check if it's already been read into memory
 			# TODO: status updates
-			if self.data.seek(0, os.SEEK_END):
-				self.data.seek(0)
-				out.write(self.data.read())
-			else:
+			if not self.data.seek(0, os.SEEK_END):
 				prepare_progress(self.flashable, "dumping")
 				self.read_to_memory(bypass=True)
-				self.data.seek(0)
-				out.write(self.data.read())
+			with self.data.getbuffer() as view:
+				out.write(view)
 			out.close()
 
 			self.dumping = False
@@ -208,15 +206,15 @@ class Linker(BaseRomEntry):
 		self.parent.update_preview()
 		prepare_progress(self.flashable, "erasing", "flashing")
 
+		# Flash straight from the file, identifying it on the way
 		with open(fn, "rb") as f:
-			self.data.seek(0)
-			self.data.write(f.read())
-			self.data.truncate()
+			reader = games.LookupReader(f)
+			self.flashable.flash(reader)
+		self.info = reader.lookup(check_crc=True)
 
+		# What's on the card is read back if it's needed
 		self.data.seek(0)
-		self.info = games.lookup(self.data, check_crc=True)
-		self.data.seek(0)
-		self.flashable.flash(self.data)
+		self.data.truncate()
 
 		self.flashing = False
 		self.parent.update_preview()
@@ -266,33 +264,66 @@ label2entry_cls = {
 }
 
 
-def refresh_linkers(game_list: "GameList"):
+def add_linker(game_list: "GameList", device: Device) -> Optional[Linker]:
+	""" Open a newly found linker and add its entry """
 	try:
-		linkers = {(l.name, l.serial): l for l in get_connected_linkers()}
+		linker = device.open()
 	except DeviceError:
-		return
-	entries = {
+		return None
+	cls = label2entry_cls[linker.name]
+	entry = cls(game_list, linker)
+	game_list.add(entry)
+	log(_("log.linker.found"), linker=linker)
+	return entry
+
+
+def remove_linker(game_list: "GameList", entry: Linker):
+	log(_("log.linker.removed"), linker=entry.linker)
+	game_list.remove_entry(entry)
+
+
+def linker_entries(game_list: "GameList") -> Dict[DeviceKey, Linker]:
+	return {
 		(e.linker.name, e.linker.serial): e
 		for e in game_list.entries.values()
 		if isinstance(e, Linker)
 	}
 
+
+def apply_linker_event(game_list: "GameList", event: DeviceEvent):
+	""" Add or remove the entry for a linker which was plugged in or unplugged """
+	entries = linker_entries(game_list)
+	if event.kind == "added":
+		if event.key in entries:
+			game_list.update_entry(entries[event.key])
+		else:
+			add_linker(game_list, event.device)
+	elif event.key in entries:
+		remove_linker(game_list, entries.pop(event.key))
+		if not entries:
+			game_list.add_no_linkers_message()
+
+
+def refresh_linkers(game_list: "GameList"):
+	try:
+		devices = {d.key: d for d in discover()}
+	except DeviceError:
+		return
+	entries = linker_entries(game_list)
+
 	# Delete removed linkers
 	for k in list(entries.keys()):
-		if k not in linkers:
-			entry = entries.pop(k)
-			log(_("log.linker.removed"), linker=entry.linker)
-			game_list.remove_entry(entry)
+		if k not in devices:
+			remove_linker(game_list, entries.pop(k))
 
-	# Update existing ones & add new ones
-	for k, linker in linkers.items():
+	# Update existing ones & add new ones, only opening the new ones
+	for k, device in devices.items():
 		if k in entries:
 			game_list.update_entry(entries[k])
 		else:
-			cls = label2entry_cls[linker.name]
-			e = entries[k] = cls(game_list, linker)
-			game_list.add(e)
-			log(_("log.linker.found"), linker=linker)
+			entry = add_linker(game_list, device)
+			if entry is not None:
+				entries[k] = entry
 
 	# If there are no entries, add a message
 	if not entries:
@@ -0,0 +1,154 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import mmap
+from io import RawIOBase
+from os import SEEK_SET, SEEK_CUR, SEEK_END
+from tempfile import TemporaryFile
+from typing import BinaryIO, Optional
+
+class MappedImage(RawIOBase):
+	"""
+	ROM image kept in a memory-mapped file. Dumps decode straight into it,
+	and getbuffer() gives a view of it which can be compared or hashed
+	without reading the file into memory.
+
+	Writing past the end grows the file by at least double, so appending
+	doesn't remap it every time. The file is cut down to the image's size
+	when it's truncated or closed.
+	"""
+
+	def __init__(self, file: BinaryIO, *, name: Optional[str] = None):
+		self.file = file
+		self.name = name if name is not None else getattr(file, "name", None)
+		self._map: Optional[mmap.mmap] = None
+		self._size = os.fstat(file.fileno()).st_size
+		# Size of the file and the mapping, which may be more than the image
+		self._capacity = 0
+		self._position = 0
+		self._remap(self._size)
+
+	@classmethod
+	def open(cls, path: os.PathLike, mode: str = "r+b") -> "MappedImage":
+		""" Map a file, mode must be one of r+b, w+b, or x+b """
+		return cls(open(path, mode), name=os.fspath(path))
+
+	@classmethod
+	def temporary(cls, size: int = 0) -> "MappedImage":
+		""" Map a new temporary file, which goes away when it's closed """
+		image = cls(TemporaryFile(), name="")
+		image.resize(size)
+		return image
+
+	def __len__(self):
+		return self._size
+
+	def _remap(self, capacity: int):
+		if self._map is not None:
+			self._map.close()
+			self._map = None
+		self._capacity = capacity
+		# Empty files can't be mapped
+		if capacity:
+			self._map = mmap.mmap(self.file.fileno(), capacity)
+
+	def _reallocate(self, capacity: int):
+		if capacity != self._capacity:
+			if self._map is not None:
+				self._map.close()
+				self._map = None
+			self.file.truncate(capacity)
+			self._remap(capacity)
+
+	def resize(self, size: int):
+		""" Grow or shrink the file to size, views from getbuffer must be released first """
+		self._reallocate(size)
+		self._size = size
+
+	def getbuffer(self) -> memoryview:
+		""" Writable view of the whole image """
+		if self._map is None:
+			return memoryview(bytearray())
+		with memoryview(self._map) as view:
+			return view[:self._size]
+
+	def reserve(self, size: int) -> memoryview:
+		""" Return a view of the next size bytes to fill in, growing the file if needed """
+		start = self._position
+		end = start + size
+		if end > self._size:
+			if end > self._capacity:
+				self._reallocate(max(end, 2 * self._capacity))
+			self._size = end
+		self._position = end
+		return self.getbuffer()[start:end]
+
+	def readable(self):
+		return True
+
+	def writable(self):
+		return True
+
+	def seekable(self):
+		return True
+
+	def fileno(self) -> int:
+		return self.file.fileno()
+
+	def seek(self, offset: int, whence: int = SEEK_SET) -> int:
+		if whence == SEEK_SET:
+			position = offset
+		elif whence == SEEK_CUR:
+			position = self._position + offset
+		elif whence == SEEK_END:
+			position = self._size + offset
+		else:
+			raise ValueError("whence must be one of: SEEK_SET, SEEK_CUR, or SEEK_END")
+		if position < 0:
+			raise ValueError("negative seek position")
+		self._position = position
+		return position
+
+	def tell(self) -> int:
+		return self._position
+
+	def readinto(self, buffer) -> int:
+		start = min(self._position, self._size)
+		size = min(len(buffer), self._size - start)
+		if size > 0:
+			with self.getbuffer() as view:
+				buffer[:size] = view[start:start + size]
+			self._position = start + size
+		return max(size, 0)
+
+	def write(self, data) -> int:
+		with memoryview(data) as view:
+			size = view.nbytes
+			if size:
+				self.reserve(size)[:] = view.cast("B")
+		return size
+
+	def truncate(self, size: Optional[int] = None) -> int:
+		if size is None:
+			size = self._position
+		self.resize(size)
+		return size
+
+	def flush(self):
+		if self._map is not None:
+			self._map.flush()
+
+	def close(self):
+		if not self.closed:
+			if self._map is not None:
+				self._map.close()
+				self._map = None
+			if self._capacity != self._size:
+				# Drop the room which was kept for growing
+				self.file.truncate(self._size)
+			self.file.close()
+		super().close()
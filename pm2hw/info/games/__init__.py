@@ -5,7 +5,9 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 import binascii
-from typing import BinaryIO, Dict, List, Tuple
+from io import RawIOBase
+from os import SEEK_SET
+from typing import BinaryIO, Dict, List, Optional, Tuple
 from collections import defaultdict
 
 from .base import Boxing, Game, ROM, Status
@@ -29,14 +31,23 @@ for game in games:
 # TODO: design and parse header that can be written to flash carts
 # TODO: check for whether start contains BIOS or junk or header
 
+# Where the header and the part of the ROM covered by the CRC start
+header_start = 0x021a4
+header_end = 0x021bc
+crc_start = 0x02100
+
 def lookup_all(f: BinaryIO):
-	f.seek(0x021a4)
-	nintendo = f.read(8)
+	f.seek(header_start)
+	return lookup_header(f.read(header_end - header_start))
+
+
+def lookup_header(header: bytes) -> List[ROM]:
+	nintendo = header[:8]
 	if nintendo != b"NINTENDO":
 		return []
 
-	code = f.read(4)
-	name = f.read(12).rstrip(b"\0").decode("shift-jis", errors="replace")
+	code = header[8:12]
+	name = header[12:24].rstrip(b"\0").decode("shift-jis", errors="replace")
 	# TODO: check for and use header if it exists
 
 	infos = games_by_rom.get((code, name))
@@ -52,23 +63,25 @@ def lookup(f: BinaryIO, check_crc: bool = False):
 	if not infos:
 		return None
 
-	code = infos[0].code
-	name = infos[0].internal
-
 	if check_crc:
-		f.seek(0x02100)
+		f.seek(crc_start)
 		crc = binascii.crc32(f.read())
-		size = f.tell()
-		for info in infos:
-			if info.crc32 == crc:
-				return info
-		# Nothing matched
-		return ROM(Status.unidentified, code, name, crc, size)
+		return match_crc(infos, crc, f.tell())
+	return match_name(infos)
 
-	# TODO: guess at likelihoods for name, or accept region or something
 
+def match_crc(infos: List[ROM], crc: int, size: int) -> ROM:
+	for info in infos:
+		if info.crc32 == crc:
+			return info
+	# Nothing matched
+	return ROM(Status.unidentified, infos[0].code, infos[0].internal, crc, size)
+
+
+def match_name(infos: List[ROM]) -> ROM:
+	# TODO: guess at likelihoods for name, or accept region or something
 	return ROM(
-		Status.unidentified, code, name, boxings=[
+		Status.unidentified, infos[0].code, infos[0].internal, boxings=[
 			Boxing(
 				"potential versions (CRC not checked)",
 				contains=[b for r in infos for b in r.boxings]
@@ -77,6 +90,64 @@ def lookup(f: BinaryIO, check_crc: bool = False):
 	)
 
 
+class LookupReader(RawIOBase):
+	"""
+	Pass reads through from a stream while keeping what's needed to look
+	up the ROM, so it can be identified while it's being flashed
+	"""
+
+	def __init__(self, stream: BinaryIO):
+		self.stream = stream
+		self.header = bytearray()
+		self.crc = 0
+		self.scanned = 0
+		self._position = 0
+
+	@property
+	def name(self):
+		return getattr(self.stream, "name", None)
+
+	def readable(self):
+		return True
+
+	def seekable(self):
+		return self.stream.seekable()
+
+	def seek(self, offset: int, whence: int = SEEK_SET) -> int:
+		self._position = self.stream.seek(offset, whence)
+		return self._position
+
+	def tell(self) -> int:
+		return self._position
+
+	def readinto(self, buffer) -> int:
+		data = self.stream.read(len(buffer))
+		size = len(data)
+		buffer[:size] = data
+		# Only contiguous reads from the start can be scanned
+		if self._position == self.scanned:
+			self._scan(data)
+		self._position += size
+		return size
+
+	def _scan(self, data: bytes):
+		start = self.scanned
+		if start < header_end:
+			self.header += data[max(header_start - start, 0):max(header_end - start, 0)]
+		if start + len(data) > crc_start:
+			self.crc = binascii.crc32(data[max(crc_start - start, 0):], self.crc)
+		self.scanned += len(data)
+
+	def lookup(self, check_crc: bool = False) -> Optional[ROM]:
+		""" Look up the ROM from what's been read so far, like lookup """
+		infos = lookup_header(bytes(self.header))
+		if not infos:
+			return None
+		if check_crc:
+			return match_crc(infos, self.crc, self.scanned)
+		return match_name(infos)
+
+
 def dump_info(f: BinaryIO):
 	f.seek(0x02100)
 	contents = f.read()
@@ -4,8 +4,9 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
-from time import sleep
-from typing import TYPE_CHECKING, Any, ClassVar, Dict, Optional, Tuple, Type, Union
+import sys
+import time
+from typing import TYPE_CHECKING, Any, ClassVar, Dict, Iterable, Iterator, Optional, Tuple, Type, Union
 
 from pm2hw.base import (
 	Transform, BytesOrSequence, BytesOrTransformer, BytesishOrSequence,
@@ -19,6 +20,7 @@ if TYPE_CHECKING:
 
 
 LinkerID = Union[str, Tuple[int, int]]
+ReadRequest = Tuple[BytesOrSequence, int, Optional[Transform]]
 linkers: Dict[LinkerID, Type["BaseLinker"]] = {}
 
 
@@ -30,17 +32,53 @@ class BaseLinker(BaseFlashable):
 
 	configuration: Dict[str, Tuple[str, str, Type, Any]] = {}
 
+	# Let cards detect when operations finish from the chip's status
+	status_polling = True
+
+	# Data bytes per read request and per batch of programming,
+	# 0 leaves it to the card, see BaseSstCard.calibrate
+	read_chunk_size = 0
+	write_chunk_size = 0
+
 	reader: ClassVar[Type[BaseReader]] = BaseReader
 
+	# Size of one USB request, buffered writes are flushed before exceeding it
+	transfer_size: int = 65536
+	# Appended to every write over the wire
+	write_suffix: ClassVar[bytes] = b""
+	# Buffer all writes, not just between start_buffering and end_buffering
+	combine_writes: ClassVar[bool] = False
+	# Flush a buffer older than this (seconds) before appending to it.
+	# There's no timer, whatever's left goes out on the next read, sleep, or flush
+	flush_deadline: ClassVar[float] = 0.005
+
 	_buffering = False
+	_buffer_view: Optional[memoryview] = None
+	_buffer_pos = 0
+	_buffer_since = 0.0
 
 	def __init__(self, handle: Handle, **kwargs):
 		self.handle = handle
+		# Simulated handles keep their own virtual clock
+		self.clock = getattr(handle, "clock", time)
 
 	def __del__(self):
+		# Writing to the device while the interpreter shuts down fails
+		# on modules which have been torn down already
+		if sys.is_finalizing():
+			return
+		try:
+			self.close()
+		except Exception:
+			pass
+
+	def close(self):
 		""" Clean up and close """
-		self.cleanup()
-		self.handle.close()
+		if self.handle is not None:
+			self.cleanup()
+			self.flush()
+			self.handle.close()
+			self.handle = None
 
 	def init(self) -> BaseFlashable:
 		""" Inititalize the connection to the linker """
@@ -56,30 +94,83 @@ class BaseLinker(BaseFlashable):
 
 	def read_in(self, size: int) -> bytes:
 		""" Read bytes from the queue """
+		self.flush()
 		ret = self.handle.read(size)
 		protocol("<", ret)
 		return ret
 
+	def read_into(self, view: memoryview) -> int:
+		""" Read bytes from the queue into view, return how many """
+		data = self.read_in(len(view))
+		size = len(data)
+		view[:size] = data
+		return size
+
 	def write_out(self, data: bytes):
 		""" Write bytes over the wire """
+		if self.combine_writes:
+			self._append(data)
+		else:
+			self._write(data + self.write_suffix)
+
+	def _write(self, data: bytes):
 		protocol(">", data)
 		self.handle.write(data)
 
+	def flush(self):
+		""" Write out everything which has been buffered so far """
+		pos = self._buffer_pos
+		if pos:
+			# Room for the suffix is always left in the buffer
+			end = pos + len(self.write_suffix)
+			self._buffer_view[pos:end] = self.write_suffix
+			self._buffer_pos = 0
+			self._write(bytes(self._buffer_view[:end]))
+
+	def sleep(self, secs: float):
+		""" Send anything buffered then wait """
+		self.flush()
+		self.clock.sleep(secs)
+
 	def start_buffering(self):
 		self._buffering = True
-		self._buffer = b""
 
 	def end_buffering(self):
 		self._buffering = False
-		if self._buffer:
-			self.write_out(self._buffer)
-		del self._buffer
+		self.flush()
 
-	def _write_out_or_buffer(self, data: bytes):
-		if self._buffering:
-			self._buffer += data
+	def _write_out_or_buffer(self, *data: bytes):
+		if self._buffering or self.combine_writes:
+			self._append(*data)
 		else:
-			self.write_out(data)
+			self.write_out(data[0] if len(data) == 1 else b"".join(data))
+
+	def _append(self, *data: bytes):
+		view = self._buffer_view
+		if view is None:
+			self._buffer = bytearray(self.transfer_size)
+			view = self._buffer_view = memoryview(self._buffer)
+
+		size = sum(len(d) for d in data)
+		limit = self.transfer_size - len(self.write_suffix)
+		pos = self._buffer_pos
+		if pos and (
+			pos + size > limit
+			or self.clock.time() - self._buffer_since > self.flush_deadline
+		):
+			self.flush()
+			pos = 0
+		if size > limit:
+			self._write(b"".join(data) + self.write_suffix)
+			return
+		if not pos:
+			self._buffer_since = self.clock.time()
+
+		for d in data:
+			end = pos + len(d)
+			view[pos:end] = d
+			pos = end
+		self._buffer_pos = pos
 
 	_warned = False
 	def _get_wait(self, wait: int):
@@ -90,26 +181,51 @@ class BaseLinker(BaseFlashable):
 				warn(_("log.wait.cannot.buffer"))
 				self._warned = True
 			def write_and_wait(buf: bytes):
-				self.write_out(buf)
-				sleep(wait)
+				self._write_out_or_buffer(buf)
+				self.sleep(wait)
 		elif wait and prepare_wait:
 			prepared_wait = prepare_wait(wait)
 			if not prepare_wait and not self._buffering:
-				sleep(wait)
+				self.sleep(wait)
 
 			def write_and_wait(buf: bytes):
-				self._write_out_or_buffer(buf + prepared_wait)
+				self._write_out_or_buffer(buf, prepared_wait)
 		else:
-			write_and_wait = self.write_out
+			write_and_wait = self._write_out_or_buffer
 
 		return write_and_wait
 
 	def read_data(self, data: BytesOrSequence, size: int, *, wait: int = 0, transform: Optional[Transform] = None) -> BaseReader:
 		raise NotImplementedError
 
+	def read_pipelined(self, requests: Iterable[ReadRequest], into: Optional[memoryview] = None) -> Iterator[Union[bytes, memoryview]]:
+		"""
+		Run (data, size, transform) read requests, yielding each response in order.
+		If into is given, responses are read into consecutive slices of it instead.
+		"""
+		pos = 0
+		for data, size, transform in requests:
+			reader = self.read_data(data, size, transform=transform)
+			if into is None:
+				yield reader.read()
+			else:
+				yield self._read_response_into(reader, into[pos:pos + size])
+				pos += size
+
+	@staticmethod
+	def _read_response_into(reader: BaseReader, view: memoryview) -> memoryview:
+		read_size = 0
+		while read_size < len(view):
+			res = reader.readinto(view[read_size:])
+			if not res:
+				break
+			read_size += res
+		return view[:read_size]
+
 	def send(self, data: BytesishOrSequence, *, wait: int = 0, transform: Optional[Transform] = None):
 		""" Write commands to the card """
 		write_and_wait = self._get_wait(wait)
+		transform = Transform.coerce(transform)
 		if isinstance(data, bytes) or callable(data):
 			buf = self.prepare_write(data, transform)
 			write_and_wait(buf)
@@ -123,10 +239,7 @@ class BaseLinker(BaseFlashable):
 		raise NotImplementedError
 
 	# Default transformers
-	@staticmethod
-	def noop(x: int) -> int:
-		return x
-
-	@staticmethod
-	def lsb_first(x: int) -> int:
-		return (x * 0x0202020202 & 0x010884422010) % 1023
+	noop: ClassVar[Transform] = Transform(range(256))
+	lsb_first: ClassVar[Transform] = Transform.from_function(
+		lambda x: (x * 0x0202020202 & 0x010884422010) % 1023
+	)
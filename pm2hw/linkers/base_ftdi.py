@@ -4,22 +4,42 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
-from time import sleep, time
-from typing import ClassVar, Optional, cast
+from collections import deque
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, ClassVar, Deque, Iterable, Iterator, Optional, Tuple, Union, cast
 
-from ftd2xx import FTD2XX
-
-from pm2hw.base import chunked, Transform, BytesOrSequence, BaseReader
+from pm2hw.base import Transform, BytesOrSequence, BaseReader
 from pm2hw.config import config
 from pm2hw.logger import protocol
 from pm2hw.locales import delayed_gettext as _
-from pm2hw.linkers.base import BaseLinker
+from pm2hw.linkers.base import BaseLinker, ReadRequest
 from pm2hw.exceptions import clarify, DeviceError
 
+if TYPE_CHECKING:
+	from ftd2xx import FTD2XX
+
+@dataclass
+class WaitStats:
+	waits: int = 0
+	polls: int = 0
+	secs: float = 0.0
+
+	def __str__(self):
+		return f"{self.waits} waits, {self.polls} polls, {self.secs:.3f}s"
+
 class BaseFtdiLinker(BaseLinker):
-	handle: FTD2XX
+	handle: "FTD2XX"
 
 	clock_divisor: int
+	clock_speed = 1.0  # MHz, until the MPSSE is configured
+	master_clock = 12  # MHz
+	# Divisors to try when calibrating
+	clock_divisors: ClassVar[Tuple[int, ...]] = (0, 1, 2, 3)
+	latency_timer = 255  # ms
+
+	# Bounds for sleeping between queue status polls (seconds)
+	poll_interval_min: ClassVar[float] = 50e-6
+	poll_interval_max: ClassVar[float] = 0.002
 
 	TSK_SK = 1 << 0
 	TDI_DO = 1 << 1
@@ -35,9 +55,19 @@ class BaseFtdiLinker(BaseLinker):
 	ftdi_port_state: int
 	ftdi_port_direction: ClassVar[int] = TSK_SK | TDI_DO | TMS_CS
 
-	def __init__(self, handle: FTD2XX):
+	# Send immediate, once per USB request
+	write_suffix = b"\x87"
+	combine_writes = True
+
+	# Most response bytes to have requested but not yet read when pipelining
+	read_ahead: ClassVar[int] = 65536
+	# Response bytes worth of requests to send together when pipelining
+	read_batch: ClassVar[int] = 2048
+
+	def __init__(self, handle: "FTD2XX"):
 		super().__init__(handle)
 		self.serial = handle.getDeviceInfo()["serial"]
+		self.wait_stats = WaitStats()
 
 	def init(self):
 		self.reload_config()
@@ -58,9 +88,10 @@ class BaseFtdiLinker(BaseLinker):
 			protocol(_("log.ftdi.characters.disable"))
 
 		# Set USB request transfer size to 64KiB
+		transfer_size = self.transfer_size
 		with clarify(_("exception.ftdi.transfer.size.set.failed")):
-			handle.setUSBParameters(65536, 65536)
-			protocol(_("log.ftdi.transfer.size.set"), **{"in": 65536, "out": 65536})
+			handle.setUSBParameters(transfer_size, transfer_size)
+			protocol(_("log.ftdi.transfer.size.set"), **{"in": transfer_size, "out": transfer_size})
 
 		# Sets the read and write timeouts in 10 sec
 		handle.setTimeouts(10000, 10000)
@@ -68,8 +99,8 @@ class BaseFtdiLinker(BaseLinker):
 
 		# Setup latency
 		with clarify(_("exception.ftdi.latency.set.failed")):
-			handle.setLatencyTimer(255)
-			protocol(_("log.ftdi.latency.set"), ms=255)
+			handle.setLatencyTimer(self.latency_timer)
+			protocol(_("log.ftdi.latency.set"), ms=self.latency_timer)
 
 		# Reset controller
 		with clarify(_("exception.ftdi.controller.reset.failed")):
@@ -81,7 +112,7 @@ class BaseFtdiLinker(BaseLinker):
 			handle.setBitMode(0x0, 0x2)
 			protocol(_("log.ftdi.mpsse.enable"))
 
-		sleep(0.050)
+		self.sleep(0.050)
 
 		# Check sync...
 		with clarify(_("exception.ftdi.mpsse.sync.failed")):
@@ -90,11 +121,31 @@ class BaseFtdiLinker(BaseLinker):
 		with clarify(_("exception.ftdi.mpsse.spi.failed")):
 			self.configure_mpsse_for_spi()
 
+	@property
+	def tuning_section(self) -> str:
+		""" Config section for settings calibrated for this particular linker """
+		serial = self.serial
+		if isinstance(serial, bytes):
+			serial = serial.decode(errors="replace")
+		return f"{type(self).__name__}:{serial}"
+
 	def reload_config(self):
+		tuned = self.tuning_section
 		self.clock_divisor = config.getint(
-			type(self).__name__,
+			tuned,
 			"clock-divisor",
-			fallback=self.configuration["clock-divisor"][3],
+			fallback=config.getint(
+				type(self).__name__,
+				"clock-divisor",
+				fallback=self.configuration["clock-divisor"][3],
+			),
+		)
+		self.read_chunk_size = config.getint(tuned, "read-chunk-size", fallback=0)
+		self.write_chunk_size = config.getint(tuned, "write-chunk-size", fallback=0)
+		self.status_polling = config.getboolean(
+			type(self).__name__,
+			"status-polling",
+			fallback=self.configuration["status-polling"][3],
 		)
 
 	def sync_to_mpsse(self):
@@ -125,9 +176,8 @@ class BaseFtdiLinker(BaseLinker):
 			b"\x8a"  # Use 60MHz master clock (disable divide by 5)
 			b"\x97"  # Turn off adaptive clocking
 		# 	b"\x8d"  # Disable three phase clocking
-			b"\x87"
 		)
-		sleep(0.010)
+		self.sleep(0.010)
 
 		# Check if the features were compatible with this chip
 		tmp = self.read_all()
@@ -146,12 +196,19 @@ class BaseFtdiLinker(BaseLinker):
 			0x86,  # Command
 			*self.clock_divisor.to_bytes(2, "little")
 		]))
-		self.clock_speed = (12 if slow_clock else 60) / (( 1 + self.clock_divisor) * 2)  # MHz
+		self.master_clock = 12 if slow_clock else 60  # MHz
+		self.clock_speed = self.master_clock / (( 1 + self.clock_divisor) * 2)  # MHz
 
 		# Disable loopback
 		self.write_out(b"\x85")
 		assert handle.getQueueStatus() == 0
 
+	def set_clock_divisor(self, divisor: int):
+		""" Change the SK clock once the MPSSE is configured """
+		self.write_out(b"\x86" + divisor.to_bytes(2, "little"))
+		self.clock_divisor = divisor
+		self.clock_speed = self.master_clock / (( 1 + divisor) * 2)  # MHz
+
 	def port_state(self, set: int = -1, *, on: int = 0, off: int = 0):
 		if set >= 0:
 			new_state = set
@@ -169,13 +226,13 @@ class BaseFtdiLinker(BaseLinker):
 		packet_size = self.card.packet_size
 		data = self.wait_read(packet_size * size, exact=False)
 		protocol("<", data)
-		return bytes(
-			self.card.deconstruct_packet(p)[1]
-			for p in chunked(packet_size, data)
-		)
+		return self.card.decode_packets(data)
 
-	def write_out(self, data: bytes):
-		return super().write_out(data + b"\x87")
+	def read_into(self, view: memoryview) -> int:
+		packet_size = self.card.packet_size
+		data = self.wait_read(packet_size * len(view), exact=False)
+		protocol("<", data)
+		return self.card.decode_packets_into(data, view)
 
 	def read_data(self, data: BytesOrSequence, size: int, *, wait: int = 0, transform: Optional[Transform] = None) -> BaseReader:
 		""" Write commands to the card and read the response """
@@ -185,23 +242,60 @@ class BaseFtdiLinker(BaseLinker):
 		if not wait:
 			if not isinstance(data, bytes):
 				data = b"".join(data)
-			buffer = b"\x35" + (len(data) - 1).to_bytes(2, "little") + data + b"\x87"
+			buffer = b"\x35" + (len(data) - 1).to_bytes(2, "little") + data
 			self._write_out_or_buffer(buffer)
 		else:
 			# Add waits between each read
 			write_and_wait = self._get_wait(wait)
 			if isinstance(data, bytes):
-				buffer = b"\x35" + (len(data) - 1).to_bytes(2, "little") + data + b"\x87"
+				buffer = b"\x35" + (len(data) - 1).to_bytes(2, "little") + data
 				write_and_wait(buffer)
 			else:
 				for d in data:
 					buffer = b"\x35" + (len(d) - 1).to_bytes(2, "little") + d
 					write_and_wait(buffer)
-				self._write_out_or_buffer(b"\x87")
 		return self.reader(self, size, transform)
 
+	def read_pipelined(self, requests: Iterable[ReadRequest], into: Optional[memoryview] = None) -> Iterator[Union[bytes, memoryview]]:
+		""" Keep requests in flight so the device clocks while earlier responses are decoded """
+		packet_size = self.card.packet_size
+		pending: Deque[Tuple[BaseReader, int, int]] = deque()
+		in_flight = 0
+		unsent = 0
+		pos = 0
+
+		def response(reader: BaseReader, start: int):
+			if into is None:
+				return reader.read()
+			return self._read_response_into(reader, into[start:start + len(reader)])
+
+		try:
+			for data, size, transform in requests:
+				expected = size * packet_size
+				while pending and in_flight + expected > self.read_ahead:
+					reader, start, reader_size = pending.popleft()
+					in_flight -= reader_size
+					yield response(reader, start)
+				pending.append((self.read_data(data, size, transform=transform), pos, expected))
+				in_flight += expected
+				unsent += expected
+				pos += size
+				# Send it now rather than when the response is needed,
+				# but let small requests share a USB write
+				if unsent >= self.read_batch:
+					self.flush()
+					unsent = 0
+			while pending:
+				reader, start = pending.popleft()[:2]
+				yield response(reader, start)
+		finally:
+			# Don't leave responses in the queue if the caller stopped early
+			while pending:
+				pending.popleft()[0].clear()
+
 	def read_all(self):
 		""" Read the entire input buffer """
+		self.flush()
 		size = self.handle.getQueueStatus()
 		if size:
 			ret = cast(bytes, self.handle.read(size))
@@ -210,11 +304,34 @@ class BaseFtdiLinker(BaseLinker):
 		return b""
 
 	def wait_read(self, size: int, secs: float = 20, exact: bool = True):
+		self.flush()
 		handle = self.handle
-		start = time()
-		while handle.getQueueStatus() < size and time() - start < secs:
-			pass
+		clock = self.clock
+		stats = self.wait_stats
+		start = clock.time()
+		stats.waits += 1
+
 		queued = handle.getQueueStatus()
+		stats.polls += 1
+		# Rather than spinning, sleep for about as long as the device
+		# needs to clock out what hasn't arrived, then back off up to a
+		# fraction of the latency timer, which is when the device sends regardless
+		interval = min(
+			(size - queued) * 8 / (self.clock_speed * 1e6),
+			self.latency_timer / 1000 / 4,
+		)
+		max_interval = min(self.poll_interval_max, self.latency_timer / 1000 / 4)
+		while queued < size:
+			elapsed = clock.time() - start
+			if elapsed >= secs:
+				break
+			if interval >= self.poll_interval_min:
+				clock.sleep(min(interval, secs - elapsed))
+			interval = min(max(interval * 2, self.poll_interval_min), max_interval)
+			queued = handle.getQueueStatus()
+			stats.polls += 1
+		stats.secs += clock.time() - start
+
 		if exact and queued > size:
 			raise DeviceError(
 				_("exception.read.wait.too-large").format(
@@ -33,6 +33,7 @@ class DittoFlash(BaseFtdiLinker):
 	configuration = {
 		"clock-divisor": (_("opt.clock.name"), _("opt.clock.help.dittomini"), int, clock_divisor),
 		"wait-after-write": (_("opt.wait-after-write.name"), _("opt.wait-after-write.help"), bool, wait_after_write),
+		"status-polling": (_("opt.status-polling.name"), _("opt.status-polling.help"), bool, BaseFtdiLinker.status_polling),
 	}
 
 	def init(self):
@@ -53,6 +54,8 @@ class DittoFlash(BaseFtdiLinker):
 
 	def cleanup(self):
 		self.port_state(on=self.PWR)
+		# Nothing else may come along to flush it
+		self.flush()
 
 	def detect_card(self):
 		""" Detect which card is connected """
@@ -8,7 +8,6 @@
 # Copyright (C) 2008-2013 Lupin
 
 from math import ceil
-from time import sleep
 from typing import Optional
 
 from pm2hw.base import BytesOrTransformer, Transform
@@ -32,6 +31,7 @@ class PokeFlash(BaseFtdiLinker):
 
 	configuration = {
 		"clock-divisor": (_("opt.clock.name"), _("opt.clock.help.pokecard2.1"), int, clock_divisor),
+		"status-polling": (_("opt.status-polling.name"), _("opt.status-polling.help"), bool, BaseFtdiLinker.status_polling),
 	}
 
 	def init(self):
@@ -46,7 +46,7 @@ class PokeFlash(BaseFtdiLinker):
 
 		# Set CS high and power on cart
 		self.port_state(self.TMS_CS)
-		sleep(0.010)
+		self.sleep(0.010)
 		# Set CS to low, start programming operation
 		self.port_state(0)
 
@@ -0,0 +1,366 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from math import ceil
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, NamedTuple, Optional, Type
+
+from pm2hw.carts.simulated import SimulatedCart, SimulatedDittoMiniRev3, SimulatedPokeCard512
+from pm2hw.linkers.base import BaseLinker, linkers
+
+class TimingReport(NamedTuple):
+	secs: float
+	usb_writes: int
+	usb_reads: int
+	bytes_out: int
+	bytes_in: int
+	clocked_bits: int
+	slept: float
+	chip_busy: float
+	busy_violations: int
+
+	def __sub__(self, other: "TimingReport"):
+		return TimingReport(*(a - b for a, b in zip(self, other)))
+
+
+class TimingModel:
+	"""
+	Virtual clock for a simulated linker. It charges host time for USB
+	transactions and sleeps, and device time for MPSSE clocking, so the
+	elapsed time is a projection of what the hardware would take.
+	"""
+
+	def __init__(self, high_speed: bool = False):
+		# High speed has 125 μs microframes, full speed has 1 ms frames
+		self.frame = 125e-6 if high_speed else 1e-3
+		# Practical bulk transfer rates in bytes per second
+		self.bandwidth = 30e6 if high_speed else 1e6
+
+		self.host = 0.0
+		self.device = 0.0
+		self.usb_writes = 0
+		self.usb_reads = 0
+		self.bytes_out = 0
+		self.bytes_in = 0
+		self.clocked_bits = 0
+		self.slept = 0.0
+		self.chip = None
+
+	# Clock interface used by BaseLinker.clock
+	def time(self) -> float:
+		return self.host
+
+	perf_counter = time
+
+	def sleep(self, secs: float):
+		self.host += secs
+		self.slept += secs
+
+	def wait_until(self, when: float):
+		if self.host < when:
+			self.host = when
+
+	def transfer_out(self, size: int, transfer_size: int):
+		""" Charge for sending size bytes to the device """
+		transfers = ceil(size / transfer_size)
+		self.usb_writes += transfers
+		self.bytes_out += size
+		# The command processor starts as soon as the first packet arrives
+		arrival = self.host + self.frame
+		if self.device < arrival:
+			self.device = arrival
+		self.host += transfers * self.frame + size / self.bandwidth
+
+	def transfer_in(self, size: int, since: float, delay: Optional[float] = None) -> float:
+		""" Charge for returning size bytes, return when they're available """
+		self.usb_reads += 1
+		self.bytes_in += size
+		# Responses stream back while the device is still clocking
+		sent = max(self.device, since + size / self.bandwidth)
+		return sent + (self.frame if delay is None else delay)
+
+	def clock_bits(self, bits: int, hz: float):
+		self.clocked_bits += bits
+		self.device += bits / hz
+
+	def report(self) -> TimingReport:
+		chip = self.chip
+		return TimingReport(
+			max(self.host, self.device),
+			self.usb_writes,
+			self.usb_reads,
+			self.bytes_out,
+			self.bytes_in,
+			self.clocked_bits,
+			self.slept,
+			chip.busy_time if chip else 0.0,
+			chip.busy_violations if chip else 0,
+		)
+
+	@contextmanager
+	def measure(self) -> Iterator[List[TimingReport]]:
+		"""
+		Measure the projected cost of some operations, like:
+
+		with linker.clock.measure() as result:
+			card.flash(f)
+		print(result[0].secs)
+		"""
+		result = []
+		start = self.report()
+		try:
+			yield result
+		finally:
+			result.append(self.report() - start)
+
+
+class SimulatedFtdiHandle:
+	"""
+	In-process stand-in for ftd2xx.FTD2XX which runs the subset of the
+	MPSSE command processor pm2hw uses against a simulated cart.
+	"""
+
+	# Commands only the H series understands
+	high_speed_commands = frozenset([0x8a, 0x8b, 0x8c, 0x8d, 0x96, 0x97])
+
+	def __init__(self, description: bytes, cart: SimulatedCart, *,
+		serial: bytes = b"SIM0001", high_speed: bool = False,
+		id: int = 0x04036010,
+	):
+		self.description = description
+		self.serial = serial
+		self.id = id
+		self.cart = cart
+		self.high_speed = high_speed
+		self.status = 1
+
+		self.port_low = 0
+		self.direction_low = 0
+		self.clock_divisor = 0
+		self.loopback = False
+		self.bitmode = 0
+		self.in_transfer_size = self.out_transfer_size = 4096
+		self.latency = 16
+
+		self._commands = bytearray()
+		self._queue = bytearray()
+		self._shift = bytearray()
+
+		self.clock = self.timing = TimingModel(high_speed)
+		self.timing.chip = cart.chip
+		cart.chip.timing = self.timing
+		self.master_clock = 12e6
+		# [ready time, size] of each response in the queue, oldest first
+		self._segments = deque()
+		self._unflushed = 0
+		self._unflushed_at = 0.0
+
+	@property
+	def clock_speed(self) -> float:
+		""" SK frequency in Hz """
+		return self.master_clock / ((1 + self.clock_divisor) * 2)
+
+	def getDeviceInfo(self):
+		return {
+			"type": 6 if self.high_speed else 4,
+			"id": self.id,
+			"description": self.description,
+			"serial": self.serial,
+		}
+
+	def close(self):
+		self.status = 0
+
+	def resetDevice(self):
+		self._commands.clear()
+		self._shift.clear()
+		self.bitmode = 0
+
+	def purge(self, mask: int = 0):
+		self._queue.clear()
+		self._segments.clear()
+
+	def setChars(self, evch: int, evch_en: int, erch: int, erch_en: int):
+		pass
+
+	def setUSBParameters(self, in_tx_size: int, out_tx_size: int = 0):
+		self.in_transfer_size = in_tx_size
+		self.out_transfer_size = out_tx_size or in_tx_size
+
+	def setTimeouts(self, read: int, write: int):
+		pass
+
+	def setLatencyTimer(self, latency: int):
+		self.latency = latency
+
+	def setBitMode(self, mask: int, enable: int):
+		self.bitmode = enable
+		self._commands.clear()
+
+	def _available(self) -> int:
+		host = self.timing.host
+		return sum(size for ready, size in self._segments if ready <= host)
+
+	def getQueueStatus(self) -> int:
+		segments = self._segments
+		if segments:
+			# Block until the device would have sent the oldest response
+			self.timing.wait_until(segments[0][0])
+		return self._available()
+
+	def read(self, nchars: int, raw: bool = True) -> bytes:
+		# Block until nchars have arrived or everything queued has
+		needed = nchars
+		for segment in self._segments:
+			self.timing.wait_until(segment[0])
+			needed -= segment[1]
+			if needed <= 0:
+				break
+
+		ret = bytes(self._queue[:nchars])
+		del self._queue[:nchars]
+		consumed = len(ret)
+		segments = self._segments
+		while consumed and segments:
+			if segments[0][1] <= consumed:
+				consumed -= segments.popleft()[1]
+			else:
+				segments[0][1] -= consumed
+				consumed = 0
+		return ret
+
+	def write(self, data: bytes) -> int:
+		self.timing.transfer_out(len(data), self.out_transfer_size)
+		self._commands += data
+		if self.bitmode == 0x2:
+			self._process()
+			if self._unflushed:
+				# No send immediate, so it waits on the latency timer
+				self._send_response(self.latency / 1000)
+		else:
+			self._commands.clear()
+		return len(data)
+
+	def _queue_response(self, data: bytes, since: Optional[float] = None):
+		if not self._unflushed:
+			self._unflushed_at = self.timing.device if since is None else since
+		self._unflushed += len(data)
+		self._queue += data
+
+	def _send_response(self, delay: Optional[float] = None):
+		ready = self.timing.transfer_in(self._unflushed, self._unflushed_at, delay)
+		segments = self._segments
+		if segments and segments[-1][0] > ready:
+			# Responses arrive in order
+			ready = segments[-1][0]
+		segments.append([ready, self._unflushed])
+		self._unflushed = 0
+
+	def _process(self):
+		cmds = self._commands
+		pos = 0
+		end = len(cmds)
+		while pos < end:
+			cmd = cmds[pos]
+			if cmd in (0x11, 0x35):
+				if end - pos < 3:
+					break
+				length = int.from_bytes(cmds[pos + 1:pos + 3], "little") + 1
+				if end - pos < 3 + length:
+					break
+				start = self.timing.device
+				response = self._clock_out(cmds[pos + 3:pos + 3 + length])
+				if cmd == 0x35:
+					self._queue_response(response, start)
+				pos += 3 + length
+			elif cmd in (0x80, 0x82, 0x86, 0x8f):
+				if end - pos < 3:
+					break
+				arg = int.from_bytes(cmds[pos + 1:pos + 3], "little")
+				if cmd == 0x80:
+					self.port_low, self.direction_low = cmds[pos + 1:pos + 3]
+				elif cmd == 0x86:
+					self.clock_divisor = arg
+				elif cmd == 0x8f:
+					self.timing.clock_bits((arg + 1) * 8, self.clock_speed)
+				pos += 3
+			elif cmd == 0x8e:
+				if end - pos < 2:
+					break
+				self.timing.clock_bits(cmds[pos + 1] + 1, self.clock_speed)
+				pos += 2
+			elif cmd in (0x81, 0x83):
+				# Bit 7 of the low byte is the cart's VCC, which is off
+				self._queue_response(bytes([self.port_low & 0x7f if cmd == 0x81 else 0]))
+				pos += 1
+			elif cmd in (0x84, 0x85):
+				self.loopback = cmd == 0x84
+				pos += 1
+			elif cmd == 0x87:
+				if self._unflushed:
+					self._send_response()
+				pos += 1
+			elif self.high_speed and cmd in self.high_speed_commands:
+				if cmd in (0x8a, 0x8b):
+					self.master_clock = 60e6 if cmd == 0x8a else 12e6
+				pos += 1
+			else:
+				# Bad command
+				self._queue_response(bytes([0xfa, cmd]))
+				pos += 1
+		del cmds[:pos]
+
+	def _clock_out(self, data: bytes) -> bytes:
+		timing = self.timing
+		hz = self.clock_speed
+		if self.loopback:
+			timing.clock_bits(len(data) * 8, hz)
+			return bytes(data)
+
+		packet_size = self.cart.packet_size
+		packet_bits = packet_size * 8
+		shift = self._shift
+		shift += data
+		ret = bytearray()
+		full = len(shift) - len(shift) % packet_size
+		for i in range(0, full, packet_size):
+			timing.clock_bits(packet_bits, hz)
+			ret += self.cart.transfer(bytes(shift[i:i + packet_size]))
+		del shift[:full]
+		# Any partial packet clocks back zeros until it's complete
+		size = len(data)
+		if len(ret) < size:
+			ret += bytes(size - len(ret))
+		return bytes(ret[-size:])
+
+
+simulated_carts: Dict[str, Type[SimulatedCart]] = {
+	"DittoFlash": SimulatedDittoMiniRev3,
+	"PokeFlash": SimulatedPokeCard512,
+}
+
+
+def open_simulated(name: str, cart: Optional[SimulatedCart] = None, **kwargs) -> BaseLinker:
+	""" Create a linker by class name which talks to a simulated device """
+	for desc, linker_cls in linkers.items():
+		if linker_cls.__name__.lower() == name.lower():
+			break
+	else:
+		raise KeyError(name)
+
+	name = linker_cls.__name__
+	if cart is None:
+		cart = simulated_carts[name]()
+	kwargs.setdefault("high_speed", name == "PokeFlash")
+	return linker_cls(SimulatedFtdiHandle(desc, cart, **kwargs))
+
+
+def get_simulated_linkers(names: List[str]) -> List[BaseLinker]:
+	return [
+		open_simulated(name, serial=f"SIM{i:04d}".encode())
+		for i, name in enumerate(names, 1)
+	]
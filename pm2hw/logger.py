@@ -8,6 +8,7 @@ from functools import wraps
 import time
 import logging
 import configparser
+import logging.handlers
 from typing import Sequence, Set
 from logging import NOTSET, DEBUG, INFO, WARN, WARNING, ERROR, CRITICAL, LogRecord, _levelToName, _nameToLevel
 
@@ -79,6 +80,9 @@ class SubtypedMessage(metaclass=strlike):
 	def subtype(self):
 		return self._subtype
 
+	def __reduce_ex__(self, protocol):
+		return (SubtypedMessage, (str(self._msg), self._subtype))
+
 class Formatter(logging.Formatter):
 	default_time_format = "%H:%M:%S"
 	default_msec_format = "%s.%03d"
@@ -329,6 +333,59 @@ class progress(SubtypedMessage):
 			**self.kwargs
 		)
 
+	def __reduce_ex__(self, protocol):
+		return (progress_snapshot, (str(self), self.current, self.end, self.created, self.updated))
+
+class progress_snapshot(progress):
+	""" How a progress message looked when it was sent from another process """
+
+	def __init__(self, text: str, current: int, end: int, created: float, updated: float):
+		SubtypedMessage.__init__(self, text, "PROGRESS")
+		self.current = current
+		self.end = end
+		self.percent = current * 100 / end if end else 0
+		self.created = created
+		self.updated = updated
+
+	def __str__(self):
+		return self._msg
+
+	def __reduce_ex__(self, protocol):
+		return (progress_snapshot, (self._msg, self.current, self.end, self.created, self.updated))
+
+class QueueHandler(logging.handlers.QueueHandler):
+	""" Send records to another process, keeping their message types """
+	# Least time between sending updates of the same progress message
+	progress_interval = 0.1
+
+	def __init__(self, queue):
+		super().__init__(queue)
+		self._progress_sent = {}
+
+	def filter(self, record: LogRecord) -> bool:
+		msg = record.msg
+		if isinstance(msg, progress) and not (msg.current == 0 or msg.is_complete()):
+			if msg.updated - self._progress_sent.get(id(msg), 0) < self.progress_interval:
+				return False
+			self._progress_sent[id(msg)] = msg.updated
+		return super().filter(record)
+
+	def prepare(self, record: LogRecord) -> LogRecord:
+		record = logging.makeLogRecord(record.__dict__)
+		if record.args:
+			record.msg = record.getMessage()
+			record.args = None
+		if record.exc_info:
+			record.exc_text = nice_formatter.formatException(record.exc_info)
+			record.exc_info = None
+		return record
+
+def forward_to(queue):
+	""" Send every record to queue instead of this process's handlers """
+	for handler in list(logger.handlers):
+		remove_handler(handler)
+	add_handler(QueueHandler(queue))
+
 def warn(msg, **kwargs):
 	logger.warn(msg.format(**kwargs))
 
@@ -0,0 +1,204 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import pickle
+import multiprocessing
+from queue import Empty
+from threading import Thread
+from time import perf_counter
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Union
+
+from pm2hw import logger
+from pm2hw.base import BaseFlashable
+from pm2hw.linkers import BaseLinker
+from pm2hw.logger import LogRecord, error, log
+from pm2hw.locales import delayed_gettext as _, natural_size
+from pm2hw.exceptions import DeviceError
+
+Job = Callable[[BaseFlashable], int]
+# One job for every flashable, or a list of one for each
+Jobs = Union[Job, Sequence[Job]]
+
+class JobResult(NamedTuple):
+	flashable: BaseFlashable
+	# Bytes handled, for throughput
+	size: int
+	secs: float
+	error: Optional[BaseException] = None
+
+	@property
+	def name(self) -> str:
+		return getattr(self.flashable, "linker", self.flashable).name
+
+
+class LinkerSpec(NamedTuple):
+	""" What another process needs to open a linker again """
+	classname: str
+	serial: bytes
+	simulated: bool
+
+	@classmethod
+	def of(cls, linker: BaseLinker) -> "LinkerSpec":
+		from pm2hw.linkers.simulated import SimulatedFtdiHandle
+		return cls(type(linker).__name__, linker.serial, isinstance(linker.handle, SimulatedFtdiHandle))
+
+	def open(self) -> BaseLinker:
+		if self.simulated:
+			from pm2hw.linkers.simulated import open_simulated
+			return open_simulated(self.classname, serial=self.serial)
+
+		import ftd2xx
+		from pm2hw.linkers import linkers_by_classname
+		from pm2hw.exceptions import clarify
+		with clarify(_("exception.device.open.failed")):
+			dev = ftd2xx.openEx(self.serial)
+		return linkers_by_classname[self.classname](dev)
+
+
+def run_all(
+	flashables: Sequence[BaseFlashable],
+	job: Jobs,
+	*,
+	parallel: bool = True,
+	processes: bool = False,
+) -> List[JobResult]:
+	"""
+	Run job on every flashable, at once with each on its own thread unless
+	parallel is off. The job returns how many bytes it handled. An error on
+	one device doesn't stop the others, it's kept in that device's result.
+	A list of jobs gives each flashable its own, in the same order.
+
+	With processes, each linker is closed here and opened again in its own
+	process instead, so encoding and decoding packets for one linker doesn't
+	hold up the others. The job must then be picklable, and anything it
+	produces has to go through files.
+	"""
+	if processes and parallel and len(flashables) > 1:
+		return run_in_processes(flashables, job)
+
+	jobs = _jobs_for(flashables, job)
+	results: List[Optional[JobResult]] = [None] * len(flashables)
+
+	def worker(i: int, flashable: BaseFlashable):
+		start = perf_counter()
+		try:
+			size = jobs[i](flashable)
+		except Exception as err:
+			results[i] = JobResult(flashable, 0, perf_counter() - start, err)
+		else:
+			results[i] = JobResult(flashable, size or 0, perf_counter() - start)
+
+	if len(flashables) == 1 or not parallel:
+		for i, flashable in enumerate(flashables):
+			worker(i, flashable)
+	else:
+		threads = [
+			Thread(target=worker, args=(i, flashable), name=f"pm2hw-{i}")
+			for i, flashable in enumerate(flashables)
+		]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+	return results
+
+
+def _jobs_for(flashables: Sequence[BaseFlashable], job: Jobs) -> Sequence[Job]:
+	if callable(job):
+		return [job] * len(flashables)
+	return job
+
+
+def _process_worker(index: int, spec: LinkerSpec, job: Job, queue, level: int):
+	""" Run in a worker process, which sends log records and then (index, size, secs, error) """
+	logger.forward_to(queue)
+	logger.set_level(level)
+	start = perf_counter()
+	try:
+		size = job(spec.open().init())
+	except Exception as err:
+		try:
+			pickle.dumps(err)
+		except Exception:
+			err = DeviceError(str(err))
+		queue.put((index, 0, perf_counter() - start, err))
+	else:
+		queue.put((index, size or 0, perf_counter() - start, None))
+
+
+def run_in_processes(flashables: Sequence[BaseFlashable], job: Jobs) -> List[JobResult]:
+	""" Run job on every flashable, each in its own process, see run_all """
+	jobs = _jobs_for(flashables, job)
+	results: List[Optional[JobResult]] = [None] * len(flashables)
+	ctx = multiprocessing.get_context()
+	queue = ctx.Queue()
+	procs = []
+	for i, flashable in enumerate(flashables):
+		linker: BaseLinker = getattr(flashable, "linker", flashable)
+		spec = LinkerSpec.of(linker)
+		# Only one handle can have the device open
+		linker.close()
+		proc = ctx.Process(
+			target=_process_worker,
+			args=(i, spec, jobs[i], queue, logger.get_effective_level()),
+			name=f"pm2hw-{i}",
+			daemon=True,
+		)
+		proc.start()
+		procs.append(proc)
+
+	# Workers which exited without a result, given one more wait to arrive
+	missing: Dict[int, int] = {}
+	while any(r is None for r in results):
+		try:
+			msg = queue.get(timeout=0.5)
+		except Empty:
+			for i, proc in enumerate(procs):
+				if results[i] is None and proc.exitcode is not None:
+					if i in missing:
+						results[i] = JobResult(flashables[i], 0, 0, DeviceError(
+							_("exception.worker.exited").format(code=proc.exitcode)
+						))
+					else:
+						missing[i] = proc.exitcode
+			continue
+
+		if isinstance(msg, LogRecord):
+			logger.logger.handle(msg)
+		else:
+			i, size, secs, err = msg
+			results[i] = JobResult(flashables[i], size, secs, err)
+
+	for proc in procs:
+		proc.join()
+	return results
+
+
+def summarize(results: List[JobResult], secs: float):
+	""" Log how each device did and the combined throughput """
+	total = 0
+	for result in results:
+		if result.error is not None:
+			error(_("cli.summary.failed"), name=result.name, errmsg=str(result.error))
+		else:
+			total += result.size
+			log(_("cli.summary.device"),
+				name=result.name,
+				size=natural_size(result.size),
+				secs=result.secs,
+				rate=natural_size(int(result.size / result.secs)) if result.secs else "-",
+			)
+	log(_("cli.summary.total"),
+		size=natural_size(total),
+		secs=secs,
+		rate=natural_size(int(total / secs)) if secs else "-",
+	)
+
+
+def raise_first(results: List[JobResult]):
+	for result in results:
+		if result.error is not None:
+			raise result.error
@@ -0,0 +1,79 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from pathlib import Path
+from typing import Callable
+
+import pytest
+
+def build_messages():
+	""" Compile the message catalogs like the build does, if they're out of date """
+	from babel.messages.mofile import write_mo
+	from babel.messages.pofile import read_po
+
+	locales = Path(__file__).parent.parent / "pm2hw" / "locales"
+	for po in locales.glob("*/LC_MESSAGES/pm2hw.po"):
+		mo = po.with_suffix(".mo")
+		if mo.exists() and mo.stat().st_mtime >= po.stat().st_mtime:
+			continue
+		with po.open("rt", encoding="UTF-8") as f:
+			catalog = read_po(f, po.parts[-3], po.stem)
+		with mo.open("wb") as f:
+			write_mo(f, catalog)
+
+# Before anything is translated
+build_messages()
+
+from pm2hw.carts import cache, journal
+from pm2hw.carts.base_sst import BaseSstCard
+from pm2hw.linkers.simulated import open_simulated
+
+linker_names = ["PokeFlash", "DittoFlash"]
+
+
+@pytest.fixture(autouse=True)
+def state_dirs(tmp_path, monkeypatch):
+	""" Keep sector caches and journals out of the user's config dir """
+	monkeypatch.setattr(cache, "cache_dir", tmp_path / "cache")
+	monkeypatch.setattr(journal, "journal_dir", tmp_path / "journal")
+
+
+@pytest.fixture(params=linker_names)
+def linker_name(request) -> str:
+	return request.param
+
+
+@pytest.fixture
+def make_card(linker_name) -> Callable[..., BaseSstCard]:
+	""" Connect to a simulated linker, optionally with a given cart """
+	opened = []
+
+	def make_card(cart=None) -> BaseSstCard:
+		linker = open_simulated(linker_name, cart)
+		opened.append(linker)
+		return linker.init()
+
+	yield make_card
+	for linker in opened:
+		linker.close()
+
+
+@pytest.fixture
+def card(make_card) -> BaseSstCard:
+	return make_card()
+
+
+@pytest.fixture
+def reconnect(make_card) -> Callable[[BaseSstCard], BaseSstCard]:
+	""" Connect to the same cart again through a new linker """
+	def reconnect(card: BaseSstCard) -> BaseSstCard:
+		cart = card.linker.handle.cart
+		# The new linker's clock starts over
+		cart.chip.reset()
+		cart.chip.busy_until = 0
+		return make_card(cart)
+
+	return reconnect
@@ -0,0 +1,42 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import random
+from io import BytesIO
+from typing import Optional
+
+from pm2hw.carts.base import BaseCard
+from pm2hw.carts.simulated import SimulatedSstChip
+
+class FakeClock:
+	""" Stands in for the time module, time only passes when a test says so """
+
+	def __init__(self):
+		self.now = 0.0
+
+	def time(self) -> float:
+		return self.now
+
+	perf_counter = time
+
+	def sleep(self, secs: float):
+		self.now += secs
+
+
+def chip_of(card: BaseCard) -> SimulatedSstChip:
+	""" The simulated chip behind a card """
+	return card.linker.handle.cart.chip
+
+
+def make_rom(size: int, seed: Optional[int] = None) -> bytes:
+	rand = random.Random(seed or size)
+	return bytes(rand.getrandbits(8) for _ in range(size))
+
+
+def dump(card: BaseCard, size: int, offset: int = 0) -> bytes:
+	out = BytesIO()
+	card.dump(out, offset=offset, size=size)
+	return out.getvalue()
@@ -0,0 +1,114 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import asyncio
+from io import BytesIO
+
+import pytest
+
+from pm2hw.aio import AsyncLinker
+from pm2hw.linkers.simulated import get_simulated_linkers, open_simulated
+
+from tests.helpers import make_rom
+
+def run(coro):
+	return asyncio.run(coro)
+
+
+def test_flash_and_dump_with_progress(linker_name):
+	async def main():
+		alinker = AsyncLinker(open_simulated(linker_name))
+		card = await alinker.init()
+		rom = make_rom(3 * card.card.block_size)
+
+		operation = card.flash(BytesIO(rom))
+		updates = [update async for update in operation]
+		await operation
+
+		out = BytesIO()
+		await card.dump(out, size=len(rom))
+		await alinker.close()
+		return rom, updates, out.getvalue()
+
+	rom, updates, dumped = run(main())
+	assert dumped == rom
+	assert updates
+	assert updates[-1].current == updates[-1].end
+	assert updates[-1].percent == 100
+
+
+def test_read_data(linker_name):
+	async def main():
+		alinker = AsyncLinker(open_simulated(linker_name))
+		card = await alinker.init()
+		rom = make_rom(2 * card.card.block_size)
+		await card.flash(BytesIO(rom))
+
+		operation = card.read_data(0, len(rom))
+		updates = [update async for update in operation]
+		data = await operation
+		await alinker.close()
+		return rom, updates, data
+
+	rom, updates, data = run(main())
+	assert data == rom
+	assert [u.stage for u in updates] == ["read"] * len(updates)
+	assert updates[-1].current == len(rom)
+
+
+def test_several_linkers_at_once():
+	async def main():
+		alinkers = [AsyncLinker(linker) for linker in get_simulated_linkers(["PokeFlash", "DittoFlash"])]
+		cards = await asyncio.gather(*(alinker.init() for alinker in alinkers))
+		rom = make_rom(0x4000)
+		await asyncio.gather(*(card.flash(BytesIO(rom)) for card in cards))
+		dumps = await asyncio.gather(*(card.read_data(0, len(rom)) for card in cards))
+		for alinker in alinkers:
+			await alinker.close()
+		return rom, dumps
+
+	rom, dumps = run(main())
+	assert dumps == [rom, rom]
+
+
+def test_timeout_leaves_the_linker_ready(linker_name):
+	async def main():
+		alinker = AsyncLinker(open_simulated(linker_name))
+		card = await alinker.init()
+		rom = make_rom(card.card.block_size)
+		await card.flash(BytesIO(rom))
+
+		with pytest.raises(asyncio.TimeoutError):
+			await card.dump(BytesIO(), timeout=0.001)
+		data = await card.read_data(0, len(rom))
+		await alinker.close()
+		return rom, data
+
+	rom, data = run(main())
+	assert data == rom
+
+
+def test_cancel_leaves_the_linker_ready(linker_name):
+	async def main():
+		alinker = AsyncLinker(open_simulated(linker_name))
+		card = await alinker.init()
+		rom = make_rom(card.card.block_size)
+		await card.flash(BytesIO(rom))
+
+		operation = card.dump(BytesIO())
+		task = asyncio.ensure_future(operation.result())
+		async for update in operation:
+			# Stop once it's started
+			task.cancel()
+			break
+		with pytest.raises(asyncio.CancelledError):
+			await task
+		data = await card.read_data(0, len(rom))
+		await alinker.close()
+		return rom, data
+
+	rom, data = run(main())
+	assert data == rom
@@ -0,0 +1,164 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from io import BytesIO
+from typing import List
+
+import pytest
+
+from pm2hw.linkers.base import BaseLinker
+from pm2hw.linkers.simulated import open_simulated
+
+from tests.helpers import FakeClock, dump, make_rom
+
+class RecordingHandle:
+	def __init__(self):
+		self.clock = FakeClock()
+		self.writes: List[bytes] = []
+
+	def write(self, data: bytes) -> int:
+		self.writes.append(bytes(data))
+		return len(data)
+
+	def read(self, size: int) -> bytes:
+		return b""
+
+	def close(self):
+		pass
+
+
+class RecordingLinker(BaseLinker):
+	name = "Recording"
+	transfer_size = 64
+	write_suffix = b"!"
+
+	def prepare_write(self, data, transform=None) -> bytes:
+		return data
+
+
+class CombiningLinker(RecordingLinker):
+	combine_writes = True
+
+
+@pytest.fixture
+def linker() -> RecordingLinker:
+	return RecordingLinker(RecordingHandle())
+
+
+@pytest.fixture
+def combining() -> CombiningLinker:
+	return CombiningLinker(RecordingHandle())
+
+
+def test_unbuffered_writes_go_out_right_away(linker):
+	linker.send(b"abc")
+	linker.send(b"def")
+	assert linker.handle.writes == [b"abc!", b"def!"]
+
+def test_buffered_writes_go_out_together(linker):
+	linker.start_buffering()
+	linker.send(b"abc")
+	linker.send([b"de", b"f"])
+	assert linker.handle.writes == []
+	linker.end_buffering()
+	assert linker.handle.writes == [b"abcdef!"]
+
+def test_buffer_is_flushed_before_exceeding_the_transfer_size(linker):
+	chunks = [bytes([i]) * 10 for i in range(20)]
+	linker.start_buffering()
+	linker.send(chunks)
+	linker.end_buffering()
+
+	writes = linker.handle.writes
+	assert len(writes) > 1
+	assert all(len(w) <= linker.transfer_size and w.endswith(b"!") for w in writes)
+	# Nothing was split or reordered
+	assert b"".join(w[:-1] for w in writes) == b"".join(chunks)
+
+def test_oversized_write_goes_out_on_its_own(linker):
+	linker.start_buffering()
+	linker.send(b"a" * 10)
+	linker.send(b"b" * 100)
+	linker.end_buffering()
+	assert linker.handle.writes == [b"a" * 10 + b"!", b"b" * 100 + b"!"]
+
+def test_buffer_can_be_reused(linker):
+	for data in (b"first", b"second"):
+		linker.start_buffering()
+		linker.send(data)
+		linker.end_buffering()
+	assert linker.handle.writes == [b"first!", b"second!"]
+
+def test_combined_writes_wait_for_a_flush(combining):
+	combining.write_out(b"abc")
+	combining.send(b"def")
+	assert combining.handle.writes == []
+	combining.flush()
+	assert combining.handle.writes == [b"abcdef!"]
+
+def test_reading_and_sleeping_flush_first(combining):
+	combining.write_out(b"abc")
+	combining.read_in(1)
+	combining.write_out(b"def")
+	combining.sleep(0.001)
+	assert combining.handle.writes == [b"abc!", b"def!"]
+
+def test_writes_held_past_the_deadline_go_out_first(combining):
+	clock = combining.handle.clock
+	combining.write_out(b"abc")
+	clock.sleep(combining.flush_deadline / 2)
+	combining.write_out(b"def")
+	assert combining.handle.writes == []
+
+	clock.sleep(combining.flush_deadline)
+	combining.write_out(b"ghi")
+	assert combining.handle.writes == [b"abcdef!"]
+	combining.flush()
+	assert combining.handle.writes == [b"abcdef!", b"ghi!"]
+
+def test_combined_writes_respect_the_transfer_size(combining):
+	for i in range(20):
+		combining.write_out(bytes([i]) * 10)
+	combining.flush()
+	writes = combining.handle.writes
+	assert all(len(w) <= combining.transfer_size for w in writes)
+	assert b"".join(w[:-1] for w in writes) == b"".join(bytes([i]) * 10 for i in range(20))
+
+def test_ftdi_requests_end_in_one_send_immediate(card):
+	handle = card.linker.handle
+	writes = []
+	write = handle.write
+	def recording(data: bytes) -> int:
+		writes.append(bytes(data))
+		return write(data)
+
+	handle.write = recording
+	rom = make_rom(card.block_size)
+	card.flash(BytesIO(rom))
+	assert dump(card, len(rom)) == rom
+	assert writes and all(w.endswith(b"\x87") for w in writes)
+
+def test_cleanup_isnt_left_in_the_buffer():
+	linker = open_simulated("DittoFlash")
+	linker.init()
+	handle = linker.handle
+	writes = []
+	write = handle.write
+	def recording(data: bytes) -> int:
+		writes.append(bytes(data))
+		return write(data)
+
+	handle.write = recording
+	linker.cleanup()
+	assert writes
+	assert linker._buffer_pos == 0
+
+def test_del_ignores_errors_from_closing(linker):
+	def close():
+		raise OSError("gone")
+
+	linker.close = close
+	linker.__del__()
@@ -0,0 +1,126 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from io import BytesIO
+from typing import List
+
+from pm2hw.carts.cache import SectorCache
+
+from tests.helpers import chip_of, dump, make_rom
+
+def record_reads(card) -> List[int]:
+	""" Collect the address of each byte read from the chip """
+	chip = chip_of(card)
+	reads = []
+	read = chip.read
+
+	def recording_read(addr: int) -> int:
+		reads.append(addr)
+		return read(addr)
+
+	chip.read = recording_read
+	return reads
+
+
+def test_record_and_match_whole_sectors():
+	cache = SectorCache(None, 0x10)
+	data = make_rom(0x40)
+	cache.record(0x10, data)
+	assert cache.matches(0x10, data)
+	assert cache.matches(0x20, data[0x10:0x20])
+	assert not cache.matches(0x10, data[:0x30] + bytes(0x10))
+	# Sectors must be covered whole to match
+	assert not cache.matches(0x10, data[:0x18])
+
+
+def test_record_forgets_partially_covered_sectors():
+	cache = SectorCache(None, 0x10)
+	cache.record(0, make_rom(0x30))
+	cache.record(0x08, bytes(0x10))
+	assert cache.get(0) is None
+	assert cache.get(1) is None
+	assert cache.get(2) is not None
+
+
+def test_invalidate():
+	cache = SectorCache(None, 0x10)
+	cache.record(0, make_rom(0x40))
+	cache.invalidate(0x18, 0x10)
+	assert [cache.get(i) is not None for i in range(4)] == [True, False, False, True]
+	cache.invalidate()
+	assert cache.sectors == {}
+
+
+def test_saved_and_loaded(tmp_path, monkeypatch):
+	from pm2hw.carts import cache as cache_module
+	monkeypatch.setattr(cache_module, "cache_dir", tmp_path)
+	path = tmp_path / "card.json"
+	data = make_rom(0x20)
+
+	cache = SectorCache(path, 0x10)
+	cache.record(0, data)
+	cache.save()
+	assert SectorCache(path, 0x10).matches(0, data)
+	# Hashes of different sized sectors don't mean anything
+	assert SectorCache(path, 0x20).sectors == {}
+
+
+def test_verify_skips_known_sectors(card):
+	rom = make_rom(4 * card.sector_size)
+	card.flash(BytesIO(rom))
+	assert dump(card, len(rom)) == rom
+
+	reads = record_reads(card)
+	assert card.verify(BytesIO(rom))
+	assert reads == []
+
+
+def test_writing_forgets_the_sectors_it_touches(card):
+	sector = card.sector_size
+	rom = make_rom(2 * sector)
+	card.flash(BytesIO(rom))
+	dump(card, len(rom))
+
+	card.write_data(sector + 5, b"\x00")
+	assert card.cache.matches(0, rom[:sector])
+	assert not card.cache.matches(sector, rom[sector:])
+
+
+def test_cache_is_dropped_for_another_card(card, reconnect):
+	rom = make_rom(2 * card.sector_size)
+	card.flash(BytesIO(rom))
+	assert card.verify(BytesIO(rom))
+	card.cache.save()
+
+	# Same linker and chip, different contents
+	chip = chip_of(card)
+	chip.array[:] = bytes(len(chip.array))
+	other = reconnect(card)
+	assert not other.cache.matches(0, rom[:card.sector_size])
+	assert not other.verify(BytesIO(rom))
+
+
+def test_unverified_flash_isnt_trusted(card):
+	# A chip which ignores programming
+	chip = chip_of(card)
+	chip.program = lambda addr, data: chip.start_operation(chip.T_BP, data)
+
+	rom = make_rom(2 * card.sector_size)
+	card.flash(BytesIO(rom))
+	assert not card.verify(BytesIO(rom))
+
+
+def test_erase_isnt_trusted(card):
+	rom = make_rom(2 * card.sector_size)
+	card.flash(BytesIO(rom))
+	dump(card, len(rom))
+
+	# A chip which ignores erasing
+	chip_of(card).erase = lambda addr, size: None
+	card.erase(size=card.sector_size)
+	assert not card.verify(BytesIO(b"\xff" * card.sector_size))
+
+
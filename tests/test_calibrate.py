@@ -0,0 +1,56 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from io import BytesIO
+
+import pytest
+
+from pm2hw.carts import base_sst
+from pm2hw.config import config
+
+from tests.helpers import dump, make_rom
+
+@pytest.fixture
+def tuning(card, monkeypatch) -> str:
+	""" Keep calibrated settings out of the user's config file """
+	monkeypatch.setattr(base_sst, "save_config", lambda: None)
+	section = card.linker.tuning_section
+	yield section
+	config.remove_section(section)
+
+
+def test_calibrate_saves_settings_for_this_linker(card, tuning):
+	divisor, read_chunk, write_chunk = card.calibrate(size=0x4000)
+	assert divisor in card.linker.clock_divisors
+	assert config.getint(tuning, "clock-divisor") == divisor
+	assert config.getint(tuning, "read-chunk-size") == read_chunk
+	assert config.getint(tuning, "write-chunk-size") == write_chunk
+
+	# The linker uses them from now on
+	assert card.linker.clock_divisor == divisor
+	assert card.linker.read_chunk_size == read_chunk
+	assert card.linker.write_chunk_size == write_chunk
+
+
+def test_calibrate_doesnt_pick_smaller_chunks_than_the_defaults(card, tuning):
+	divisor, read_chunk, write_chunk = card.calibrate(size=0x4000)
+	# Ties between chunk sizes are common, and smaller ones aren't better
+	assert read_chunk >= card.read_chunk_size
+	assert write_chunk >= card.write_chunk_size
+
+
+def test_calibrate_keeps_the_cards_contents(card, tuning):
+	rom = make_rom(0x4000)
+	card.flash(BytesIO(rom))
+	card.calibrate(size=0x4000)
+	assert dump(card, len(rom)) == rom
+
+
+def test_tuning_section_is_per_linker(card):
+	serial = card.linker.serial
+	if isinstance(serial, bytes):
+		serial = serial.decode()
+	assert card.linker.tuning_section == f"{type(card.linker).__name__}:{serial}"
@@ -0,0 +1,130 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import logging
+import sys
+import socket
+from io import BytesIO
+from threading import Thread
+from typing import List
+
+import pytest
+
+from pm2hw import daemon
+from pm2hw.logger import log
+from pm2hw.linkers.simulated import open_simulated
+
+from tests.helpers import chip_of, make_rom
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="needs Unix sockets")
+
+@pytest.fixture
+def daemon_dir(tmp_path, monkeypatch):
+	""" Keep the socket and key out of the user's config dir """
+	monkeypatch.setattr(daemon, "config_dir", tmp_path)
+	monkeypatch.setattr(daemon, "key_file", tmp_path / "daemon.key")
+	return tmp_path
+
+
+def echo(argv: List[str]) -> int:
+	""" Stands in for the CLI: copies stdin to stdout and exits with the argument """
+	log("running in {cwd}", cwd=os.getcwd())
+	sys.stdout.buffer.write(sys.stdin.buffer.read())
+	return int(argv[0])
+
+
+@pytest.fixture
+def serving(daemon_dir):
+	""" Run a daemon on a thread until the test ends """
+	server = daemon.Daemon([])
+	thread = Thread(target=server.serve, args=(echo,), daemon=True)
+	thread.start()
+	for _ in range(100):
+		if os.path.exists(daemon.address()) and daemon.key_file.exists():
+			break
+		thread.join(0.05)
+	yield server
+	daemon.stop()
+	thread.join(5)
+	assert not thread.is_alive()
+
+
+def test_no_daemon(daemon_dir):
+	assert daemon.connect() is None
+	assert daemon.request(["0"]) is None
+	assert not daemon.stop()
+
+
+def test_request_round_trip(serving, tmp_path, monkeypatch, capsysbinary, caplog):
+	cwd = tmp_path / "work"
+	cwd.mkdir()
+	monkeypatch.chdir(cwd)
+	with caplog.at_level(logging.INFO, logger="pm2hw"):
+		assert daemon.request(["3"], BytesIO(b"some rom")) == 3
+	assert capsysbinary.readouterr().out == b"some rom"
+	assert f"running in {cwd}" in caplog.text
+
+
+def test_stdin_is_streamed_in_chunks(serving, capsysbinary):
+	rom = make_rom(5 * daemon._ConnectionReader.chunk_size + 123)
+	sizes = []
+
+	class Stdin(BytesIO):
+		def read(self, size=-1):
+			sizes.append(size)
+			return super().read(size)
+
+	assert daemon.request(["0"], Stdin(rom)) == 0
+	assert capsysbinary.readouterr().out == rom
+	assert 0 < max(sizes) <= daemon._ConnectionReader.chunk_size
+
+
+def test_stdin_is_empty_without_a_stream(serving, capsysbinary):
+	assert daemon.request(["0"]) == 0
+	assert capsysbinary.readouterr().out == b""
+
+
+def test_stop(daemon_dir):
+	server = daemon.Daemon([])
+	thread = Thread(target=server.serve, args=(echo,), daemon=True)
+	thread.start()
+	for _ in range(100):
+		if daemon.connect() is not None:
+			break
+		thread.join(0.05)
+	assert daemon.stop()
+	thread.join(5)
+	assert not thread.is_alive()
+	# It cleans up after itself
+	assert not daemon.key_file.exists()
+
+
+def test_linkers_stay_initialized():
+	linker = open_simulated("DittoFlash")
+	server = daemon.Daemon([linker])
+	card = server.connect([linker])[0]
+	assert server.connect([linker]) == [card]
+
+	# Something went wrong, so start over
+	server.forget()
+	assert server.connect([linker])[0] is not card
+	linker.close()
+
+
+def test_swapped_cards_are_noticed():
+	linker = open_simulated("DittoFlash")
+	server = daemon.Daemon([linker])
+	card = server.connect([linker])[0]
+	card.seek(0)
+	assert card.read(16) == b"\xff" * 16
+
+	# Another cart is put in between requests
+	chip_of(card).array[:16] = bytes(16)
+	assert server.connect([linker]) == [card]
+	card.seek(0)
+	assert card.read(16) == bytes(16)
+	linker.close()
@@ -0,0 +1,110 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from io import BytesIO
+from typing import List
+
+from tests.helpers import chip_of, dump, make_rom
+
+def record_erases(card) -> List[int]:
+	""" Collect the address of each erase the chip runs """
+	chip = chip_of(card)
+	erased = []
+	erase = chip.erase
+
+	def recording_erase(addr: int, size: int):
+		erased.append(addr)
+		erase(addr, size)
+
+	chip.erase = recording_erase
+	return erased
+
+
+def record_programs(card) -> List[int]:
+	""" Collect the address of each byte the chip programs """
+	chip = chip_of(card)
+	programmed = []
+	program = chip.program
+
+	def recording_program(addr: int, data: int):
+		programmed.append(addr)
+		program(addr, data)
+
+	chip.program = recording_program
+	return programmed
+
+
+def test_sectors_cover_the_range(card):
+	sector = card.sector_size
+	assert list(card.sectors(100, 2 * sector)) == [
+		(100, sector),
+		(100 + sector, sector),
+	]
+	assert list(card.sectors(card.memory - 10)) == [(card.memory - 10, 10)]
+
+
+def test_differential_flash(card):
+	sector = card.sector_size
+	size = 8 * sector
+	rom = bytearray(make_rom(size))
+	rom[sector + 10] = 0xa5
+	rom[5 * sector + 20] = 0xa5
+	card.flash(BytesIO(rom))
+
+	new = bytearray(rom)
+	# Only clears bits, so it's programmed without an erase
+	new[sector + 10] = 0x05
+	# Sets bits, so its sector is erased
+	new[5 * sector + 20] = 0xf5
+
+	erased = record_erases(card)
+	card.flash(BytesIO(bytes(new)), differential=True)
+	assert erased == [5 * sector]
+	assert dump(card, size) == new
+
+
+def test_differential_flash_only_programs_changes(card):
+	sector = card.sector_size
+	rom = bytearray(make_rom(4 * sector))
+	rom[sector + 10] = 0xa5
+	card.flash(BytesIO(rom))
+
+	new = bytearray(rom)
+	new[sector + 10] = 0x05
+	programmed = record_programs(card)
+	card.flash(BytesIO(bytes(new)), differential=True)
+	assert programmed == [sector + 10]
+
+
+def test_differential_flash_with_nothing_to_do(card):
+	rom = make_rom(4 * card.sector_size)
+	card.flash(BytesIO(rom))
+
+	erased = record_erases(card)
+	programmed = record_programs(card)
+	card.flash(BytesIO(rom), differential=True)
+	assert erased == []
+	assert programmed == []
+
+
+def test_differential_flash_doesnt_trust_unverified_programming(card):
+	sector = card.sector_size
+	size = 4 * sector
+	rom = bytearray(make_rom(size))
+	rom[sector] = 0xa5
+	card.flash(BytesIO(rom), verify=True)
+
+	new = bytearray(rom)
+	new[sector] = 0x05
+	chip = chip_of(card)
+	program = chip.program
+	chip.program = lambda addr, data: chip.start_operation(chip.T_BP, data)
+	card.flash(BytesIO(bytes(new)), differential=True)
+	chip.program = program
+
+	assert not card.cache.matches(sector, new[sector:2 * sector])
+	card.flash(BytesIO(bytes(new)), differential=True)
+	assert dump(card, size) == new
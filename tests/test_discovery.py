@@ -0,0 +1,207 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import sys
+from threading import Event
+from types import ModuleType
+from typing import List
+
+import pytest
+
+from pm2hw import discovery, get_connected_linkers
+from pm2hw.linkers import linkers, linkers_by_classname
+from pm2hw.linkers.simulated import SimulatedFtdiHandle, simulated_carts
+from pm2hw.exceptions import DeviceError
+
+class FakeFtd2xx(ModuleType):
+	""" Stands in for the ftd2xx module, with simulated devices plugged in """
+
+	def __init__(self):
+		super().__init__("ftd2xx")
+		self.devices: List[dict] = []
+		# Index of each device opened
+		self.opened: List[int] = []
+
+	def plug(self, name: str, location: int, serial: bytes, *, hidden: bool = False, flags: int = 0):
+		""" Connect a linker, hidden ones have no info in the list like the PokeCard """
+		description = next(
+			(desc for desc, cls in linkers.items() if cls.__name__ == name),
+			name.encode()
+		)
+		self.devices.append({
+			"name": name,
+			"location": location,
+			"description": description,
+			"serial": serial,
+			"hidden": hidden,
+			"flags": flags,
+		})
+
+	def unplug(self, location: int):
+		self.devices = [d for d in self.devices if d["location"] != location]
+
+	def createDeviceInfoList(self) -> int:
+		return len(self.devices)
+
+	def getDeviceInfoDetail(self, index: int, update: bool = True) -> dict:
+		device = self.devices[index]
+		blank = device["hidden"] or device["flags"] & discovery.FLAG_OPENED
+		return {
+			"index": index,
+			"flags": device["flags"],
+			"type": 4,
+			"id": 0x04036010,
+			"location": device["location"],
+			"serial": b"" if blank else device["serial"],
+			"description": b"" if blank else device["description"],
+			"handle": None,
+		}
+
+	def open(self, index: int, update: bool = True) -> SimulatedFtdiHandle:
+		self.opened.append(index)
+		device = self.devices[index]
+		cart = simulated_carts[device["name"]]()
+		return SimulatedFtdiHandle(device["description"], cart, serial=device["serial"])
+
+
+@pytest.fixture
+def ftd2xx(monkeypatch) -> FakeFtd2xx:
+	module = FakeFtd2xx()
+	monkeypatch.setitem(sys.modules, "ftd2xx", module)
+	monkeypatch.setattr(discovery, "described", {})
+	return module
+
+
+def test_finds_linkers_without_opening_them(ftd2xx):
+	ftd2xx.plug("DittoFlash", 0x11, b"A")
+	ftd2xx.plug("Something else", 0x12, b"B")
+	ftd2xx.plug("DittoFlash", 0x13, b"C")
+
+	found = discovery.discover()
+	assert [(d.location, d.serial) for d in found] == [(0x11, b"A"), (0x13, b"C")]
+	assert found[0].linker_cls is linkers_by_classname["DittoFlash"]
+	assert found[0].key == (linkers_by_classname["DittoFlash"].name, b"A")
+	assert ftd2xx.opened == []
+
+
+def test_discover_holds_the_lock(ftd2xx, monkeypatch):
+	ftd2xx.plug("DittoFlash", 0x15, b"A")
+	held = []
+	count = ftd2xx.createDeviceInfoList
+	def recording() -> int:
+		held.append(discovery.described_lock.locked())
+		return count()
+
+	monkeypatch.setattr(ftd2xx, "createDeviceInfoList", recording)
+	discovery.discover()
+	assert held == [True]
+	assert not discovery.described_lock.locked()
+
+
+def test_open_finds_the_device_after_others_are_unplugged(ftd2xx):
+	ftd2xx.plug("DittoFlash", 0x16, b"A")
+	ftd2xx.plug("PokeFlash", 0x17, b"P", hidden=True)
+	found = discovery.discover()
+	ftd2xx.opened.clear()
+
+	# Everything after it in the list moves up
+	ftd2xx.unplug(0x16)
+	linker = found[1].open()
+	assert ftd2xx.opened == [0]
+	assert linker.serial == b"P"
+	linker.close()
+
+
+def test_open_fails_once_unplugged(ftd2xx):
+	ftd2xx.plug("DittoFlash", 0x18, b"A")
+	found = discovery.discover()
+	ftd2xx.unplug(0x18)
+	ftd2xx.plug("DittoFlash", 0x19, b"B")
+	with pytest.raises(DeviceError):
+		found[0].open()
+	assert ftd2xx.opened == []
+
+
+def test_hidden_devices_are_opened_once(ftd2xx):
+	ftd2xx.plug("PokeFlash", 0x21, b"P", hidden=True)
+
+	for _ in range(3):
+		found = discovery.discover()
+		assert [(d.location, d.serial) for d in found] == [(0x21, b"P")]
+	assert ftd2xx.opened == [0]
+
+
+def test_open_devices_are_remembered(ftd2xx):
+	ftd2xx.plug("DittoFlash", 0x31, b"D")
+	discovery.discover()
+
+	# Some process has it open, so the list leaves out its info
+	ftd2xx.devices[0]["flags"] = discovery.FLAG_OPENED
+	assert [d.serial for d in discovery.discover()] == [b"D"]
+
+
+def test_hidden_devices_in_use_are_skipped(ftd2xx):
+	ftd2xx.plug("PokeFlash", 0x41, b"P", hidden=True, flags=discovery.FLAG_OPENED)
+	assert discovery.discover() == []
+	assert ftd2xx.opened == []
+
+
+def test_unplugged_locations_are_forgotten(ftd2xx):
+	ftd2xx.plug("PokeFlash", 0x51, b"P", hidden=True)
+	discovery.discover()
+	ftd2xx.unplug(0x51)
+	assert discovery.discover() == []
+	assert 0x51 not in discovery.described
+
+	# Whatever's plugged in there next is asked again
+	ftd2xx.plug("PokeFlash", 0x51, b"Q", hidden=True)
+	assert [d.serial for d in discovery.discover()] == [b"Q"]
+	assert ftd2xx.opened == [0, 0]
+
+
+def test_get_connected_linkers(ftd2xx):
+	ftd2xx.plug("DittoFlash", 0x61, b"D")
+	ftd2xx.plug("PokeFlash", 0x62, b"P", hidden=True)
+
+	linkers = get_connected_linkers()
+	assert [type(linker).__name__ for linker in linkers] == ["DittoFlash", "PokeFlash"]
+	assert [linker.serial for linker in linkers] == [b"D", b"P"]
+	for linker in linkers:
+		assert linker.init().memory
+		linker.close()
+
+
+def test_watcher_reports_changes(ftd2xx):
+	watcher = discovery.Watcher()
+	events = []
+	unsubscribe = watcher.subscribe(events.append)
+
+	ftd2xx.plug("DittoFlash", 0x71, b"D")
+	ftd2xx.plug("PokeFlash", 0x72, b"P", hidden=True)
+	assert [(e.kind, e.key[1]) for e in watcher.poll()] == [("added", b"D"), ("added", b"P")]
+	assert watcher.poll() == []
+
+	ftd2xx.unplug(0x71)
+	ftd2xx.plug("DittoFlash", 0x73, b"E")
+	assert [(e.kind, e.key[1]) for e in watcher.poll()] == [("removed", b"D"), ("added", b"E")]
+	assert [e.kind for e in events] == ["added", "added", "removed", "added"]
+
+	unsubscribe()
+	ftd2xx.unplug(0x72)
+	assert [(e.kind, e.key[1]) for e in watcher.poll()] == [("removed", b"P")]
+	assert len(events) == 4
+
+
+def test_watcher_polls_in_the_background(ftd2xx):
+	watcher = discovery.Watcher(interval=0.01)
+	added = Event()
+	watcher.subscribe(lambda event: added.set())
+	watcher.start()
+	try:
+		ftd2xx.plug("DittoFlash", 0x81, b"D")
+		assert added.wait(5)
+	finally:
+		watcher.stop()
@@ -0,0 +1,91 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import struct
+from io import BytesIO
+
+import pytest
+
+from pm2hw.carts.simulated import SST39VF1681, SimulatedDittoMiniRev3
+
+from tests.helpers import dump, make_rom
+
+def steps(plan) -> list:
+	return [(addr, size) for method, addr, size, secs in plan]
+
+
+def sector_size(card) -> int:
+	return card.erase_modes[0][1]
+
+
+def test_plan_widens_to_whole_sectors(card):
+	sector = sector_size(card)
+	assert steps(card.plan_erase(100, sector)) == [(0, sector), (sector, sector)]
+	assert steps(card.plan_erase(sector, sector)) == [(sector, sector)]
+
+
+def test_plan_whole_card_is_one_chip_erase(card):
+	assert steps(card.plan_erase(0, card.memory)) == [(0, card.memory)]
+
+
+def test_erase_time_is_the_plan_time(card):
+	plan = card.plan_erase(0, 3 * sector_size(card))
+	assert card.erase_time(0, 3 * sector_size(card)) == pytest.approx(sum(step[3] for step in plan))
+
+
+@pytest.mark.parametrize("linker_name", ["DittoFlash"])
+def test_plan_uses_blocks_inside_the_range(card):
+	k = 1024
+	assert steps(card.plan_erase(60 * k, 72 * k)) == [
+		(60 * k, 4 * k),
+		(64 * k, 64 * k),
+		(128 * k, 4 * k),
+	]
+
+
+@pytest.mark.parametrize("linker_name", ["PokeFlash"])
+def test_plan_spares_nothing_outside_unless_allowed(card):
+	size = 32 * 1024
+	assert steps(card.plan_erase(0, size)) == [
+		(addr, sector_size(card))
+		for addr in range(0, size, sector_size(card))
+	]
+	# A chip erase is quicker than eight sector erases
+	assert steps(card.plan_erase(0, size, spare=True)) == [(0, card.memory)]
+
+
+def test_erase_keeps_data_around_the_range(card):
+	rom = make_rom(3 * sector_size(card))
+	card.flash(BytesIO(rom))
+
+	start = sector_size(card) + 100
+	card.erase(offset=start, size=1000)
+	assert dump(card, len(rom)) == rom[:start] + b"\xff" * 1000 + rom[start + 1000:]
+
+
+def test_erase_past_the_end_does_nothing(card):
+	rom = make_rom(sector_size(card))
+	card.flash(BytesIO(rom))
+	card.erase_data(card.memory, sector_size(card))
+	card.erase_data(card.memory + sector_size(card))
+	assert dump(card, len(rom)) == rom
+
+
+class OneRegionChip(SST39VF1681):
+	""" Reports only its 4 KiB sectors in the CFI query """
+	# Drop the region count and both regions, then add back one
+	cfi_query = SST39VF1681.cfi_query[:-9] + bytes([1]) + struct.pack("<HH", 511, 0x10)
+
+
+@pytest.mark.parametrize("linker_name", ["DittoFlash"])
+def test_one_erase_region_is_both_sizes(make_card):
+	card = make_card(SimulatedDittoMiniRev3(OneRegionChip()))
+	assert [esize for method, esize, secs in card.erase_modes] == [4096, 4096, card.memory]
+
+	rom = make_rom(2 * sector_size(card))
+	card.flash(BytesIO(rom))
+	card.erase(size=sector_size(card))
+	assert dump(card, len(rom)) == b"\xff" * sector_size(card) + rom[sector_size(card):]
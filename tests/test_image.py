@@ -0,0 +1,92 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from io import BytesIO
+from os import SEEK_END
+
+from pm2hw.image import MappedImage
+
+from tests.helpers import make_rom
+
+def test_write_and_read_back(tmp_path):
+	data = make_rom(5000)
+	path = tmp_path / "rom.min"
+	with MappedImage.open(path, "w+b") as image:
+		assert image.write(data[:3000]) == 3000
+		assert image.write(data[3000:]) == 2000
+		assert len(image) == 5000
+		image.seek(100)
+		assert image.read(10) == data[100:110]
+		assert image.seek(0, SEEK_END) == 5000
+		assert image.read() == b""
+	assert path.read_bytes() == data
+
+
+def test_temporary_image_starts_blank():
+	with MappedImage.temporary(0x100) as image:
+		assert len(image) == 0x100
+		with image.getbuffer() as view:
+			assert view == bytes(0x100)
+
+
+def test_reserve_grows_the_image():
+	with MappedImage.temporary() as image:
+		image.write(b"abc")
+		with image.reserve(4) as view:
+			view[:] = b"defg"
+		assert image.tell() == 7
+		assert len(image) == 7
+		image.seek(0)
+		assert image.read() == b"abcdefg"
+
+
+def test_overwrite_in_the_middle():
+	with MappedImage.temporary() as image:
+		image.write(b"abcdefg")
+		image.seek(2)
+		image.write(b"XY")
+		assert len(image) == 7
+		with image.getbuffer() as view:
+			assert view == b"abXYefg"
+
+
+def test_truncate(tmp_path):
+	path = tmp_path / "rom.min"
+	path.write_bytes(b"abcdefg")
+	with MappedImage.open(path) as image:
+		assert image.read(3) == b"abc"
+		image.truncate()
+		assert len(image) == 3
+	assert path.read_bytes() == b"abc"
+
+
+def test_appending_grows_the_file_ahead(tmp_path):
+	path = tmp_path / "rom.min"
+	path.write_bytes(b"")
+	with MappedImage.open(path) as image:
+		remaps = []
+		remap = image._remap
+		image._remap = lambda capacity: (remaps.append(capacity), remap(capacity))
+		for _ in range(1000):
+			image.write(b"ab")
+		assert len(image) == 2000
+		assert len(remaps) <= 12
+		with image.getbuffer() as view:
+			assert view == b"ab" * 1000
+	# The room kept for growing isn't left in the file
+	assert path.read_bytes() == b"ab" * 1000
+
+
+def test_dump_into_an_image(card):
+	rom = make_rom(3 * card.block_size)
+	card.flash(BytesIO(rom))
+
+	with MappedImage.temporary() as image:
+		card.dump(image, size=len(rom))
+		assert len(image) == len(rom)
+		with image.getbuffer() as view:
+			assert view == rom
+		assert card.verify(image)
@@ -0,0 +1,75 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import pytest
+
+from tests.helpers import make_rom
+
+ranges = [(0, 0x100), (0x1234, 0x33), (-0x100, 0x100)]
+
+
+# Negative addresses count from the top of the card
+@pytest.mark.parametrize("addr, size", ranges)
+def test_read_packets_match_packet_by_packet(card, addr, size):
+	addr %= card.memory
+	assert card.prepare_read_packets(addr, size) == b"".join(
+		card.prepare_read_packet(a)
+		for a in range(addr, addr + size)
+	)
+
+
+@pytest.mark.parametrize("addr, size", ranges)
+def test_write_packets_match_packet_by_packet(card, addr, size):
+	addr %= card.memory
+	data = bytes(range(256))[:size] if size == 0x100 else make_rom(size)
+	assert card.prepare_write_packets(addr, data) == b"".join(
+		card.prepare_write_packet(a, d)
+		for a, d in zip(range(addr, addr + size), data)
+	)
+
+
+def test_program_packets_match_byte_program(card, monkeypatch):
+	sent = []
+	monkeypatch.setattr(card.linker, "send", lambda data, **kwargs: sent.append(data))
+	card.erased = (0, 0)
+	data = bytes(range(256))
+	for a, d in enumerate(data, 0x100):
+		card.sst_byte_program(a, d)
+
+	assert card.prepare_program_packets(0x100, data) == b"".join(sent)
+
+
+def test_runs_to_program_skip_blank_bytes_only_where_erased(card):
+	card.erased = (0x10, 0x20)
+	data = b"\xff\x01" * 16
+
+	assert list(card._runs_to_program(0x08, data)) == [
+		(0x08, data[:8]),
+		(0x11, b"\x01"),
+		(0x13, b"\x01"),
+		(0x15, b"\x01"),
+		(0x17, b"\x01"),
+		(0x19, b"\x01"),
+		(0x1b, b"\x01"),
+		(0x1d, b"\x01"),
+		(0x1f, b"\x01"),
+		(0x20, data[24:]),
+	]
+
+
+def test_decode_packets_matches_packet_by_packet(card):
+	# Including bits the cart doesn't drive
+	raw = make_rom(card.packet_size * 0x200)
+	packet_size = card.packet_size
+	assert card.decode_packets(raw) == bytes(
+		card.deconstruct_packet(raw[i:i + packet_size])[1]
+		for i in range(0, len(raw), packet_size)
+	)
+
+
+def test_decode_packets_reverses_write_packets(card):
+	data = bytes(range(256))
+	assert card.decode_packets(card.prepare_write_packets(0x100, data)) == data
@@ -0,0 +1,86 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from io import BytesIO
+from typing import List
+
+from pm2hw.carts.base import BaseCard
+from pm2hw.carts.dittomini import DittoMiniRev3
+from pm2hw.linkers.base import ReadRequest
+
+from tests.helpers import dump, make_rom
+
+def read_request(card: BaseCard, addr: int, size: int) -> ReadRequest:
+	""" The request the card would make to read this range """
+	transform = card.linker.lsb_first if isinstance(card, DittoMiniRev3) else None
+	return (
+		b"".join(card.prepare_read_packet(a) for a in range(addr, addr + size)),
+		size,
+		transform,
+	)
+
+
+def record_reads(card: BaseCard, monkeypatch) -> List[int]:
+	""" Collect the size of each read the linker sends """
+	issued = []
+	read_data = card.linker.read_data
+
+	def recording_read_data(data, size, **kwargs):
+		issued.append(size)
+		return read_data(data, size, **kwargs)
+
+	monkeypatch.setattr(card.linker, "read_data", recording_read_data)
+	return issued
+
+
+def test_responses_come_in_request_order(card):
+	rom = make_rom(0x1000)
+	card.flash(BytesIO(rom))
+
+	ranges = [(0xc00, 0x100), (0x000, 0x80), (0x800, 0x200), (0x100, 0x10)]
+	responses = card.linker.read_pipelined(
+		read_request(card, addr, size) for addr, size in ranges
+	)
+	assert list(responses) == [rom[addr:addr + size] for addr, size in ranges]
+
+
+def test_requests_go_out_before_responses_are_read(card, monkeypatch):
+	issued = record_reads(card, monkeypatch)
+
+	responses = card.linker.read_pipelined(
+		read_request(card, addr, 0x40) for addr in range(0, 0x400, 0x40)
+	)
+	next(responses)
+	assert len(issued) > 1
+	responses.close()
+
+
+def test_read_ahead_limits_requests_in_flight(card, monkeypatch):
+	size = 0x40
+	monkeypatch.setattr(card.linker, "read_ahead", 2 * size * card.packet_size)
+	issued = record_reads(card, monkeypatch)
+
+	received = 0
+	for _ in card.linker.read_pipelined(
+		read_request(card, addr, size) for addr in range(0, 0x400, size)
+	):
+		assert len(issued) - received <= 2
+		received += 1
+	assert received == 0x400 // size
+
+
+def test_stopping_early_drains_the_responses(card):
+	rom = make_rom(0x1000)
+	card.flash(BytesIO(rom))
+
+	responses = card.linker.read_pipelined(
+		read_request(card, addr, 0x100) for addr in range(0, 0x1000, 0x100)
+	)
+	assert next(responses) == rom[:0x100]
+	responses.close()
+
+	assert card.linker.handle.getQueueStatus() == 0
+	assert dump(card, 0x1000) == rom
@@ -0,0 +1,55 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from io import BytesIO
+
+import pytest
+
+from pm2hw.exceptions import DeviceError
+
+from tests.helpers import chip_of, dump, make_rom
+
+@pytest.fixture(params=[True, False], ids=["polling", "fixed waits"])
+def status_polling(card, request) -> bool:
+	card.linker.status_polling = request.param
+	return request.param
+
+
+def test_erase_waits_for_the_chip(card, status_polling):
+	assert card.use_status_polling() == status_polling
+	card.flash(BytesIO(make_rom(0x1000)))
+
+	card.erase(size=0x4000)
+	assert dump(card, 0x1000) == b"\xff" * 0x1000
+	assert chip_of(card).busy_violations == 0
+
+
+def test_wait_for_ready_returns_when_the_chip_is_done(card):
+	chip = chip_of(card)
+	card.sst_sector_erase(0)
+	card.linker.flush()
+	assert chip.is_busy()
+
+	assert card._wait_for_ready(0, 1)
+	assert not chip.is_busy()
+
+
+def test_polling_replaces_the_fixed_wait(card):
+	assert "status-polling" in card.linker.configuration
+	assert card.erase_wait(0.025) == 0
+	card.linker.status_polling = False
+	assert card.erase_wait(0.025) == 0.025
+
+
+def test_erase_which_doesnt_finish_raises(card, status_polling):
+	chip = chip_of(card)
+	# A chip which stays busy after erasing
+	chip.erase_commands = {
+		command: (size, 1000.0)
+		for command, (size, secs) in chip.erase_commands.items()
+	}
+	with pytest.raises(DeviceError):
+		card.erase(size=0x1000)
@@ -0,0 +1,92 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from io import BytesIO
+
+import pytest
+
+from pm2hw.base import BaseReader, Transform
+
+from tests.helpers import make_rom
+
+@pytest.fixture
+def rom(card) -> bytes:
+	rom = make_rom(card.block_size)
+	card.flash(BytesIO(rom))
+	return rom
+
+
+def reader_for(card, addr: int, size: int, transform=None) -> BaseReader:
+	return card.linker.read_data(card.prepare_read_packets(addr, size), size, transform=transform)
+
+
+def test_readinto_fills_the_buffer(card, rom):
+	expected = reader_for(card, 0, 0x100).read()
+
+	buffer = bytearray(0x100)
+	reader = reader_for(card, 0, 0x100)
+	read_size = 0
+	while read_size < len(buffer):
+		read_size += reader.readinto(memoryview(buffer)[read_size:])
+	assert buffer == expected
+	assert reader.readinto(bytearray(0x10)) == 0
+
+
+def test_readinto_stops_at_the_end_of_the_response(card, rom):
+	reader = reader_for(card, 0, 0x10)
+	buffer = bytearray(b"\xaa" * 0x20)
+	read_size = 0
+	while True:
+		res = reader.readinto(memoryview(buffer)[read_size:])
+		if not res:
+			break
+		read_size += res
+	assert read_size == 0x10
+	assert buffer[0x10:] == b"\xaa" * 0x10
+	assert card.linker.handle.getQueueStatus() == 0
+
+
+def test_readinto_applies_the_transform(card, rom):
+	expected = reader_for(card, 0, 0x40).read()
+	invert = Transform.from_function(lambda x: ~x)
+
+	buffer = bytearray(0x40)
+	assert reader_for(card, 0, 0x40, invert).readinto(buffer) == 0x40
+	assert buffer == invert.apply(expected)
+
+
+def test_read_in_pieces_does_not_over_read(card, rom):
+	expected = reader_for(card, 0, 0x100).read()
+
+	reader = reader_for(card, 0, 0x100)
+	assert reader.read(0x10) + reader.read(0x30) + reader.read() == expected
+	assert reader.read() == b""
+	assert card.linker.handle.getQueueStatus() == 0
+
+
+def test_clear_discards_the_rest(card, rom):
+	reader = reader_for(card, 0, 0x100)
+	reader.read(0x10)
+	reader.clear()
+	assert reader.read() == b""
+	assert card.linker.handle.getQueueStatus() == 0
+
+
+def test_decode_packets_into_matches_decode_packets(card):
+	raw = make_rom(card.packet_size * 0x100)
+	buffer = bytearray(0x100)
+	assert card.decode_packets_into(raw, memoryview(buffer)) == 0x100
+	assert buffer == card.decode_packets(raw)
+
+
+def test_read_data_into_a_buffer(card, rom):
+	image = memoryview(bytearray(len(rom)))
+	pos = 0
+	for data in card.read_data(0, len(rom), into=image):
+		assert data.obj is image.obj
+		pos += len(data)
+	assert pos == len(rom)
+	assert image == rom
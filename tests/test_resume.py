@@ -0,0 +1,188 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from io import BytesIO
+from logging import INFO
+from threading import Event
+
+import pytest
+
+from pm2hw.carts import journal
+from pm2hw.carts.journal import Journal
+from pm2hw.exceptions import DeviceError, OperationCancelled
+
+from tests.helpers import chip_of, dump, make_rom
+
+class Interrupted(Exception):
+	pass
+
+
+@pytest.fixture(autouse=True)
+def checkpoint_every_time(monkeypatch):
+	monkeypatch.setattr(Journal, "interval", 0)
+
+
+def test_resume_flash(card, reconnect):
+	rom = make_rom(6 * card.block_size)
+	chip = chip_of(card)
+	program = chip.program
+	count = 0
+
+	def counting(addr: int, data: int):
+		nonlocal count
+		count += 1
+		program(addr, data)
+
+	def failing(addr: int, data: int):
+		if count == 4 * card.block_size:
+			raise Interrupted()
+		counting(addr, data)
+
+	# Checkpoint after every block
+	card.checkpoint_size = card.block_size
+	chip.program = failing
+	with pytest.raises(Interrupted):
+		card.flash(BytesIO(rom))
+
+	# Blocks the interrupted flash finished aren't programmed again
+	card = reconnect(card)
+	card.checkpoint_size = card.block_size
+	count = 0
+	chip.program = counting
+	card.flash(BytesIO(rom), resume=True)
+	assert 0 < count <= 3 * card.block_size
+	assert dump(card, len(rom)) == rom
+
+
+def test_resume_without_journal_flashes_everything(card):
+	rom = make_rom(2 * card.block_size)
+	card.flash(BytesIO(rom), resume=True)
+	assert dump(card, len(rom)) == rom
+
+
+def test_finished_jobs_remove_their_journal(card, tmp_path):
+	card.flash(BytesIO(make_rom(2 * card.block_size)))
+	assert list(journal.journal_dir.glob("*.json")) == []
+
+
+def test_resume_dump(card, reconnect):
+	rom = make_rom(6 * card.block_size)
+	card.flash(BytesIO(rom))
+
+	class FailingOutput(BytesIO):
+		def write(self, data):
+			if self.tell() == 4 * card.block_size:
+				raise Interrupted()
+			return super().write(data)
+
+	card.checkpoint_size = card.block_size
+	out = FailingOutput()
+	with pytest.raises(Interrupted):
+		card.dump(out, size=len(rom))
+
+	# Blocks already in the file aren't read again
+	card = reconnect(card)
+	chip = chip_of(card)
+	read = chip.read
+	reads = 0
+
+	def counting(addr: int) -> int:
+		nonlocal reads
+		reads += 1
+		return read(addr)
+
+	chip.read = counting
+	resumed = BytesIO(out.getvalue())
+	card.dump(resumed, size=len(rom), resume=True)
+	assert reads < 3 * card.block_size
+	assert resumed.getvalue() == rom
+
+
+def test_journal_for_another_job_isnt_resumed(tmp_path):
+	saved = Journal(tmp_path / "job.json", {"kind": "flash", "rom": "a"})
+	saved.erased = True
+	saved.complete(0x1000)
+	saved.save()
+
+	assert Journal(tmp_path / "job.json", {"kind": "flash", "rom": "a"}).resume()
+	assert not Journal(tmp_path / "job.json", {"kind": "flash", "rom": "b"}).resume()
+
+
+def test_flash_logs_completion_once(card, caplog):
+	with caplog.at_level(INFO, logger="pm2hw"):
+		card.flash(BytesIO(make_rom(2 * card.block_size)))
+	# The progress record is logged again on each update
+	assert caplog.text.count("Completed in") == 1
+
+
+def test_cancelled_flash_can_be_resumed(card):
+	rom = make_rom(6 * card.block_size)
+	card.checkpoint_size = card.block_size
+	card.cancel = Event()
+	chip = chip_of(card)
+	program = chip.program
+	count = 0
+
+	def cancelling(addr: int, data: int):
+		nonlocal count
+		count += 1
+		if count == 3 * card.block_size:
+			card.cancel.set()
+		program(addr, data)
+
+	chip.program = cancelling
+	with pytest.raises(OperationCancelled):
+		card.flash(BytesIO(rom), verify=True)
+	# It stopped before the end and left the linker ready
+	assert count < 5 * card.block_size
+	assert card.read_all_data(0, 16) == rom[:16]
+
+	card.cancel = None
+	count = 0
+	card.flash(BytesIO(rom), verify=True, resume=True)
+	assert count < 4 * card.block_size
+	assert dump(card, len(rom)) == rom
+
+
+def test_cancelled_dump_can_be_resumed(card):
+	rom = make_rom(6 * card.block_size)
+	card.flash(BytesIO(rom))
+	card.checkpoint_size = card.block_size
+	card.cancel = Event()
+
+	class CancellingOutput(BytesIO):
+		def write(self, data):
+			if self.tell() == 2 * card.block_size:
+				card.cancel.set()
+			return super().write(data)
+
+	out = CancellingOutput()
+	with pytest.raises(OperationCancelled):
+		card.dump(out, size=len(rom))
+	assert card.read_all_data(0, 16) == rom[:16]
+
+	card.cancel = None
+	card.dump(out, size=len(rom), resume=True)
+	assert out.getvalue() == rom
+
+
+def test_dump_which_cant_be_read_back_cant_be_resumed(card, tmp_path):
+	with open(tmp_path / "rom.min", "wb") as out:
+		with pytest.raises(DeviceError):
+			card.dump(out, size=card.block_size, resume=True)
+
+
+def test_dump_which_cant_be_read_back_keeps_no_journal(card, tmp_path, monkeypatch):
+	saved = []
+	monkeypatch.setattr(Journal, "save", lambda self: saved.append(self.path))
+	rom = make_rom(3 * card.block_size)
+	card.flash(BytesIO(rom))
+	saved.clear()
+
+	with open(tmp_path / "rom.min", "wb") as out:
+		card.dump(out, size=len(rom))
+	assert (tmp_path / "rom.min").read_bytes() == rom
+	assert all(path is None for path in saved)
@@ -0,0 +1,167 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import logging
+from functools import partial
+from io import BytesIO
+from threading import Barrier, current_thread
+from types import SimpleNamespace
+
+import pytest
+
+from pm2hw.__main__ import dump_job
+from pm2hw.linkers.simulated import get_simulated_linkers, open_simulated
+from pm2hw.scheduler import JobResult, LinkerSpec, raise_first, run_all, summarize
+
+from tests.helpers import dump, make_rom
+
+class Failed(Exception):
+	pass
+
+
+def flash_and_dump(rom_path, card) -> int:
+	""" Job for worker processes, which can only hand results back through files """
+	rom = rom_path.read_bytes()
+	card.flash(BytesIO(rom))
+	with open(rom_path.with_name(card.linker.serial.decode() + ".min"), "wb") as f:
+		card.dump(f, size=len(rom))
+	return len(rom)
+
+
+def fail(card):
+	raise Failed(card.linker.serial.decode())
+
+
+def devices(*names: str):
+	return [SimpleNamespace(name=name) for name in names]
+
+
+def test_results_are_in_order():
+	flashables = devices("a", "b", "c")
+	results = run_all(flashables, lambda f: len(f.name) * 10)
+	assert [r.flashable for r in results] == flashables
+	assert [r.size for r in results] == [10, 10, 10]
+	assert all(r.error is None for r in results)
+
+
+def test_jobs_run_at_the_same_time():
+	flashables = devices("a", "b", "c")
+	barrier = Barrier(len(flashables), timeout=5)
+	threads = set()
+
+	def job(flashable):
+		threads.add(current_thread().name)
+		# Only gets past this if every job is running
+		barrier.wait()
+		return 1
+
+	results = run_all(flashables, job)
+	assert all(r.error is None for r in results)
+	assert len(threads) == 3
+
+
+def test_jobs_run_in_turn_unless_parallel():
+	order = []
+	run_all(devices("a", "b"), lambda f: order.append(f.name), parallel=False)
+	assert order == ["a", "b"]
+
+
+def test_one_failure_doesnt_stop_the_others():
+	def job(flashable):
+		if flashable.name == "b":
+			raise Failed("b broke")
+		return 5
+
+	results = run_all(devices("a", "b", "c"), job)
+	assert [r.size for r in results] == [5, 0, 5]
+	assert isinstance(results[1].error, Failed)
+	with pytest.raises(Failed):
+		raise_first(results)
+
+
+def test_raise_first_with_no_errors():
+	raise_first([JobResult(SimpleNamespace(name="a"), 1, 1.0)])
+
+
+def test_summarize(caplog):
+	results = [
+		JobResult(SimpleNamespace(name="first"), 2048, 2.0),
+		JobResult(SimpleNamespace(name="second"), 0, 1.0, Failed("oops")),
+	]
+	with caplog.at_level(logging.INFO, logger="pm2hw"):
+		summarize(results, 2.0)
+
+	errors = [r.getMessage() for r in caplog.records if r.levelno == logging.ERROR]
+	infos = [r.getMessage() for r in caplog.records if r.levelno == logging.INFO]
+	assert len(errors) == 1 and "second" in errors[0] and "oops" in errors[0]
+	assert len(infos) == 2 and "first" in infos[0]
+
+
+def test_each_flashable_can_have_its_own_job():
+	results = run_all(devices("a", "b"), [lambda f: 1, lambda f: 2])
+	assert [r.size for r in results] == [1, 2]
+
+
+def test_flash_several_linkers():
+	cards = [linker.init() for linker in get_simulated_linkers(["PokeFlash", "DittoFlash"])]
+	rom = make_rom(2 * max(card.block_size for card in cards))
+
+	def job(card):
+		card.flash(BytesIO(rom))
+		return len(rom)
+
+	results = run_all(cards, job)
+	assert [r.error for r in results] == [None, None]
+	assert [r.name for r in results] == [card.linker.name for card in cards]
+	for card in cards:
+		assert dump(card, len(rom)) == rom
+
+
+def test_linker_spec_opens_the_same_linker():
+	linker = get_simulated_linkers(["DittoFlash"])[0]
+	spec = LinkerSpec.of(linker)
+	linker.close()
+
+	again = spec.open()
+	assert type(again) is type(linker)
+	assert again.serial == linker.serial
+	again.close()
+
+
+def test_jobs_in_processes(tmp_path):
+	rom = make_rom(0x4000)
+	rom_path = tmp_path / "rom.min"
+	rom_path.write_bytes(rom)
+	cards = [linker.init() for linker in get_simulated_linkers(["PokeFlash", "DittoFlash"])]
+
+	results = run_all(cards, partial(flash_and_dump, rom_path), processes=True)
+	assert [(r.size, r.error) for r in results] == [(len(rom), None)] * 2
+	for card in cards:
+		assert (tmp_path / (card.linker.serial.decode() + ".min")).read_bytes() == rom
+
+
+def test_errors_come_back_from_processes():
+	cards = [linker.init() for linker in get_simulated_linkers(["PokeFlash", "DittoFlash"])]
+	results = run_all(cards, fail, processes=True)
+	assert [str(r.error) for r in results] == ["SIM0001", "SIM0002"]
+	assert all(isinstance(r.error, Failed) for r in results)
+
+
+@pytest.mark.parametrize("processes", [False, True], ids=["threads", "processes"])
+def test_dumps_are_numbered_by_position(tmp_path, processes):
+	# Linkers don't all have a serial, or one of their own
+	linkers = [open_simulated("DittoFlash", serial=b"") for _ in range(2)]
+	cards = [linker.init() for linker in linkers]
+
+	out = tmp_path / "dumps"
+	out.mkdir()
+	args = SimpleNamespace(dest=str(out / "{i}.min"), resume=False, simulate=False)
+	kwargs = {"size": cards[0].block_size}
+	jobs = [partial(dump_job, args=args, kwargs=kwargs, index=i) for i in range(len(cards))]
+	results = run_all(cards, jobs, processes=processes)
+	assert [r.error for r in results] == [None, None]
+	# Each went to its own file
+	assert sorted(path.name for path in out.iterdir()) == ["0.min", "1.min"]
@@ -0,0 +1,53 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from io import BytesIO
+
+import pytest
+
+from pm2hw.linkers.simulated import get_simulated_linkers, open_simulated
+
+from tests.helpers import chip_of, dump, make_rom
+
+chips = {
+	"PokeFlash": "SST39VF040",
+	"DittoFlash": "SST39VF1681",
+}
+
+def test_detects_the_chip(card, linker_name):
+	chip = chip_of(card)
+	assert card.chip == chips[linker_name] == chip.chip
+	assert card.memory == chip.memory
+
+def test_flash_and_dump(card):
+	rom = make_rom(2 * card.block_size + 100)
+	card.flash(BytesIO(rom))
+	assert dump(card, len(rom)) == rom
+	assert card.verify(BytesIO(rom))
+
+def test_dump_from_an_offset(card):
+	rom = make_rom(card.block_size)
+	card.flash(BytesIO(rom))
+	assert dump(card, 100, offset=1000) == rom[1000:1100]
+
+def test_erase(card):
+	card.flash(BytesIO(make_rom(card.block_size)))
+	card.erase()
+	assert chip_of(card).array == b"\xff" * card.memory
+
+def test_contents_survive_reconnecting(card, reconnect):
+	rom = make_rom(card.block_size)
+	card.flash(BytesIO(rom))
+	other = reconnect(card)
+	assert dump(other, len(rom)) == rom
+
+def test_unknown_linker():
+	with pytest.raises(KeyError):
+		open_simulated("NoSuchFlash")
+
+def test_simulated_linkers_have_their_own_serials():
+	linkers = get_simulated_linkers(["PokeFlash", "DittoFlash"])
+	assert [linker.serial for linker in linkers] == [b"SIM0001", b"SIM0002"]
@@ -0,0 +1,136 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from io import BytesIO, RawIOBase
+
+import pytest
+
+from pm2hw.base import read_fully
+from pm2hw.carts.journal import Journal
+from pm2hw.info import games
+from pm2hw.exceptions import DeviceError
+
+from tests.helpers import chip_of, dump, make_rom
+
+class Pipe(RawIOBase):
+	""" Gives back a little at a time and can't seek, like stdin """
+
+	def __init__(self, data: bytes, chunk: int = 100):
+		self.data = BytesIO(data)
+		self.chunk = chunk
+
+	def readable(self):
+		return True
+
+	def readinto(self, buffer) -> int:
+		data = self.data.read(min(len(buffer), self.chunk))
+		buffer[:len(data)] = data
+		return len(data)
+
+
+def make_game(size: int = 0x8000) -> bytes:
+	""" A ROM with Pokémon Race mini's header """
+	rom = bytearray(make_rom(size))
+	header = b"NINTENDO" + b"MRCJ" + "ﾎﾟｹﾓﾝﾚｰｽ".encode("shift-jis").ljust(12, b"\0")
+	rom[games.header_start:games.header_end] = header
+	return bytes(rom)
+
+
+def test_read_fully_waits_for_the_rest():
+	data = make_rom(1000)
+	pipe = Pipe(data, 30)
+	assert read_fully(pipe, 500) == data[:500]
+	assert read_fully(pipe, 1000) == data[500:]
+	assert read_fully(pipe, 1000) == b""
+
+
+@pytest.mark.parametrize("check_crc", [False, True])
+def test_lookup_reader_matches_lookup(check_crc):
+	rom = make_game()
+	reader = games.LookupReader(BytesIO(rom))
+	while reader.read(1000):
+		pass
+
+	expected = games.lookup(BytesIO(rom), check_crc)
+	found = reader.lookup(check_crc)
+	assert expected.code == b"MRCJ"
+	assert (found.code, found.internal, found.crc32, found.size) == (
+		expected.code, expected.internal, expected.crc32, expected.size
+	)
+
+
+def test_lookup_reader_only_scans_from_the_start():
+	rom = make_game()
+	reader = games.LookupReader(BytesIO(rom))
+	reader.seek(games.crc_start)
+	reader.read()
+	assert reader.scanned == 0
+	assert reader.lookup() is None
+
+
+def test_flash_from_a_pipe(card):
+	rom = make_rom(3 * card.block_size + 100)
+	card.flash(Pipe(rom))
+	assert dump(card, len(rom)) == rom
+
+
+def test_differential_flash_from_a_pipe(card):
+	sector = card.sector_size
+	card.checkpoint_size = 2 * sector
+	rom = make_rom(5 * sector + 100, 1)
+	card.flash(BytesIO(rom))
+
+	new = bytearray(rom)
+	new[3 * sector:4 * sector] = make_rom(sector, 2)
+	sizes = []
+
+	class RecordingPipe(Pipe):
+		def readinto(self, buffer) -> int:
+			sizes.append(len(buffer))
+			return super().readinto(buffer)
+
+	card.flash(RecordingPipe(bytes(new), sector), differential=True)
+	assert dump(card, len(new)) == new
+	# Compared a run at a time rather than read all at once
+	assert max(sizes) <= card.checkpoint_size
+
+
+def test_differential_flash_from_a_pipe_too_large(card):
+	# Only flash a little of the card to find out
+	card.memory = 2 * card.sector_size
+	with pytest.raises(DeviceError):
+		card.flash(Pipe(make_rom(card.memory + 1), card.sector_size), differential=True)
+
+
+def test_resume_rewrites_blocks_of_another_rom(card, reconnect, monkeypatch):
+	monkeypatch.setattr(Journal, "interval", 0)
+	card.checkpoint_size = card.block_size
+	old = make_rom(4 * card.block_size, 1)
+	new = make_rom(4 * card.block_size, 2)
+
+	chip = chip_of(card)
+	program = chip.program
+	count = 0
+
+	class Interrupted(Exception):
+		pass
+
+	def failing(addr: int, data: int):
+		nonlocal count
+		count += 1
+		if count == 2 * card.block_size:
+			raise Interrupted()
+		program(addr, data)
+
+	chip.program = failing
+	with pytest.raises(Interrupted):
+		card.flash(BytesIO(old))
+
+	# Same size, so the journal is picked up, but the blocks differ
+	chip.program = program
+	card = reconnect(card)
+	card.flash(BytesIO(new), resume=True)
+	assert dump(card, len(new)) == new
@@ -0,0 +1,70 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from io import BytesIO
+
+import pytest
+
+from pm2hw.carts.simulated import SST39VF040
+from pm2hw.linkers.simulated import TimingModel
+
+from tests.helpers import chip_of, make_rom
+
+def test_chip_ignores_commands_while_busy():
+	chip = SST39VF040()
+	chip.timing = timing = TimingModel()
+	chip.start_operation(0.001, 0x00)
+	assert chip.is_busy()
+
+	# Toggle bit and Data# polling instead of the array
+	first, second = chip.read(0), chip.read(0)
+	assert first ^ second == 0x40
+	assert first & 0x80 == 0x80
+
+	chip.write(0x5555, 0xaa)
+	assert chip.busy_violations == 1
+
+	timing.device += 0.001
+	assert not chip.is_busy()
+	assert chip.read(0) == 0xff
+
+def test_clocking_is_charged_to_the_device():
+	timing = TimingModel()
+	timing.clock_bits(8000, 1e6)
+	assert timing.device == pytest.approx(0.008)
+	assert timing.host == 0
+	assert timing.report().secs == pytest.approx(0.008)
+
+def test_sleeping_is_charged_to_the_host():
+	timing = TimingModel()
+	timing.sleep(0.5)
+	assert timing.time() == timing.report().slept == 0.5
+
+@pytest.mark.parametrize("high_speed, frame", [(False, 1e-3), (True, 125e-6)])
+def test_usb_transfers_take_a_frame(high_speed, frame):
+	timing = TimingModel(high_speed)
+	timing.transfer_out(10, 4096)
+	assert timing.usb_writes == 1
+	assert timing.time() >= frame
+
+def test_measure_projects_an_operation(card):
+	rom = make_rom(card.block_size)
+	with card.linker.clock.measure() as result:
+		card.flash(BytesIO(rom))
+	report = result[0]
+	chip = chip_of(card)
+
+	assert report.usb_writes > 0
+	assert report.bytes_out > 0
+	# At least as long as programming the bytes which needed it
+	programmed = sum(b != 0xff for b in rom)
+	assert report.chip_busy >= programmed * chip.T_BP
+	assert report.secs >= report.chip_busy
+
+def test_operations_wait_for_the_chip(card):
+	card.flash(BytesIO(make_rom(card.block_size)))
+	card.erase()
+	assert card.linker.clock.report().busy_violations == 0
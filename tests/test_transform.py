@@ -0,0 +1,53 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from io import BytesIO
+
+from pm2hw.base import Transform
+from pm2hw.carts import pokecard
+from pm2hw.linkers.base import BaseLinker
+
+from tests.helpers import make_rom
+
+def test_lsb_first_reverses_the_bits():
+	for x in range(256):
+		assert BaseLinker.lsb_first(x) == int(f"{x:08b}"[::-1], 2)
+
+
+def test_noop_changes_nothing():
+	data = bytes(range(256))
+	assert BaseLinker.noop.apply(data) == data
+
+
+def test_pokecard_tables_match_the_bit_shuffles():
+	for x in range(256):
+		assert pokecard.convert_byte(x) == pokecard._convert_byte(x)
+		assert pokecard.revert_byte(x) == pokecard._revert_byte(x)
+		assert pokecard.revert_byte(pokecard.convert_byte(x)) == x
+
+
+def test_apply_translates_every_byte():
+	invert = Transform.from_function(lambda x: ~x)
+	assert invert.apply(b"\x00\x0f\xff") == b"\xff\xf0\x00"
+
+
+def test_coerce_accepts_functions():
+	assert Transform.coerce(None) is None
+	assert Transform.coerce(BaseLinker.lsb_first) is BaseLinker.lsb_first
+
+	table = Transform.coerce(lambda x: x + 1)
+	assert isinstance(table, Transform)
+	assert table(0x7f) == 0x80
+	assert table(0xff) == 0x00
+
+
+def test_reads_take_plain_functions(card):
+	card.flash(BytesIO(make_rom(card.block_size)))
+	packets = card.prepare_read_packets(0, 0x100)
+
+	raw = card.linker.read_data(packets, 0x100).read()
+	inverted = card.linker.read_data(packets, 0x100, transform=lambda x: x ^ 0xff).read()
+	assert inverted == bytes(x ^ 0xff for x in raw)
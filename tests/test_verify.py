@@ -0,0 +1,58 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from io import BytesIO
+
+import pytest
+
+from tests.helpers import chip_of, dump, make_rom
+
+def ignore_programs(card, at: int, times: int = -1):
+	""" Make the chip ignore programming one address, some number of times """
+	chip = chip_of(card)
+	program = chip.program
+
+	def flaky(addr: int, data: int):
+		nonlocal times
+		if addr != at or not times:
+			program(addr, data)
+		else:
+			times -= 1
+			chip.start_operation(chip.T_BP, data)
+
+	chip.program = flaky
+
+
+@pytest.mark.parametrize("verify", [False, True])
+def test_flash_and_verify(card, verify):
+	rom = make_rom(40000)
+	errors = card.flash(BytesIO(rom), verify=verify)
+	assert errors == ({} if verify else None)
+	assert card.verify(BytesIO(rom))
+	assert dump(card, len(rom)) == rom
+
+
+def test_verify_finds_changes(card):
+	rom = make_rom(20000)
+	card.flash(BytesIO(rom))
+	bad = bytearray(rom)
+	bad[12345] ^= 0xff
+	assert not card.verify(BytesIO(bytes(bad)))
+
+
+def test_flash_retries_blocks_which_dont_program(card):
+	ignore_programs(card, card.block_size + 10, times=1)
+	rom = make_rom(3 * card.block_size)
+	assert card.flash(BytesIO(rom), verify=True) == {}
+	assert dump(card, len(rom)) == rom
+
+
+def test_flash_reports_blocks_which_dont_program(card):
+	stuck = card.block_size
+	ignore_programs(card, stuck)
+	rom = make_rom(3 * card.block_size)
+	errors = card.flash(BytesIO(rom), verify=True)
+	assert list(errors) == [stuck]
@@ -0,0 +1,91 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from io import BytesIO
+from os import SEEK_END
+from typing import List, Tuple
+
+import pytest
+
+from pm2hw.carts.view import CardView
+
+from tests.helpers import make_rom
+
+@pytest.fixture
+def rom(card) -> bytes:
+	rom = make_rom(4 * card.block_size)
+	card.flash(BytesIO(rom))
+	return rom
+
+
+def record_ranges(card, monkeypatch) -> List[List[Tuple[int, int]]]:
+	""" Collect the ranges of each read_ranges request which reads anything """
+	requests = []
+	read_ranges = card.read_ranges
+
+	def recording_read_ranges(ranges, *args, **kwargs):
+		ranges = list(ranges)
+		if ranges:
+			requests.append(ranges)
+		return read_ranges(ranges, *args, **kwargs)
+
+	monkeypatch.setattr(card, "read_ranges", recording_read_ranges)
+	return requests
+
+
+def test_small_reads_cost_one_block(card, rom, monkeypatch):
+	requests = record_ranges(card, monkeypatch)
+	view = CardView(card)
+	view.seek(10)
+	assert view.read(4) == rom[10:14]
+	assert view.read(20) == rom[14:34]
+	assert requests == [[(0, card.block_size)]]
+
+
+def test_missing_blocks_are_read_together(card, rom, monkeypatch):
+	requests = record_ranges(card, monkeypatch)
+	block = card.block_size
+	view = CardView(card)
+	view.seek(block + 10)
+	view.read(1)
+
+	view.seek(10)
+	assert view.read(3 * block) == rom[10:3 * block + 10]
+	assert requests[1] == [(0, block), (2 * block, block), (3 * block, block)]
+
+
+def test_least_recently_used_blocks_go_first(card, rom, monkeypatch):
+	requests = record_ranges(card, monkeypatch)
+	block = card.block_size
+	view = CardView(card, capacity=2)
+	for i in (0, 1, 0, 2):
+		view.seek(i * block)
+		view.read(1)
+	assert sorted(view.blocks) == [0, 2]
+
+	view.seek(0)
+	view.read(1)
+	assert len(requests) == 3
+
+
+def test_seek_stays_on_the_card(card):
+	view = CardView(card)
+	assert view.seek(-10) == 0
+	assert view.seek(10, SEEK_END) == card.memory
+	assert view.read(10) == b""
+
+
+def test_writing_drops_the_blocks(card, rom):
+	block = card.block_size
+	card.seek(0)
+	assert card.read(block) == rom[:block]
+	card.flash(BytesIO(bytes(block)))
+	card.seek(0)
+	assert card.read(block) == bytes(block)
+
+	card.erase(size=card.sector_size)
+	card.seek(0)
+	assert card.read(16) == b"\xff" * 16
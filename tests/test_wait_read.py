@@ -0,0 +1,101 @@
+# Copyright (C) 2021 Sapphire Becker (logicplace.com)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from typing import List, Tuple
+
+import pytest
+
+from pm2hw.linkers.base_ftdi import BaseFtdiLinker
+from pm2hw.exceptions import DeviceError
+
+from tests.helpers import FakeClock
+
+class ArrivingHandle:
+	""" Receive queue which data arrives in at set times """
+
+	def __init__(self):
+		self.clock = FakeClock()
+		# (time, data) in order of arrival
+		self.arrivals: List[Tuple[float, bytes]] = []
+		self.polls = 0
+
+	def arrive(self, at: float, data: bytes):
+		self.arrivals.append((at, data))
+
+	def getDeviceInfo(self):
+		return {"serial": b"FAKE0001"}
+
+	def getQueueStatus(self) -> int:
+		self.polls += 1
+		return sum(len(data) for at, data in self.arrivals if at <= self.clock.now)
+
+	def read(self, size: int) -> bytes:
+		now = self.clock.now
+		queued = b"".join(data for at, data in self.arrivals if at <= now)
+		later = [(at, data) for at, data in self.arrivals if at > now]
+		rest = queued[size:]
+		self.arrivals = ([(now, rest)] if rest else []) + later
+		return queued[:size]
+
+	def write(self, data: bytes) -> int:
+		return len(data)
+
+	def close(self):
+		pass
+
+
+class ArrivingLinker(BaseFtdiLinker):
+	name = "Arriving"
+	clock_speed = 6.0
+	latency_timer = 16
+
+
+@pytest.fixture
+def linker() -> ArrivingLinker:
+	return ArrivingLinker(ArrivingHandle())
+
+
+def test_waits_for_the_response(linker):
+	handle = linker.handle
+	handle.arrive(0.1, b"\x01\x02\x03")
+	assert linker.wait_read(3) == b"\x01\x02\x03"
+	# Not long after it arrived
+	assert 0.1 <= handle.clock.now <= 0.1 + linker.poll_interval_max
+
+def test_first_sleep_is_for_what_hasnt_arrived(linker):
+	handle = linker.handle
+	handle.arrive(0.0, bytes(4000))
+	handle.arrive(0.0002, bytes(96))
+	assert len(linker.wait_read(4096)) == 4096
+	# Sleeping for the whole response would have waited milliseconds
+	assert handle.clock.now < 0.001
+
+def test_backs_off_instead_of_spinning(linker):
+	handle = linker.handle
+	handle.arrive(0.5, b"\x00")
+	linker.wait_read(1)
+	# Spinning would poll endlessly on a clock which only moves when slept on
+	assert handle.polls <= 0.5 / linker.poll_interval_max + 20
+	assert linker.wait_stats.waits == 1
+	assert linker.wait_stats.polls == handle.polls
+	assert linker.wait_stats.secs == pytest.approx(handle.clock.now)
+
+def test_times_out(linker):
+	handle = linker.handle
+	handle.arrive(0.0, b"\x00")
+	with pytest.raises(DeviceError):
+		linker.wait_read(2, secs=1)
+	assert handle.clock.now == pytest.approx(1)
+
+def test_too_much_in_the_queue(linker):
+	linker.handle.arrive(0.0, b"\x00\x01")
+	with pytest.raises(DeviceError):
+		linker.wait_read(1)
+
+def test_inexact_reads_leave_the_rest(linker):
+	linker.handle.arrive(0.0, b"\x00\x01")
+	assert linker.wait_read(1, exact=False) == b"\x00"
+	assert linker.wait_read(1) == b"\x01"